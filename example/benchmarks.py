@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Micro benchmarks of swallow internals, run with ``python benchmarks.py``
+from the example project directory. They do not need a database."""
+import sys
+from timeit import default_timer
+
+from django.core.management import setup_environ
+
+import settings
+setup_environ(settings)
+
+from django.db import models
+
+from swallow.builder import BaseBuilder
+from swallow.mappers import BaseMapper
+from swallow.populator import BasePopulator
+
+
+WIDE_FIELDS = 60
+
+
+def _wide_model():
+    attrs = {
+        '__module__': __name__,
+        'Meta': type('Meta', (), {'app_label': 'swallow'}),
+    }
+    for i in xrange(WIDE_FIELDS):
+        attrs['field%s' % i] = models.IntegerField(null=True)
+    return type('WideModel', (models.Model,), attrs)
+
+
+WideModel = _wide_model()
+
+
+class WideMapper(BaseMapper):
+
+    def __getattr__(self, name):
+        if name.startswith('field'):
+            return self._content
+        raise AttributeError(name)
+
+
+class WidePopulator(BasePopulator):
+
+    # half of the fields are mapper properties, the other half is
+    # populated by methods
+    _fields_one_to_one = tuple(
+        'field%s' % i for i in xrange(0, WIDE_FIELDS, 2)
+    )
+    _fields_if_instance_already_exists = None
+    _fields_if_instance_modified_from_last_import = None
+
+
+def _method(name):
+    def method(self):
+        setattr(self._instance, name, self._mapper._content)
+    return method
+
+
+for i in xrange(1, WIDE_FIELDS, 2):
+    setattr(WidePopulator, 'field%s' % i, _method('field%s' % i))
+
+
+def populate_fields(builder, plan_of, count):
+    """Populates the simple fields of ``count`` instances like
+    :meth:`BaseBuilder.process_mapper` does"""
+    for i in xrange(count):
+        mapper = WideMapper(i)
+        instance = WideModel()
+        populator = WidePopulator(mapper, instance, False, builder)
+        plan = plan_of(populator, instance)
+        for name, method in plan.fields:
+            if method is None:
+                setattr(instance, name, getattr(mapper, name))
+            else:
+                method(populator)
+
+
+def bench_population_plans(count=2000):
+    """Cached population plans versus plans computed for each record"""
+    builder = BaseBuilder(None, None)
+    results = []
+    for label, plan_of in (
+        ('computed', builder.compile_population_plan),
+        ('cached', builder.population_plan),
+    ):
+        start = default_timer()
+        populate_fields(builder, plan_of, count)
+        elapsed = default_timer() - start
+        results.append((label, elapsed))
+        print '%s fields, %s records, %s plans: %.3fs (%.1f records/s)' % (
+            WIDE_FIELDS,
+            count,
+            label,
+            elapsed,
+            count / elapsed,
+        )
+    return results
+
+
+BENCHMARKS = (
+    bench_population_plans,
+)
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for bench in BENCHMARKS:
+        if not names or bench.__name__ in names:
+            bench()
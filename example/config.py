@@ -1,7 +1,5 @@
-from lxml import etree
-
 from swallow.config import BaseConfig
-from swallow.mappers import BaseMapper
+from swallow.mappers import IterXmlMapper, XPathField
 from swallow.populator import BasePopulator
 from swallow.builder import BaseBuilder
 
@@ -15,29 +13,17 @@ class FeedBuilder(BaseBuilder):
 
     Model = FeedItem
 
-    class Mapper(BaseMapper):
-
-        def __init__(self, item):
-            self.item = item
+    class Mapper(IterXmlMapper):
 
-        @classmethod
-        def _iter_mappers(cls, file_path, f):
-            xml = etree.parse(f)
-            root = xml.getroot()
-            for item in root.xpath('.//n:entry', namespaces=NS):
-                yield cls(item)
+        ITEM_TAG = 'n:feed/n:entry'
+        NAMESPACES = NS
 
         @property
         def _instance_filters(self):
             return {'title': self.title}
 
-        @property
-        def title(self):
-            return self.item.xpath('.//n:title', namespaces=NS)[0].text[:255]
-
-        @property
-        def content(self):
-            return self.item.xpath('.//n:content', namespaces=NS)[0].text
+        title = XPathField('.//n:title', max_length=255)
+        content = XPathField('.//n:content')
 
     class Populator(BasePopulator):
 
@@ -45,6 +31,10 @@ class FeedBuilder(BaseBuilder):
         _fields_if_instance_already_exists = None
         _fields_if_instance_modified_from_last_import = None
 
+    def __init__(self, content, config):
+        super(FeedBuilder, self).__init__(content, config)
+        self.fd = config.open(content)
+
     def instance_is_locally_modified(self, instance):
         return False
 
@@ -54,6 +44,6 @@ class FeedBuilder(BaseBuilder):
 
 class Github(BaseConfig):
 
-    def load_builder(self, path, f):
+    def load_builder(self, path):
         if path.endswith('.atom'):
-            return FeedBuilder(path, f, self)
+            return FeedBuilder(path, self)
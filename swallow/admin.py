@@ -1,4 +1,3 @@
-import shutil 
 import os
 
 from django.contrib import admin
@@ -11,7 +10,8 @@ from sneak.admin import SneakAdmin
 
 from query import VirtualFileSystemQuerySet, SwallowConfigurationQuerySet
 from models import VirtualFileSystemElement, SwallowConfiguration, Matching
-from util import get_configurations
+from util import get_configurations, move_file, remove_empty_directories
+from util import split_segment, Segment
 
 
 admin.site.register(Matching)
@@ -50,28 +50,61 @@ def reset(modeladmin, request, queryset):
     # directory should always be set
     directory = request.GET['directory']
     configuration = get_configuration(directory)
+    # segment path -> (segment, names of the files to remove from it)
+    segments = {}
     for path in request.POST.getlist('_selected_action'):
         swallow_dir, filepath = get_swallow_dir_and_filepath(path)
         dir_config_method = getattr(configuration, '%s_dir' % swallow_dir)
         swallow_dir_path = dir_config_method()
         source_path = os.path.join(swallow_dir_path, *filepath)
 
+        # files of done and error dirs might be stored below a partition
+        # see BaseConfig.PARTITION
+        partition, relative_path = configuration.split_partition(
+            '/'.join(filepath)
+        )
         input_dir = configuration.input_dir()
-        target_path = os.path.join(input_dir, *filepath)
-
-        shutil.move(source_path, target_path)
+        target_path = os.path.join(input_dir, relative_path)
+
+        segment_path, name = split_segment(source_path)
+        if segment_path is not None:
+            # restore the file from the segment, see BaseConfig.pack
+            if segment_path not in segments:
+                segments[segment_path] = (Segment(segment_path), [])
+            segment, names = segments[segment_path]
+            segment.extract(name, target_path)
+            names.append(name)
+        else:
+            move_file(source_path, target_path)
+            if partition:
+                remove_empty_directories(
+                    os.path.dirname(source_path),
+                    swallow_dir_path
+                )
+    # each segment is rewritten once
+    for segment, names in segments.values():
+        segment.remove(names)
 reset.short_description = 'Reset'
 
 
 def delete(modeladmin, request, queryset):
     directory = request.GET['directory']
     configuration = get_configuration(directory)
+    # segment path -> names of the files to remove from it
+    segments = {}
     for path in request.POST.getlist('_selected_action'):
         swallow_dir, filepath = get_swallow_dir_and_filepath(path)
         dir_config_method = getattr(configuration, '%s_dir' % swallow_dir)
         swallow_dir_path = dir_config_method()
         source_path = os.path.join(swallow_dir_path, *filepath)
-        os.remove(source_path)
+        segment_path, name = split_segment(source_path)
+        if segment_path is not None:
+            segments.setdefault(segment_path, []).append(name)
+        else:
+            os.remove(source_path)
+    # each segment is rewritten once
+    for segment_path, names in segments.items():
+        Segment(segment_path).remove(names)
 delete.short_description = 'Delete'
 
 
@@ -79,7 +112,7 @@ class FileSystemAdmin(SneakAdmin):
     """Custom admin class for VFS elements"""
     QuerySet = VirtualFileSystemQuerySet
 
-    list_display = ('name', 'creation_date', 'modification_date')
+    list_display = ('name', 'creation_date', 'modification_date', 'preview')
     actions = [reset, delete]
 
     def get_changelist(self, request):
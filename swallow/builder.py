@@ -1,18 +1,33 @@
 import sys
+import hashlib
+import inspect
 import logging
+import operator
 
+from time import time
 from functools import wraps
+from itertools import islice
 from contextlib import contextmanager
 
-from django.db.models.fields import AutoField
-from django.db import DatabaseError, close_connection
+from django.core.exceptions import ValidationError
+from django.utils.encoding import force_unicode
+from django.db.models import Q, Model
+from django.db.models.fields import AutoField, FieldDoesNotExist
+from django.db.models.fields.related import ForeignKey
+from django.db import DatabaseError, IntegrityError, close_connection
+from django.db import transaction, connection
 
 from swallow.exception import StopConfig, StopBuilder, StopMapper, PostponeBuilder
-from swallow.util import format_exception
+from swallow.models import MapperFingerprint, Matching
+from swallow.util import format_exception, LookupCache, normalize_value
 
 
 log = logging.getLogger('swallow.builder')
 
+# savepoint id of a mapper when the database does not support savepoints,
+# see :meth:`BaseBuilder.mapper_savepoint`
+COMMITTED = 'committed'
+
 
 @contextmanager
 def dummy():
@@ -32,6 +47,32 @@ class BaseBuilder(object):
     This is *must* be inherited and properly configured to work. See
     each attribute for more information how to set up this class."""
 
+    BATCH_SIZE = None  # If set, existing instances of this many mappers
+                       # are fetched with one query, see
+                       # :meth:`BaseBuilder.prefetch_instances`
+    BULK_CREATE_BATCH_SIZE = 100  # Number of new instances inserted at once
+                                  # when the populator ``_bulk_create``
+                                  # flag is set
+    TRACK_CHANGES = False  # If True, fetched instances are saved only if a
+                           # field changed, see
+                           # :meth:`BaseBuilder.save_changes`
+    UPDATE_WITH_QUERYSET = False  # If True, changed fields of fetched
+                                  # instances are saved with a
+                                  # ``QuerySet.update`` which does not
+                                  # send any signal
+    FINGERPRINTS = False  # If True, mappers whose content did not change
+                          # since their last successful import are not
+                          # processed, see
+                          # :meth:`BaseBuilder.mapper_fingerprint`
+    COMMIT_EVERY = None  # If set, mappers are processed in a transaction
+                         # committed every this many mappers, see
+                         # :meth:`BaseBuilder.iter_process`
+    COMMIT_INTERVAL = None  # If set, mappers are processed in a transaction
+                            # committed every this many seconds
+    CACHE_POPULATION_PLANS = True  # If False, the fields to populate are
+                                   # computed for each mapper, see
+                                   # :meth:`BaseBuilder.population_plan`
+
     @property
     def Mapper(self):
         """Mapper used to populate one to one fields in
@@ -71,50 +112,412 @@ class BaseBuilder(object):
         if ``managed``` is set to ``False`` the function won't try to commit
         transaction.
         """
-        instances = []
-        unhandled_errors = False
+        instances = list(self.iter_process())
+        return instances, self.unhandled_errors
+
+    def iter_process(self):
+        """Same as :meth:`BaseBuilder.process_and_save` but yields the
+        instances as soon as they are populated instead of returning them
+        in a list, so that they do not need to stay in memory.
+
+        ``unhandled_errors`` attribute is set once the generator is
+        exhausted.
+
+        If ``COMMIT_EVERY`` or ``COMMIT_INTERVAL`` is set and the builder
+        is not ``managed``, mappers are processed in a transaction which
+        is committed by chunks. Each mapper is processed in a savepoint, so
+        that a failing mapper is rolled back without closing the connection.
+        If the database does not support savepoints (SQLite), the
+        transaction is committed before each mapper instead, so that a
+        failing mapper can still be rolled back alone. The transaction is
+        committed too when the builder is stopped or postponed, like it
+        would have been without transaction, and rolled back on unexpected
+        errors.
+        A nested builder uses savepoints in the transaction of its parent
+        only if it sets ``COMMIT_EVERY`` or ``COMMIT_INTERVAL`` too.
+
+        Without ``COMMIT_EVERY`` nor ``COMMIT_INTERVAL``, a
+        ``DatabaseError`` closes the connection as it always did.
+        """
+        chunked = bool(self.COMMIT_EVERY or self.COMMIT_INTERVAL)
+        if self.managed or not chunked:
+            self._in_transaction = chunked and transaction.is_managed()
+            for instance in self._iter_process():
+                yield instance
+            return
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        self._in_transaction = True
+        self._commit_per_mapper = not connection.features.uses_savepoints
+        self._committed_at = time()
+        self._uncommitted = 0
+        try:
+            for instance in self._iter_process(chunked=True):
+                yield instance
+        except (StopConfig, PostponeBuilder, GeneratorExit):
+            transaction.commit()
+            raise
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+        finally:
+            self._in_transaction = False
+            self._commit_per_mapper = False
+            transaction.leave_transaction_management()
+
+    def commit_if_due(self):
+        """Commits the transaction of :meth:`BaseBuilder.iter_process`
+        if ``COMMIT_EVERY`` mappers were processed or ``COMMIT_INTERVAL``
+        seconds elapsed since the last commit"""
+        due = self.COMMIT_EVERY and self._uncommitted >= self.COMMIT_EVERY
+        if not due and self.COMMIT_INTERVAL:
+            due = time() - self._committed_at >= self.COMMIT_INTERVAL
+        if due:
+            log.info(u'commit %s mappers' % self._uncommitted)
+            transaction.commit()
+            self._committed_at = time()
+            self._uncommitted = 0
+
+    def _iter_process(self, chunked=False):
+        self.unhandled_errors = False
+        self.saves_skipped = 0
+        self.mappers_unchanged = 0
+        self._pending_creates = []
+        self._pending_keys = {}  # lookup key -> instance
+        self._deferred_ids = set()
+        self._pending_fingerprints = {}
+        self._created = []
 
-        for mapper in self.Mapper._iter_mappers(self):
+        for mapper in self.iter_mappers():
+            if chunked:
+                self.commit_if_due()
+                self._uncommitted += 1
+            self._mapper_sid = self.mapper_savepoint()
             try:
                 instance = self.process_mapper(mapper)
             except StopBuilder, e:
+                self.savepoint_commit(self._pop_mapper_sid())
                 # Implementor has asked to totally stop the import
                 msg = u"Import of builder %s has been stopped" % self
                 log.warning(msg, exc_info=sys.exc_info())
                 # FIXME: empty instances?
                 break
-            except StopConfig:
-                raise  # Propagate stop order to Config
-            except PostponeBuilder:
-                raise  # Propagate postpone order to Config
+            except (StopConfig, PostponeBuilder):
+                self.savepoint_commit(self._pop_mapper_sid())
+                # Save the instances of the previous mappers like if they
+                # were not deferred
+                self.flush_creates()
+                raise  # Propagate stop or postpone order to Config
             except StopMapper, e:
+                self.savepoint_commit(self._pop_mapper_sid())
                 msg = u"Import of mapper %s has been stopped" % mapper
                 log.warning(msg, exc_info=sys.exc_info())
                 continue  # To next mapper
             except DatabaseError, e:
-                # Close django connection, as it doest not do it by itself
-                # when things go wrong
-                # cf. https://docs.djangoproject.com/en/dev/topics/db/transactions/#django-s-default-transaction-behavior
-                close_connection()
-                unhandled_errors = True
+                self.recover(self._pop_mapper_sid())
+                self.unhandled_errors = True
                 msg = u"DatabaseError exception on %s" % mapper
                 log.error(msg, exc_info=sys.exc_info())
                 continue  # To next mapper
             except Exception, e:
-                unhandled_errors = True
+                self.savepoint_rollback(self._pop_mapper_sid())
+                self.unhandled_errors = True
                 msg = u"Unhandled exception on %s" % mapper
                 log.error(msg, exc_info=sys.exc_info())
                 continue  # To next mapper
             else:
-                if instance:
+                self.savepoint_commit(self._pop_mapper_sid())
+                for created in self._pop_created():
+                    yield created
+                if instance is None:
                     # Instance is None if mapper has be skipped in skip method
-                    instances.append(instance)
-        return instances, unhandled_errors
+                    continue
+                if id(instance) in self._deferred_ids:
+                    # it will be yielded once inserted
+                    self._deferred_ids.discard(id(instance))
+                    continue
+                yield instance
+
+        self.flush_creates()
+        for created in self._pop_created():
+            yield created
+
+        if self.FINGERPRINTS:
+            log.info(u'%s unchanged mappers skipped by %s' % (
+                self.mappers_unchanged,
+                self,
+            ))
+        if self.TRACK_CHANGES:
+            log.info(u'%s saves of unchanged instances skipped by %s' % (
+                self.saves_skipped,
+                self,
+            ))
+
+    def savepoint(self):
+        """Creates a savepoint if the builder runs in a transaction and
+        returns its id, else returns ``None``"""
+        if self._in_transaction:
+            return transaction.savepoint()
+        return None
+
+    def mapper_savepoint(self):
+        """Same as :meth:`BaseBuilder.savepoint` for the savepoint of a
+        mapper, but commits the transaction and returns ``COMMITTED`` if
+        the database does not support savepoints, so that rolling back the
+        transaction only discards the writes of the mapper"""
+        if self._in_transaction and self._commit_per_mapper:
+            transaction.commit()
+            return COMMITTED
+        return self.savepoint()
+
+    def savepoint_commit(self, sid):
+        if sid is not None and sid != COMMITTED:
+            transaction.savepoint_commit(sid)
+
+    def savepoint_rollback(self, sid):
+        if sid == COMMITTED:
+            transaction.rollback()
+        elif sid is not None:
+            transaction.savepoint_rollback(sid)
+
+    def recover(self, sid):
+        """Recovers from a ``DatabaseError`` by rolling back to savepoint
+        ``sid``. Outside of a transaction, Django connection is closed as
+        it does not do it by itself when things go wrong
+        cf. https://docs.djangoproject.com/en/dev/topics/db/transactions/#django-s-default-transaction-behavior
+        """
+        if sid is None:
+            close_connection()
+        else:
+            self.savepoint_rollback(sid)
+
+    @property
+    def lookups(self):
+        """:class:`swallow.util.LookupCache` of the config, or of the builder
+        if the config has none"""
+        lookups = getattr(self.config, 'lookups', None)
+        if lookups is None:
+            if self._lookups is None:
+                self._lookups = LookupCache()
+            lookups = self._lookups
+        return lookups
+
+    def lookup(self, Model, **filters):
+        """Returns the instance of ``Model`` matching ``filters`` like
+        ``Model.objects.get``, but the result is cached until the end of the
+        run of the config so that populators can resolve foreign keys
+        without a query per mapper:
+
+          .. code-block:: python
+
+            def section(self):
+                self._instance.section = self._builder.lookup(
+                    Section,
+                    name=self._mapper.section_name,
+                )
+
+        ``DoesNotExist`` is raised if there is no such instance, and cached
+        too. The cache is shared by nested builders, use
+        ``self.lookups.preload(Model, *names)`` to load a whole table at
+        once."""
+        return self.lookups.get(Model, **filters)
+
+    def _pop_created(self):
+        created, self._created = self._created, []
+        return created
+
+    def iter_mappers(self):
+        """Yields the mappers of the builder content. If ``BATCH_SIZE`` is
+        set, existing instances of the mappers are prefetched by batches"""
+        mappers = self.Mapper._iter_mappers(self)
+        if not self.BATCH_SIZE:
+            for mapper in mappers:
+                yield mapper
+            return
+        while True:
+            batch = list(islice(mappers, self.BATCH_SIZE))
+            if not batch:
+                break
+            self.prefetch_instances(batch)
+            self.prefetch_matchings(batch)
+            for mapper in batch:
+                yield mapper
+        self.prefetch_instances([])
+        self.prefetch_matchings([])
+
+    def _lookup_key(self, filters):
+        """Returns a hashable key for ``filters`` that can be computed
+        from an instance too, or ``None`` if ``filters`` are not simple
+        field equalities"""
+        opts = self.Model._meta
+        key = []
+        for name in sorted(filters):
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return None  # lookups like ``foo__iexact`` or ``foo_id``
+            key.append((name, normalize_value(field, filters[name])))
+        return tuple(key)
+
+    def _instance_key(self, instance, names):
+        opts = self.Model._meta
+        key = []
+        for name in names:
+            field = opts.get_field(name)
+            value = getattr(instance, field.attname)
+            key.append((name, normalize_value(field, value)))
+        return tuple(key)
+
+    def prefetch_instances(self, mappers):
+        """Fetches existing instances of ``mappers`` with one query so
+        that :meth:`BaseBuilder.get_or_create_instance` does not need to
+        query the database for them.
+
+        Filters with a single field are fetched with an ``IN`` lookup,
+        other filters are ORed. Only filters made of plain field names are
+        prefetched, values are compared in python after conversion with
+        the ``to_python`` method of the field, other mappers are looked up
+        one by one. A mapper whose filters are the same as a previous mapper
+        of the batch is looked up too, since the instance might have been
+        created by the previous mapper.
+        """
+        self._prefetch_keys = {}  # id(mapper) -> key
+        self._prefetched = {}  # key -> list of instances
+        self._consumed = set()  # keys already used by a mapper
+        self.prefetch_fingerprints(mappers)
+        lookups = []
+        names = set()
+        for mapper in mappers:
+            try:
+                filters = mapper._instance_filters
+                key = self._lookup_key(filters)
+                hash(key)
+            except Exception:
+                # the error will be raised again when the mapper is
+                # processed and handled like any other error
+                continue
+            if key is None:
+                continue
+            self._prefetch_keys[id(mapper)] = key
+            lookups.append(filters)
+            names.add(tuple(sorted(filters)))
+        if not lookups:
+            return
+        if len(names) == 1 and len(lookups[0]) == 1:
+            name = lookups[0].keys()[0]
+            values = [filters[name] for filters in lookups]
+            # ``IN`` never matches NULL, unlike ``get(name=None)``
+            qs = []
+            not_null = [value for value in values if value is not None]
+            if not_null:
+                qs.append(Q(**{'%s__in' % name: not_null}))
+            if len(not_null) < len(values):
+                qs.append(Q(**{'%s__isnull' % name: True}))
+            queryset = self.Model.objects.filter(reduce(operator.or_, qs))
+        else:
+            q = reduce(operator.or_, [Q(**filters) for filters in lookups])
+            queryset = self.Model.objects.filter(q)
+        for instance in queryset:
+            for n in names:
+                key = self._instance_key(instance, n)
+                self._prefetched.setdefault(key, []).append(instance)
+
+    def batch_matchings(self):
+        """Returns the ``from_matching`` decorators of the populator methods
+        with the ``batch`` flag"""
+        if self._batch_matchings is None:
+            self._batch_matchings = []
+            for name in dir(self.Populator):
+                decorator = getattr(
+                    getattr(self.Populator, name, None),
+                    'from_matching',
+                    None,
+                )
+                if decorator is not None and decorator.batch:
+                    self._batch_matchings.append(decorator)
+        return self._batch_matchings
+
+    def prefetch_matchings(self, mappers):
+        """Evaluates the matchings of populator methods decorated with
+        ``from_matching(..., batch=True)`` for all ``mappers`` at once, see
+        :meth:`swallow.models.Matching.match_many`. If the evaluation
+        fails, matchings are evaluated mapper by mapper"""
+        self._matched = {}  # (matching name, first_match) -> results
+        if not mappers:
+            return
+        for decorator in self.batch_matchings():
+            key = (decorator.matching_name, decorator.first_match)
+            if key in self._matched:
+                continue
+            try:
+                matching = self.lookup(Matching, name=decorator.matching_name)
+                results = matching.match_many(mappers, decorator.first_match)
+            except Exception:
+                msg = u"batch evaluation of matching %s failed" % decorator.matching_name
+                log.warning(msg, exc_info=sys.exc_info())
+                continue
+            self._matched[key] = dict(
+                (id(mapper), result)
+                for mapper, result in zip(mappers, results)
+            )
+
+    def matched(self, decorator, mapper):
+        """Returns the result of the matching of ``decorator`` for
+        ``mapper`` computed by :meth:`BaseBuilder.prefetch_matchings`,
+        raises ``KeyError`` if it was not computed"""
+        key = (decorator.matching_name, decorator.first_match)
+        return self._matched[key][id(mapper)]
+
+    def prefetch_fingerprints(self, mappers):
+        """Fetches the fingerprints of ``mappers`` with one query, see
+        :meth:`BaseBuilder.is_unchanged`"""
+        self._fingerprints = {}  # key -> digest
+        if not self.FINGERPRINTS or getattr(self.config, 'force', False):
+            return
+        keys = []
+        for mapper in mappers:
+            try:
+                keys.append(self._fingerprint_key(mapper._instance_filters))
+            except Exception:
+                # the error will be raised again when the mapper is
+                # processed and handled like any other error
+                continue
+        if not keys:
+            return
+        queryset = MapperFingerprint.objects.filter(
+            model=self._model_label(),
+            key__in=keys,
+        )
+        for key, digest in queryset.values_list('key', 'digest'):
+            self._fingerprints[key] = digest
+        for key in keys:
+            # absent keys do not need to be looked up
+            self._fingerprints.setdefault(key, None)
 
     def process_mapper(self, mapper):
         log.info('processing of %s mapper starts' % mapper)
         if not self.skip(mapper):
+            fingerprint = self.mapper_fingerprint(mapper)
+            unchanged = (
+                fingerprint is not None and self.is_unchanged(fingerprint)
+            )
+            self._mapper_errors = False
+
+            if self._pending_creates:
+                # the instance might be waiting to be inserted
+                key = self._mapper_key(mapper)
+                if key is None or key in self._pending_keys:
+                    self.flush_creates()
             instance = self.get_or_create_instance(mapper)
+            if unchanged and not instance._state.adding:
+                # the existing instance is returned so that parent builders
+                # keep their relations to it
+                log.info('skip unchanged %s mapper' % mapper)
+                self.mappers_unchanged += 1
+                return instance
             modified = self.instance_is_locally_modified(instance)
             populator = self.Populator(
                 mapper,
@@ -123,84 +526,429 @@ class BaseBuilder(object):
                 self
             )
 
+            snapshot = None
+            if self.TRACK_CHANGES and instance.pk is not None:
+                snapshot = self.snapshot(instance)
+
+            plan = self.population_plan(populator, instance)
+
             # --- Populate simple fields
-            for field in instance._meta.fields:
-                if isinstance(field, AutoField):
-                    # can't set auto field
-                    pass
-                else:
-                    if populator._to_set(field.name):
-                        # Do not catch exceptions here
-                        self.set_field(
-                            populator,
-                            instance,
-                            mapper,
-                            field.name
-                        )
+            # Do not catch exceptions here
+            if self._default_set_field:
+                for name, method in plan.fields:
+                    if method is None:
+                        # it's a mapper property
+                        setattr(instance, name, getattr(mapper, name))
+                    else:
+                        method(populator)
+            else:
+                for name, method in plan.fields:
+                    self.set_field(populator, instance, mapper, name)
+
+            # --- Brand new instances without relations to populate
+            # can be inserted by batches
+            if self.defer_create(populator, instance, mapper):
+                if fingerprint is not None:
+                    # recorded once the instance is inserted
+                    self._pending_fingerprints[id(instance)] = fingerprint
+                return instance
 
             # --- Save to be able to populate relations fields
-            instance.save()
+            if snapshot is None:
+                instance.save()
+            else:
+                self.save_changes(instance, snapshot)
 
             # --- Populate m2m fields
-            for field in instance._meta.many_to_many:
-                if populator._to_set(field.name):
-                    try:
-                        self.set_m2m_field(
-                            populator,
-                            instance,
-                            field.name
-                        )
-                    except (StopMapper, StopBuilder, StopConfig):
-                        # Implementor has asked the import to be stopped, so
-                        # propagate it
-                        raise
-                    except DatabaseError, e:
-                        # Close django connection, as it doest not do it by itself
-                        # when things go wrong
-                        close_connection()
-                        msg = u"DatabaseError exception on m2m %s" % field.name
-                        log.error(msg, exc_info=sys.exc_info())
-                        continue  # To next field
-                    except Exception, e:
-                        # Unhandled error
-                        # Do not stop import, just continue to next field
-                        msg = u"Unhandled exception on m2m %s" % field.name
-                        log.error(msg, exc_info=sys.exc_info())
-                        continue  # To next field
+            for name in plan.m2m:
+                sid = self.savepoint()
+                try:
+                    self.set_m2m_field(
+                        populator,
+                        instance,
+                        name
+                    )
+                except (StopMapper, StopBuilder, StopConfig):
+                    # Implementor has asked the import to be stopped, so
+                    # propagate it
+                    raise
+                except DatabaseError, e:
+                    self.recover(sid)
+                    self._mapper_errors = True
+                    msg = u"DatabaseError exception on m2m %s" % name
+                    log.error(msg, exc_info=sys.exc_info())
+                    continue  # To next field
+                except Exception, e:
+                    # Unhandled error
+                    # Do not stop import, just continue to next field
+                    self.savepoint_rollback(sid)
+                    self._mapper_errors = True
+                    msg = u"Unhandled exception on m2m %s" % name
+                    log.error(msg, exc_info=sys.exc_info())
+                    continue  # To next field
+                else:
+                    self.savepoint_commit(sid)
 
             # --- Populate related fields
-            for related in instance._meta.get_all_related_objects():
-                accessor_name = related.get_accessor_name()
-                if populator._to_set(accessor_name):
-                    try:
-                        self.set_field(
-                            populator,
-                            instance,
-                            mapper,
-                            accessor_name
-                        )
-                    except (StopMapper, StopBuilder, StopConfig):
-                        # Implementor has asked the import to be stopped, so
-                        # propagate it
-                        raise
-                    except DatabaseError, e:
-                        # Close django connection, as it doest not do it by itself
-                        # when things go wrong
-                        close_connection()
-                        msg = u"DatabaseError exception on related %s" % accessor_name
-                        log.error(msg, exc_info=sys.exc_info())
-                        continue  # To next field
-                    except Exception, e:
-                        # Unhandled error
-                        # Do not stop import, just continue to next field
-                        msg = u"Unhandled exception on related %s" % accessor_name
-                        log.error(msg, exc_info=sys.exc_info())
-                        continue  # To next field
+            for accessor_name in plan.related:
+                sid = self.savepoint()
+                try:
+                    self.set_field(
+                        populator,
+                        instance,
+                        mapper,
+                        accessor_name
+                    )
+                except (StopMapper, StopBuilder, StopConfig):
+                    # Implementor has asked the import to be stopped, so
+                    # propagate it
+                    raise
+                except DatabaseError, e:
+                    self.recover(sid)
+                    self._mapper_errors = True
+                    msg = u"DatabaseError exception on related %s" % accessor_name
+                    log.error(msg, exc_info=sys.exc_info())
+                    continue  # To next field
+                except Exception, e:
+                    # Unhandled error
+                    # Do not stop import, just continue to next field
+                    self.savepoint_rollback(sid)
+                    self._mapper_errors = True
+                    msg = u"Unhandled exception on related %s" % accessor_name
+                    log.error(msg, exc_info=sys.exc_info())
+                    continue  # To next field
+                else:
+                    self.savepoint_commit(sid)
+
+            if fingerprint is not None and not self._mapper_errors:
+                self.record_fingerprint(fingerprint)
         else:
             log.info('skip %s mapper' % mapper)
             instance = None
         return instance
 
+    def _model_label(self):
+        opts = self.Model._meta
+        return '%s.%s' % (opts.app_label, opts.object_name.lower())
+
+    def _fingerprint_key(self, filters):
+        """Digest of the builder, its populator and the normalized values
+        of ``filters``, so that builders importing the same model in
+        different ways do not share fingerprints"""
+        key = self._lookup_key(filters)
+        if key is None:
+            key = sorted(filters.items())
+        parts = [_class_label(type(self)), _class_label(self.Populator)]
+        for name, value in key:
+            if isinstance(value, Model):
+                value = value.pk
+            if value is not None:
+                value = force_unicode(value)
+            parts.append(u'%s=%r' % (name, value))
+        return hashlib.sha1(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def mapper_fingerprint(self, mapper):
+        """Returns a ``(key, digest)`` tuple for ``mapper`` where ``key``
+        identifies the instance and ``digest`` the source content of the
+        mapper, see :attr:`swallow.mappers.BaseMapper._fingerprint`.
+
+        Returns ``None`` if ``FINGERPRINTS`` is not set, if the config was
+        run with ``force`` or if the mapper has no fingerprint."""
+        if not self.FINGERPRINTS or getattr(self.config, 'force', False):
+            return None
+        digest = mapper._fingerprint
+        if digest is None:
+            return None
+        return self._fingerprint_key(mapper._instance_filters), digest
+
+    def is_unchanged(self, fingerprint):
+        """Returns ``True`` if the mapper with ``fingerprint`` was already
+        imported successfully with the same content. The mapper is skipped
+        only if its instance still exists, see
+        :meth:`BaseBuilder.process_mapper`"""
+        key, digest = fingerprint
+        if key in self._fingerprints:
+            return self._fingerprints[key] == digest
+        return MapperFingerprint.objects.filter(
+            model=self._model_label(),
+            key=key,
+            digest=digest,
+        ).exists()
+
+    def record_fingerprint(self, fingerprint):
+        """Records that the mapper with ``fingerprint`` was imported
+        successfully"""
+        key, digest = fingerprint
+        self._fingerprints.pop(key, None)
+        label = self._model_label()
+        updated = MapperFingerprint.objects.filter(
+            model=label,
+            key=key,
+        ).update(digest=digest)
+        if not updated:
+            sid = self.savepoint()
+            try:
+                MapperFingerprint(model=label, key=key, digest=digest).save()
+            except IntegrityError:
+                # recorded meanwhile by another process
+                self.recover(sid)
+            else:
+                self.savepoint_commit(sid)
+
+    def snapshot(self, instance):
+        """Returns the values of ``instance`` fields"""
+        values = {}
+        for field in instance._meta.fields:
+            values[field.attname] = getattr(instance, field.attname)
+        return values
+
+    def changed_fields(self, instance, snapshot):
+        """Returns the fields of ``instance`` whose value is not the same as
+        in ``snapshot``, values are compared after conversion with the
+        ``to_python`` method of the field"""
+        changed = []
+        for field in instance._meta.fields:
+            old = snapshot[field.attname]
+            new = getattr(instance, field.attname)
+            if old == new:
+                continue
+            try:
+                if field.to_python(old) == field.to_python(new):
+                    continue
+            except ValidationError:
+                pass
+            changed.append(field)
+        return changed
+
+    def save_changes(self, instance, snapshot):
+        """Saves ``instance`` only if a field changed since ``snapshot``
+        was taken.
+
+        Only changed fields are saved, with ``QuerySet.update`` if
+        ``UPDATE_WITH_QUERYSET`` is set, else with
+        ``save(update_fields=...)`` if the version of Django supports it
+        (Django >= 1.5), otherwise the whole instance is saved.
+
+        Returns ``True`` if the instance was saved."""
+        changed = self.changed_fields(instance, snapshot)
+        if not changed:
+            self.saves_skipped += 1
+            log.info('skip save of unchanged instance')
+            return False
+        if self.UPDATE_WITH_QUERYSET:
+            values = dict((f.attname, getattr(instance, f.attname)) for f in changed)
+            self.Model._default_manager.filter(pk=instance.pk).update(**values)
+        elif _SAVE_UPDATE_FIELDS:
+            instance.save(update_fields=[f.name for f in changed])
+        else:
+            instance.save()
+        return True
+
+    def _mapper_key(self, mapper):
+        try:
+            key = self._lookup_key(mapper._instance_filters)
+            hash(key)
+        except Exception:
+            # The error will be raised again by get_or_create_instance
+            return None
+        return key
+
+    def needs_relations(self, populator, instance):
+        """Returns ``True`` if ``populator`` populates a m2m or related
+        field of ``instance``"""
+        plan = self.population_plan(populator, instance)
+        return bool(plan.m2m or plan.related)
+
+    def population_plan(self, populator, instance):
+        """Returns the :class:`PopulationPlan` of ``instance`` with
+        ``populator``, compiled once per model, populator class and state
+        of the instance (created, updated or locally modified) by
+        :meth:`BaseBuilder.compile_population_plan`.
+
+        Populator ``_fields_*`` attributes should then not depend on the
+        mapper, set ``CACHE_POPULATION_PLANS`` to ``False`` otherwise."""
+        if not self.CACHE_POPULATION_PLANS:
+            return self.compile_population_plan(populator, instance)
+        key = (
+            type(instance),
+            type(populator),
+            populator._updating,
+            bool(populator._modified),
+        )
+        plan = _population_plans.get(key)
+        if plan is None:
+            plan = self.compile_population_plan(populator, instance)
+            _population_plans[key] = plan
+        return plan
+
+    def compile_population_plan(self, populator, instance):
+        """Computes the fields of ``instance`` to populate with
+        ``populator``: fields set with :method:`BasePopulator._to_set` and
+        that are a mapper property listed in ``_fields_one_to_one`` or have
+        a populator method."""
+        one_to_one = populator._fields_one_to_one or ()
+        opts = instance._meta
+
+        def method(name):
+            value = getattr(type(populator), name, None)
+            if callable(value):
+                return value
+            return None
+
+        fields = []
+        for field in opts.fields:
+            if isinstance(field, AutoField):
+                # can't set auto field
+                continue
+            name = field.name
+            if not populator._to_set(name):
+                continue
+            if name in one_to_one:
+                fields.append((name, None))
+            else:
+                func = method(name)
+                if func is not None:
+                    fields.append((name, func))
+                # else this field doesn't need to be populated
+        m2m = []
+        for field in opts.many_to_many:
+            name = field.name
+            # m2m are always populated by populator methods
+            if populator._to_set(name) and method(name) is not None:
+                m2m.append(name)
+        related = []
+        for rel in opts.get_all_related_objects():
+            name = rel.get_accessor_name()
+            if not populator._to_set(name):
+                continue
+            if name in one_to_one or method(name) is not None:
+                related.append(name)
+        return PopulationPlan(fields, m2m, related)
+
+    def defer_create(self, populator, instance, mapper):
+        """Queues ``instance`` to be inserted with other new instances if
+        the populator ``_bulk_create`` flag is set, the instance is new and
+        there is no relation to populate. Returns ``True`` if the instance
+        was queued.
+
+        Queued instances are inserted by :meth:`BaseBuilder.flush_creates`
+        with :meth:`BaseBuilder.bulk_create`. Beware that ``save`` is not
+        called on them so no signal is sent. Instances whose filters are not
+        plain field equalities are not queued, since their primary key
+        could not be fetched after the insert.
+        """
+        if not getattr(populator, '_bulk_create', False):
+            return False
+        if populator._updating or self.needs_relations(populator, instance):
+            return False
+        key = self._mapper_key(mapper)
+        if key is None:
+            return False
+        self._pending_creates.append(instance)
+        self._pending_keys[key] = instance
+        self._deferred_ids.add(id(instance))
+        if len(self._pending_creates) >= self.BULK_CREATE_BATCH_SIZE:
+            self.flush_creates()
+        return True
+
+    def flush_creates(self):
+        """Inserts the instances queued by :meth:`BaseBuilder.defer_create`.
+        If the batch insert fails, instances are saved one by one so that
+        only the faulty instances are lost"""
+        instances, self._pending_creates = self._pending_creates, []
+        keys, self._pending_keys = self._pending_keys, {}
+        fingerprints, self._pending_fingerprints = self._pending_fingerprints, {}
+        if not instances:
+            return
+        try:
+            self._insert_creates(instances, keys, fingerprints)
+        finally:
+            self._release_mapper_savepoint()
+
+    def _insert_creates(self, instances, keys, fingerprints):
+        sid = self.savepoint()
+        try:
+            self.bulk_create(instances)
+        except DatabaseError, e:
+            self.recover(sid)
+            msg = u"DatabaseError exception on bulk insert of %s instances" % len(instances)
+            log.warning(msg, exc_info=sys.exc_info())
+        else:
+            self.savepoint_commit(sid)
+            self.fetch_primary_keys(keys)
+            self._created.extend(instances)
+            for fingerprint in fingerprints.values():
+                self.record_fingerprint(fingerprint)
+            return
+        for instance in instances:
+            sid = self.savepoint()
+            try:
+                instance.save()
+            except DatabaseError, e:
+                self.recover(sid)
+                self.unhandled_errors = True
+                msg = u"DatabaseError exception on %s" % instance
+                log.error(msg, exc_info=sys.exc_info())
+            except Exception, e:
+                self.savepoint_rollback(sid)
+                self.unhandled_errors = True
+                msg = u"Unhandled exception on %s" % instance
+                log.error(msg, exc_info=sys.exc_info())
+            else:
+                self.savepoint_commit(sid)
+                self._created.append(instance)
+                fingerprint = fingerprints.get(id(instance))
+                if fingerprint is not None:
+                    self.record_fingerprint(fingerprint)
+
+    def _pop_mapper_sid(self):
+        sid, self._mapper_sid = self._mapper_sid, None
+        return sid
+
+    def _release_mapper_savepoint(self):
+        """Releases the savepoint of the current mapper and creates a new
+        one once :meth:`BaseBuilder.flush_creates` inserted the instances
+        of the previous mappers, so that they are not rolled back if the
+        current mapper fails"""
+        if self._mapper_sid is not None:
+            self.savepoint_commit(self._pop_mapper_sid())
+            self._mapper_sid = self.mapper_savepoint()
+
+    def bulk_create(self, instances):
+        """Inserts ``instances`` with ``bulk_create`` of the model default
+        manager, or one by one if it does not exists (Django < 1.4)"""
+        _bulk_insert(self.Model._default_manager, instances)
+
+    def fetch_primary_keys(self, keys):
+        """Sets the primary key of the instances of ``keys``, a dictionary
+        of lookup keys and instances, that were inserted without it, like
+        ``bulk_create`` does from Django 1.4. Instances are fetched back
+        with one query so that parent builders and postprocessing get saved
+        instances"""
+        missing = [
+            (key, instance) for key, instance in keys.iteritems()
+            if instance.pk is None
+        ]
+        if not missing:
+            return
+        names = set(tuple(name for name, value in key) for key, _ in missing)
+        q = reduce(operator.or_, [Q(**dict(key)) for key, _ in missing])
+        fetched = {}
+        for instance in self.Model._default_manager.filter(q):
+            for n in names:
+                fetched[self._instance_key(instance, n)] = instance
+        for key, instance in missing:
+            saved = fetched.get(key)
+            if saved is None:
+                log.warning(u'inserted %s not found, lookup parameters were %s' % (
+                    self.Model._meta.object_name,
+                    dict(key),
+                ))
+                continue
+            instance.pk = saved.pk
+            instance._state.db = saved._state.db
+            instance._state.adding = False
+
     def set_field(self, populator, instance, mapper, field_name):
         if field_name in populator._fields_one_to_one:
             # it's a mapper property
@@ -221,13 +969,71 @@ class BaseBuilder(object):
         # m2m are always populated by populator methods
         method = getattr(populator, field_name, None)
         if method is not None:
-            f = getattr(instance, field_name)
-            f.clear()  # XXX: add a hook to overide
-                       # this behaviour
+            if getattr(populator, '_clear_m2m', True):
+                # the populator method adds every related object again
+                f = getattr(instance, field_name)
+                f.clear()
+            # else the populator method is expected to call
+            # :meth:`BasePopulator._sync_m2m`
             method()
         # else ``method`` is not set
         # no need to set this field
 
+    def sync_m2m_field(self, instance, field_name, objects, defaults=None):
+        """Makes the rows of the through model of m2m field ``field_name``
+        of ``instance`` match ``objects``, a list of instances or primary
+        keys of the related model.
+
+        Only the difference with the current rows is written: missing rows
+        are inserted by batches (with ``defaults`` values for the other
+        fields of the through model), rows of objects that are not in
+        ``objects`` are deleted with one query, and if ``defaults`` is set
+        the rows that are kept but whose values differ are updated with
+        one query. ``m2m_changed`` signal is not sent.
+
+        Returns the sets of the primary keys added and removed."""
+        field = instance._meta.get_field(field_name)
+        through = field.rel.through
+        source = through._meta.get_field(field.m2m_field_name())
+        target = through._meta.get_field(field.m2m_reverse_field_name())
+        manager = through._default_manager
+
+        wanted = []
+        for obj in objects:
+            if isinstance(obj, Model):
+                obj = obj.pk
+            obj = normalize_value(target, obj)
+            if obj not in wanted:
+                wanted.append(obj)
+
+        rows = manager.filter(**{source.name: instance})
+        current = set(rows.values_list(target.attname, flat=True))
+        removed = current.difference(wanted)
+        added = [pk for pk in wanted if pk not in current]
+
+        if removed:
+            rows.filter(**{'%s__in' % target.name: list(removed)}).delete()
+        if defaults:
+            kept = current.difference(removed)
+            if kept:
+                rows.filter(
+                    **{'%s__in' % target.name: list(kept)}
+                ).exclude(**defaults).update(**defaults)
+        if added:
+            news = []
+            for pk in added:
+                values = dict(defaults or {})
+                values[source.attname] = instance.pk
+                values[target.attname] = pk
+                news.append(through(**values))
+            _bulk_insert(manager, news)
+        log.info(u'%s m2m: %s added, %s removed' % (
+            field_name,
+            len(added),
+            len(removed),
+        ))
+        return set(added), removed
+
     def __init__(self, content, config, managed=False, parent_instance=None):
         # :param content: an open variable for content storing
         #                 it can a be file descriptor, a node in xml
@@ -240,7 +1046,8 @@ class BaseBuilder(object):
         # :param managed: if the builder is in a managed transaction block
         #                 it should be set to True. If it is not managed
         #                 Then it should take care of starting and ending
-        #                 transactions for each mapper.
+        #                 transactions for each mapper, see
+        #                 :attribute:`BaseBuilder.COMMIT_EVERY`.
         self.managed = managed
         # :param parent_instance: the instance created by the parent builder
         #                         you can use it in during population step
@@ -249,9 +1056,63 @@ class BaseBuilder(object):
         #                         parent_instance was already saved by the
         #                         parent builder
         self.parent_instance = parent_instance
+        # instances fetched by :meth:`BaseBuilder.prefetch_instances`
+        self._prefetch_keys = {}
+        self._prefetched = {}
+        self._consumed = set()
+        # number of unchanged instances not saved, see
+        # :meth:`BaseBuilder.save_changes`
+        self.saves_skipped = 0
+        # new instances waiting to be inserted by batch, see
+        # :meth:`BaseBuilder.defer_create`
+        self._pending_creates = []
+        self._pending_keys = {}
+        self._deferred_ids = set()
+        self._pending_fingerprints = {}
+        self._created = []
+        # fingerprints fetched by :meth:`BaseBuilder.prefetch_fingerprints`
+        self._fingerprints = {}
+        self._mapper_errors = False
+        self.mappers_unchanged = 0
+        # transaction state, see :meth:`BaseBuilder.iter_process`
+        self._in_transaction = False
+        self._commit_per_mapper = False
+        self._mapper_sid = None
+        self._committed_at = None
+        self._uncommitted = 0
+        # used by :meth:`BaseBuilder.lookup` if the config has no cache
+        self._lookups = None
+        # matchings evaluated by :meth:`BaseBuilder.prefetch_matchings`
+        self._batch_matchings = None
+        self._matched = {}
+        # simple fields are set without calling ``set_field`` if it is
+        # not overridden, see :meth:`BaseBuilder.population_plan`
+        self._default_set_field = (
+            type(self).set_field.im_func is BaseBuilder.set_field.im_func
+        )
 
     def get_or_create_instance(self, mapper):
         # get or create without saving
+        key = self._prefetch_keys.pop(id(mapper), None)
+        if key is not None and key not in self._consumed:
+            self._consumed.add(key)
+            instances = self._prefetched.get(key, [])
+            if len(instances) > 1:
+                raise self.Model.MultipleObjectsReturned(
+                    'get() returned more than one %s -- it returned %s! '
+                    'Lookup parameters were %s' % (
+                        self.Model._meta.object_name,
+                        len(instances),
+                        dict(key),
+                    )
+                )
+            if instances:
+                instance = instances[0]
+                log.info('fetched instance')
+            else:
+                instance = self.Model(**mapper._instance_filters)
+                log.info('created instance')
+            return instance
         try:
             instance = self.Model.objects.get(
                 **mapper._instance_filters
@@ -263,6 +1124,50 @@ class BaseBuilder(object):
         return instance
 
 
+class PopulationPlan(object):
+    """Fields of an instance to populate, see
+    :meth:`BaseBuilder.population_plan`"""
+
+    __slots__ = ('fields', 'm2m', 'related')
+
+    def __init__(self, fields, m2m, related):
+        # :param fields: ordered list of ``(name, method)`` for simple
+        #                fields, ``method`` is the populator function or
+        #                ``None`` for a mapper property
+        self.fields = fields
+        # :param m2m: names of m2m fields
+        self.m2m = m2m
+        # :param related: accessor names of related fields
+        self.related = related
+
+    def __repr__(self):
+        return '<PopulationPlan %s>' % ', '.join(
+            [name for name, method in self.fields] + self.m2m + self.related
+        )
+
+
+# plans computed by :meth:`BaseBuilder.population_plan`
+_population_plans = {}
+
+
+# ``update_fields`` argument of ``Model.save`` was added in Django 1.5
+_SAVE_UPDATE_FIELDS = 'update_fields' in inspect.getargspec(Model.save)[0]
+
+
+def _bulk_insert(manager, instances):
+    """Inserts ``instances`` with ``bulk_create`` of ``manager``, or one by
+    one if it does not exists (Django < 1.4)"""
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(instances)
+    else:
+        for instance in instances:
+            instance.save()
+
+
+def _class_label(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
 class from_builder(object):
     """Decorator object used to inject a builder results
     as parameters of a populator method.
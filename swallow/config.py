@@ -1,14 +1,27 @@
 import sys
 import os
+import zlib
+import errno
+import shutil
 import logging
 
-from time import time
+from time import time, localtime, mktime, strftime, strptime
+from collections import deque, OrderedDict
+from multiprocessing import Pool
 
 from django.conf import settings
+from django.db import connections, IntegrityError, transaction
 from django.utils.text import force_unicode
 
+from swallow.builder import BaseBuilder
 from swallow.exception import StopConfig, PostponeBuilder
-from swallow.util import format_exception, move_file, smart_decode, is_utf8
+from swallow.models import ImportedFile
+from swallow.util import format_exception, smart_decode, is_utf8
+from swallow.util import ScanPlan, scan_directory, file_digest, LookupCache
+from swallow.util import decompressed, logical_name, COMPRESSION_SUFFIXES
+from swallow.util import FileTransitions, Segment, SEGMENT_SUFFIX
+from swallow.util import remove_empty_directories, makedirs
+from swallow.util import Lease, LEASE_SUFFIX, default_worker_id
 
 
 log = logging.getLogger('swallow.config')
@@ -29,6 +42,47 @@ class BaseConfig(object):
     GRACE_PERIOD = 60 * 60 * 24  # Max time a secondary file will stay in input_dir
                                  # if not processed with a config.open()
                                  # (in seconds)
+    DEDUPLICATE = False  # If True, files whose content was already imported
+                         # successfully are moved to duplicate_dir without
+                         # being processed
+    MAX_FILES = None  # Max number of files processed by a run, the other
+                      # files are kept in input_dir for the next run
+    TIME_BUDGET = None  # Time (in seconds) after which a run stops
+                        # processing files, the file being processed
+                        # is not interrupted
+    ORDERING = None  # Name of an ordering of ORDERINGS or a callable, see
+                     # BaseConfig.process_ordered. If None files are
+                     # processed directory by directory
+    POSTPROCESS_CHUNK_SIZE = None  # Max number of instances passed to
+                                   # postprocess_chunk at once, if None
+                                   # it is called once per file
+    WORKERS = 1  # Number of worker processes used to process endpoint
+                 # files, files of a directory should be independent
+                 # from each other to use more than one worker
+    LOOKUP_CACHE_SIZE = 10000  # Max number of instances kept by
+                               # BaseConfig.lookups, see
+                               # BaseBuilder.lookup
+    FSYNC = 'none'  # When file moves are flushed to disk: 'none' lets
+                    # the system decide, 'file' flushes each move and
+                    # 'batch' flushes every FSYNC_BATCH_SIZE moves and
+                    # at the end of runs, see swallow.util.FileTransitions
+    FSYNC_BATCH_SIZE = 100  # Number of file moves flushed at once by the
+                            # 'batch' FSYNC policy
+    PARTITION = None  # strftime format like '%Y/%m/%d/%H', files moved to
+                      # done, error or duplicate dirs are stored below
+                      # the partition of the time they are moved, if None
+                      # these dirs mirror input dir
+    CLAIM = False  # If True, files are claimed by renaming them into
+                   # work/<worker id>/ so that several hosts can share
+                   # input dir, see BaseConfig.claim
+    WORKER_ID = None  # Id of the worker if CLAIM is set, defaults to
+                      # <host name>-<process id>
+    LEASE_DURATION = 5 * 60  # Time (in seconds) after which files claimed
+                             # by a worker which stopped updating its
+                             # lease are moved back to input dir
+    PACK = False  # If True, partitions of done, error and duplicate dirs
+                  # are packed into segments at the end of runs once
+                  # closed, see BaseConfig.pack
 
     @classmethod
     def input_dir(cls):
@@ -88,6 +142,169 @@ class BaseConfig(object):
             class_name,
             'duplicate')
         return path
+
+    @classmethod
+    def partition(cls, when=None):
+        """Returns the partition of time ``when``, now by default, see
+        :attribute:`BaseConfig.PARTITION`"""
+        if not cls.PARTITION:
+            return ''
+        if when is None:
+            when = time()
+        return strftime(cls.PARTITION, localtime(when))
+
+    @classmethod
+    def split_partition(cls, relative_path):
+        """Splits a path relative to done, error or duplicate dir into its
+        partition and the path of the file relative to input dir. The
+        partition is ``''`` if the path is not partitioned"""
+        if not cls.PARTITION:
+            return '', relative_path
+        depth = cls.PARTITION.count('/') + 1
+        components = relative_path.split('/')
+        partition = '/'.join(components[:depth])
+        if partition.endswith(SEGMENT_SUFFIX):
+            # a file archived in a segment, see BaseConfig.pack
+            partition = partition[:-len(SEGMENT_SUFFIX)]
+        try:
+            strptime(partition, cls.PARTITION)
+        except ValueError:
+            return '', relative_path
+        return partition, '/'.join(components[depth:])
+
+    @classmethod
+    def partitions(cls, directory, before=None):
+        """Returns the paths of the partitions of done, error or
+        duplicate dir ``directory`` from the oldest to the newest.
+
+        If ``before`` is given only the partitions whose files were all
+        moved before this time are returned."""
+        return cls._dated_entries(directory, before, False)
+
+    @classmethod
+    def segments(cls, directory, before=None):
+        """Same as :method:`BaseConfig.partitions` for the segments of
+        the partitions packed by :method:`BaseConfig.pack`"""
+        return cls._dated_entries(directory, before, True)
+
+    @classmethod
+    def archived_count(cls, directory):
+        """Returns the number of files in done, error or duplicate dir
+        ``directory``, including the files of its partitions and segments
+        if :attribute:`BaseConfig.PARTITION` is set"""
+        if not cls.PARTITION:
+            return len(os.listdir(directory))
+        # files moved before partitioning was enabled
+        count = len([
+            entry for entry in scan_directory(directory)
+            if not entry.is_dir and not entry.name.endswith(SEGMENT_SUFFIX)
+        ])
+        for partition in cls.partitions(directory):
+            for dirpath, dirnames, filenames in os.walk(partition):
+                count += len(filenames)
+        for path in cls.segments(directory):
+            segment = Segment(path)
+            try:
+                count += len(segment.members())
+            finally:
+                segment.close()
+        return count
+
+    @classmethod
+    def _dated_entries(cls, directory, before, segments):
+        if not cls.PARTITION:
+            return []
+        level = [('', directory)]
+        depth = cls.PARTITION.count('/') + 1
+        for i in range(depth):
+            level = [
+                (os.path.join(name, entry.name), entry.path)
+                for name, path in level
+                for entry in scan_directory(path)
+                # segments are files at the last level
+                if entry.is_dir != (segments and i == depth - 1)
+            ]
+        limit = None
+        if before is not None:
+            # beginning of the partition of ``before``
+            limit = mktime(strptime(cls.partition(before), cls.PARTITION))
+        entries = []
+        for name, path in level:
+            if segments:
+                if not name.endswith(SEGMENT_SUFFIX):
+                    continue
+                name = name[:-len(SEGMENT_SUFFIX)]
+            try:
+                start = mktime(strptime(name, cls.PARTITION))
+            except ValueError:
+                continue  # not a partition
+            if limit is None or start < limit:
+                entries.append((start, path))
+        entries.sort()
+        return [path for start, path in entries]
+
+    @classmethod
+    def pack(cls, directory, before=None):
+        """Packs each partition of done, error or duplicate dir
+        ``directory`` moved before ``before``, by default the closed
+        partitions, into a :class:`swallow.util.Segment` named after the
+        partition and returns the number of files packed.
+
+        Only the packed files are removed from the partition, with the
+        directories they leave empty, so that a file moved in meanwhile is
+        packed by the next call. The files stay readable from the segment
+        one by one, by the admin for instance."""
+        if before is None:
+            before = time()
+        fsync = cls.FSYNC != 'none'
+        count = 0
+        for partition in cls.partitions(directory, before):
+            segment = Segment(partition + SEGMENT_SUFFIX)
+            paths = segment.add(partition, fsync)
+            log.info(u'pack %s files in %s' % (len(paths), smart_decode(segment.path)))
+            count += len(paths)
+            directories = set()
+            for path in paths:
+                os.remove(path)
+                directories.add(os.path.dirname(path))
+            for path in directories:
+                remove_empty_directories(path, directory)
+        return count
+
+    def pack_partitions(self):
+        """Packs the closed partitions of done, error and duplicate dirs,
+        see :attribute:`BaseConfig.PACK`"""
+        for directory in (
+                self.done_dir(),
+                self.error_dir(),
+                self.duplicate_dir()):
+            if os.path.isdir(directory):
+                self.pack(directory)
+
+    def archive_path(self, to_dir, partial_file_path, partition=None):
+        """Returns the path where file ``partial_file_path`` is moved in
+        ``to_dir``, below the current partition if ``to_dir`` is done,
+        error or duplicate dir, see :attribute:`BaseConfig.PARTITION`"""
+        if self.PARTITION and to_dir in (
+                self.done_dir(),
+                self.error_dir(),
+                self.duplicate_dir()):
+            if partition is None:
+                partition = self.partition()
+            to_dir = os.path.join(to_dir, partition)
+        return os.path.join(to_dir, partial_file_path)
+
+    @classmethod
+    def journal_file(cls):
+        """File where moves of files between swallow directories are
+        recorded, see :method:`BaseConfig.recover`"""
+        class_name = cls.__name__.lower()
+        path = os.path.join(
+            settings.SWALLOW_DIRECTORY,
+            class_name,
+            'journal'
+        )
+        return path
     
     def load_builder(self, partial_file_path):
         """Should load a :class`:swallow.builder.BaseBuilder` class and return
@@ -102,9 +319,93 @@ class BaseConfig(object):
         """
         raise NotImplementedError()
 
-    def __init__(self, dryrun=False):
+    def __init__(self, dryrun=False, workers=None, max_files=None,
+                 time_budget=None, ordering=None, force=False,
+                 worker_id=None, shard=None):
         self.dryrun = dryrun
 
+        # :param force: if ``True`` builders process every mapper even if
+        #               its content did not change since last import, see
+        #               :attribute:`swallow.builder.BaseBuilder.FINGERPRINTS`
+        self.force = force
+
+        # :param workers: number of worker processes used to process files,
+        #                 defaults to :attribute:`BaseConfig.WORKERS`
+        if workers is None:
+            workers = self.WORKERS
+        self.workers = workers
+
+        # :param max_files, time_budget, ordering: see
+        #        :attribute:`BaseConfig.MAX_FILES`,
+        #        :attribute:`BaseConfig.TIME_BUDGET` and
+        #        :attribute:`BaseConfig.ORDERING`, class attributes are
+        #        used by default
+        if max_files is None:
+            max_files = self.MAX_FILES
+        self.max_files = max_files
+        if time_budget is None:
+            time_budget = self.TIME_BUDGET
+        self.time_budget = time_budget
+        if ordering is None:
+            ordering = self.ORDERING
+        if not (ordering is None or callable(ordering)
+                or ordering in ORDERINGS):
+            raise ValueError('ordering should be one of %s or a callable, not %r' % (
+                ', '.join(sorted(ORDERINGS)),
+                ordering,
+            ))
+        self.ordering = ordering
+        self._file_count = 0  # files handed to builders during the run
+        self._deadline = None  # end of the time budget of the run
+        self._interrupted = False  # True if files were left in input dir
+                                   # because the budget is exhausted
+        self._pool = None  # pool of worker processes, only set during run
+        self._roots = None  # real paths of swallow directories, computed
+                            # once per run by :method:`BaseConfig.paths`
+        self._opened = set()  # relative paths of files moved out of
+                              # input dir during the run
+        self._postponed = set()  # relative paths moved back to input dir
+                                 # during the run
+        self._real_paths = {}  # names without compression suffix -> paths
+                               # of the files being processed
+        # instances looked up by builders during the run, shared by nested
+        # builders, see :method:`swallow.builder.BaseBuilder.lookup`
+        self.lookups = LookupCache(self.LOOKUP_CACHE_SIZE)
+        # :param worker_id: id of the worker if :attribute:`BaseConfig.CLAIM`
+        #                   is set, defaults to
+        #                   :attribute:`BaseConfig.WORKER_ID`
+        if worker_id is None:
+            worker_id = self.WORKER_ID or default_worker_id()
+        self.worker_id = worker_id
+
+        # :param shard: ``(index, count)`` tuple, if given only the files
+        #               whose key hashes to shard ``index`` of ``count``
+        #               are processed, see :method:`BaseConfig.shard_key`
+        if shard is not None:
+            index, count = shard
+            if not 0 <= index < count:
+                raise ValueError('invalid shard %s/%s' % (index, count))
+        self.shard = shard
+        self._lease = None  # lease of the worker while it runs, only
+                            # used if CLAIM is set
+        self._claimed = set()  # relative paths claimed for the file
+                               # being processed
+        journal = self.journal_file()
+        if self.CLAIM:
+            # each worker has its own journal, replayed by the worker
+            # which reclaims its files
+            journal = self.working_dir() + '.journal'
+        elif shard is not None:
+            # shards run concurrently, each one recovers and truncates
+            # its own journal only
+            journal = '%s.%s-%s' % (journal, index, count)
+        # moves files between swallow directories and journals the moves
+        self.transitions = FileTransitions(
+            journal,
+            self.FSYNC,
+            self.FSYNC_BATCH_SIZE,
+        )
+
         self.files = []  # this is the current list of files processed
                          # by swallow
                          # FIXME: explain how it works
@@ -112,18 +413,194 @@ class BaseConfig(object):
         self.on_error = False  # this should reset at for each file
 
     def open(self, relative_path):
+        """Moves file ``relative_path`` from input dir to work dir and
+        returns it opened.
+
+        Compressed files (gzip, bzip2 or xz) are decompressed on the fly,
+        while the file on disk stays compressed. They can be opened by
+        their name without compression suffix, like the one passed to
+        :method:`BaseConfig.load_builder`."""
+        relative_path = self.real_path(relative_path)
         path = os.path.join(
             self.input_dir(),
             relative_path
         )
-        work = os.path.join(self.work_dir(), relative_path)
-        move_file(
-            path,
-            work
+        work = os.path.join(self.working_dir(), relative_path)
+        if relative_path in self._claimed:
+            pass  # already claimed by process_file
+        elif self.CLAIM:
+            if not self.claim(relative_path):
+                raise IOError(errno.ENOENT, 'No such file or directory', path)
+        else:
+            self.transitions.move(
+                path,
+                work
+            )
+            self.files.append(relative_path)
+            self._opened.add(relative_path)
+        f = open(work, 'rb')
+        return decompressed(f)
+
+    def working_dir(self):
+        """Work dir of this worker, ``work/<worker id>`` if
+        :attribute:`BaseConfig.CLAIM` is set"""
+        if self.CLAIM:
+            return os.path.join(self.work_dir(), self.worker_id)
+        return self.work_dir()
+
+    def shard_key(self, partial_file_path):
+        """Returns the key of file ``partial_file_path`` which decides its
+        shard, files with the same key are processed by the same worker in
+        the usual order, see :attribute:`BaseConfig.shard`.
+
+        By default the key is the first component of the path, the
+        subdirectory of input dir the file belongs to, or the file itself
+        if it is at the top of input dir."""
+        return partial_file_path.split(os.sep, 1)[0]
+
+    def in_shard(self, partial_file_path):
+        """Returns ``True`` if file ``partial_file_path`` belongs to the
+        shard of this worker"""
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        key = self.shard_key(partial_file_path)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # stable across processes and hosts, unlike hash()
+        return (zlib.crc32(key) & 0xffffffff) % count == index
+
+    def claim(self, relative_path):
+        """Moves file ``relative_path`` from input dir to the work dir of
+        this worker, and returns ``False`` if another worker claimed it
+        first.
+
+        The file is renamed, so input dir and work dir should be on the
+        same file system. Each worker holds a lease which it updates while
+        it runs, the files claimed by a worker whose lease expired are
+        moved back to input dir by :method:`BaseConfig.reclaim`."""
+        claimed = self.transitions.claim(
+            os.path.join(self.input_dir(), relative_path),
+            os.path.join(self.working_dir(), relative_path),
+        )
+        if claimed:
+            self.files.append(relative_path)
+            self._opened.add(relative_path)
+            self._claimed.add(relative_path)
+        return claimed
+
+    def acquire_lease(self):
+        """Takes the lease of this worker, moves back to input dir the files
+        left by a previous worker with the same id, then reclaims the
+        expired leases.
+
+        Returns ``False`` if the lease is already held."""
+        if self._lease is not None:
+            return False
+        if os.path.exists(self.working_dir()):
+            self._reclaim_worker(self.worker_id)
+        self._lease = Lease(
+            self.working_dir() + LEASE_SUFFIX,
+            self.LEASE_DURATION,
+        )
+        self._lease.acquire()
+        self.reclaim()
+        return True
+
+    def release_lease(self):
+        """Releases the lease of this worker. If files are left in its
+        work dir the lease file is kept, so that they are reclaimed once
+        it expires"""
+        directory = self.working_dir()
+        empty = not any(
+            filenames for dirpath, dirnames, filenames in os.walk(directory)
         )
-        self.files.append(relative_path)
-        f = open(work)
-        return f
+        if empty:
+            shutil.rmtree(directory, ignore_errors=True)
+            self.transitions.close()
+            if os.path.exists(self.transitions.journal):
+                os.remove(self.transitions.journal)
+        self._lease.release(remove=empty)
+        self._lease = None
+
+    def reclaim(self):
+        """Moves back to input dir the files claimed by the workers whose
+        lease expired and returns their ids"""
+        now = self._lease.now()
+        reclaimed = []
+        for entry in scan_directory(self.work_dir()):
+            # leases being reclaimed are renamed <id>.lease.<reclaimer id>
+            worker_id, sep, reclaimer = entry.name.partition(LEASE_SUFFIX)
+            if (entry.is_dir or not sep
+                or reclaimer and not reclaimer.startswith('.')
+                or worker_id == self.worker_id):
+                continue
+            try:
+                if not self._lease.expired(entry.path, now):
+                    continue
+            except OSError:
+                continue  # reclaimed meanwhile
+            # only the worker which renames the lease reclaims it, the
+            # lease is renewed in case this worker stops while reclaiming
+            path = '%s%s.%s' % (worker_id, LEASE_SUFFIX, self.worker_id)
+            path = os.path.join(self.work_dir(), path)
+            try:
+                os.rename(entry.path, path)
+            except OSError:
+                continue
+            os.utime(path, None)
+            log.warning(u'reclaim files of worker %s' % smart_decode(worker_id))
+            self._reclaim_worker(worker_id)
+            os.remove(path)
+            reclaimed.append(worker_id)
+        return reclaimed
+
+    def _reclaim_worker(self, worker_id):
+        """Completes the moves of worker ``worker_id`` and moves back its
+        files to input dir"""
+        directory = os.path.join(self.work_dir(), worker_id)
+        if worker_id == self.worker_id:
+            transitions = self.transitions
+        else:
+            transitions = FileTransitions(directory + '.journal', self.FSYNC)
+        transitions.recover()
+        input_dir = self.input_dir()
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                self.transitions.move(
+                    path,
+                    os.path.join(input_dir, os.path.relpath(path, directory))
+                )
+        shutil.rmtree(directory, ignore_errors=True)
+        if transitions is not self.transitions:
+            transitions.close()
+            if os.path.exists(transitions.journal):
+                os.remove(transitions.journal)
+
+    def real_path(self, relative_path):
+        """Returns the path in input dir of the file whose name without
+        compression suffix is ``relative_path``, see
+        :method:`BaseConfig.open`"""
+        real = self._real_paths.get(relative_path)
+        if real is not None:
+            return real
+        input_dir = self.input_dir()
+        if not os.path.exists(os.path.join(input_dir, relative_path)):
+            for suffix in COMPRESSION_SUFFIXES:
+                if os.path.exists(os.path.join(input_dir, relative_path + suffix)):
+                    return relative_path + suffix
+        return relative_path
+
+    def recover(self):
+        """Completes the moves of files interrupted by a crash of a previous
+        run and moves the files it left in work dir back to input dir, so
+        that they are processed again"""
+        work_dir = os.path.join(os.path.realpath(self.work_dir()), '')
+        for origin, path in self.transitions.recover():
+            if os.path.realpath(path).startswith(work_dir):
+                log.warning(u'move back %s left in work dir' % smart_decode(path))
+                self.transitions.move(path, origin)
 
     def run(self):
         """Process recursivly ``input_dir``"""
@@ -131,23 +608,124 @@ class BaseConfig(object):
             type(self).__name__,
             self.input_dir(),
         ))
-        self.process_recursively()
+        acquired = False
+        if self.CLAIM:
+            acquired = self.acquire_lease()
+        else:
+            self.recover()
+        self._roots = None
+        self._opened = set()
+        self._postponed = set()
+        self._file_count = 0
+        self._deadline = None
+        self._interrupted = False
+        if self.time_budget is not None:
+            self._deadline = time() + self.time_budget
+        if self.ordering is None:
+            process = self.process_recursively
+        else:
+            process = self.process_ordered
+        self.lookups.clear()
+        try:
+            if self.workers > 1 and not self.dryrun:
+                # the forked workers must not share the sockets of the
+                # parent process, each of them opens its own connections
+                for connection in connections.all():
+                    connection.close()
+                self._pool = Pool(self.workers, _init_worker, (self,))
+                try:
+                    process()
+                finally:
+                    self._pool.close()
+                    self._pool.join()
+                    self._pool = None
+            else:
+                process()
+        except:
+            self.transitions.sync()
+            raise
+        else:
+            # every file opened during the run was moved out of work dir
+            self.transitions.truncate()
+            if self.PACK and not self.dryrun:
+                self.pack_partitions()
+        finally:
+            # looked up instances may be modified before the next run
+            self.lookups.clear()
+            if acquired:
+                self.release_lease()
+
+    def budget_exhausted(self):
+        """Returns ``True`` if no more file should be processed during this
+        run according to ``max_files`` and ``time_budget``"""
+        if self.max_files is not None and self._file_count >= self.max_files:
+            exhausted = True
+        elif self._deadline is not None and time() >= self._deadline:
+            exhausted = True
+        elif self._lease is not None and self._lease.lost:
+            # the files of this worker are reclaimed by another one
+            exhausted = True
+        else:
+            exhausted = False
+        if exhausted and not self._interrupted:
+            log.info(u'budget of %s exhausted' % type(self).__name__)
+            self._interrupted = True
+        return exhausted
 
     def paths(self, path):
         """Builds paths for relative path ``path``"""
-        input = os.path.realpath(os.path.join(self.input_dir(), path))
-        work = os.path.realpath(os.path.join(self.work_dir(), path))
-        error = os.path.realpath(os.path.join(self.error_dir(), path))
-        done = os.path.realpath(os.path.join(self.done_dir(), path))
+        if self._roots is None:
+            # resolve swallow directories only once per run
+            self._roots = (
+                os.path.realpath(self.input_dir()),
+                os.path.realpath(self.working_dir()),
+                os.path.realpath(self.error_dir()),
+                os.path.realpath(self.done_dir()),
+            )
+        if not path:
+            return self._roots
+        input, work, error, done = [
+            os.path.join(root, path) for root in self._roots
+        ]
+        return input, work, error, done
+
+    def prepare_paths(self, path):
+        """Builds paths for relative path ``path`` and creates work, error
+        and done directories if they do not exist"""
+        input, work, error, done = self.paths(path)
+
+        # other shards may create the same directories concurrently
+        makedirs(work)
+        if self.PARTITION and path:
+            # partitions are created when files are moved, below the
+            # root error and done dirs
+            return input, work, error, done
+        makedirs(error)
+        makedirs(done)
+        # input_dir should exists
         return input, work, error, done
 
     def mv_files_from_work_dir(self, to_dir):
         """Move current endpoints files from work dir to to_dir."""
-        # Move the endpoint files
+        # Move the endpoint files, in the same partition
+        partition = self.partition()
+        lost = self._lease is not None and self._lease.lost
         for p in self.files:
-            work = os.path.join(self.work_dir(), p)
-            target = os.path.join(to_dir, p)
-            move_file(work, target)
+            work = os.path.join(self.working_dir(), p)
+            target = self.archive_path(to_dir, p, partition)
+            try:
+                self.transitions.move(work, target)
+            except OSError, e:
+                if not lost or e.errno != errno.ENOENT:
+                    raise
+                # moved back to input dir by the worker which reclaimed
+                # the lease, see BaseConfig.reclaim
+                log.warning(u'%s was reclaimed by another worker' % smart_decode(work))
+                continue
+            if to_dir == self.input_dir():
+                # the file is back in input dir
+                self._opened.discard(p)
+                self._postponed.add(p)
         self.files = []
 
     def listdir(self, dir):
@@ -156,103 +734,242 @@ class BaseConfig(object):
         """
         return os.listdir(dir)
 
-    def process_recursively(self, path=""):
-        """Recusively inspect :attribute:`BaseConfig.input_dir`
-        and process files using BFS
+    def scandir(self, dir):
+        """Return the content of a directory as a list of
+        :class:`swallow.util.ScanEntry`, the type and modification time of
+        each entry is collected once.
 
-        Recursivly inspect :attribute:`BaseConfig.input_dir`, loads
-        builder class through :method:`BaseConfig.load_builder` and
-        run processing"""
+        If :method:`BaseConfig.listdir` is overriden, the names it returns
+        are used."""
+        if self.listdir.im_func is BaseConfig.listdir.im_func:
+            return scan_directory(dir)
+        return scan_directory(dir, self.listdir(dir))
 
-        instances = None
-        if hasattr(self, 'postprocess'):
-            instances = []
+    def is_duplicate(self, digest):
+        """Returns ``True`` if a file with the content ``digest`` was
+        already imported successfully by this configuration"""
+        return ImportedFile.objects.filter(
+            config=type(self).__name__,
+            digest=digest,
+        ).exists()
 
-        log.info(u'process_recursively %s' % path)
+    def record_digest(self, digest, partial_file_path):
+        """Records that the file ``partial_file_path`` with the content
+        ``digest`` was imported successfully"""
+        # a failed insert aborts the whole transaction on PostgreSQL
+        # unless it is rolled back to a savepoint
+        sid = transaction.savepoint()
+        try:
+            ImportedFile.objects.get_or_create(
+                config=type(self).__name__,
+                digest=digest,
+                defaults={'path': smart_decode(partial_file_path)},
+            )
+        except IntegrityError:
+            # the same content was recorded meanwhile by another process
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
 
-        input, work, error, done = self.paths(path)
+    def process_file(self, partial_file_path):
+        """Loads the builder of ``partial_file_path`` through
+        :method:`BaseConfig.load_builder` and runs it.
 
-        if not os.path.exists(work):
-            os.makedirs(work)
-        if not os.path.exists(error):
-            os.makedirs(error)
-        if not os.path.exists(done):
-            os.makedirs(done)
-        # input_dir should exists
+        Returns a ``(to_dir, new_instances, stop)`` tuple where ``to_dir``
+        is the directory where files opened by the builder should be moved,
+        ``None`` if the file was skipped, and ``stop`` is ``True`` if the
+        implementor asked to stop the import.
 
-        log.info(u'work_path %s' % work)
+        Files are *not* moved by this method, so that it can run in a
+        worker process while the parent process keeps control of the
+        swallow directories."""
+        input_file_path = os.path.join(self.input_dir(), partial_file_path)
 
-        for f in self.listdir(input):
-            # Relative file path from current path
-            partial_file_path = os.path.join(path, f)
-            # Absolute file path
-            input_file_path = os.path.join(input, f)
+        self._claimed = set()
+        file_path = input_file_path
+        if self.CLAIM:
+            # claimed before anything else, other workers skip it
+            if not self.claim(partial_file_path):
+                return None, None, False
+            file_path = os.path.join(self.working_dir(), partial_file_path)
 
-            # For now, do not process non utf-8 file names  #FIXME
-            if not is_utf8(f):
-                error_file_path = os.path.join(self.error_dir(), f)
-                move_file(input_file_path, error_file_path)
+        digest = None
+        if self.DEDUPLICATE and not self.dryrun:
+            try:
+                digest = file_digest(file_path)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # removed or claimed by another process meanwhile
+                log.info(u'skip vanished file %s' % force_unicode(input_file_path))
+                if partial_file_path in self.files:
+                    self.files.remove(partial_file_path)
+                return None, None, False
+            if self.is_duplicate(digest):
+                log.info(u'duplicate file %s' % force_unicode(input_file_path))
+                # go through work dir like any other file so that the
+                # caller does the final move
+                if not self.CLAIM:
+                    work = os.path.join(self.working_dir(), partial_file_path)
+                    self.transitions.move(input_file_path, work)
+                    self.files.append(partial_file_path)
+                    self._opened.add(partial_file_path)
+                return self.duplicate_dir(), None, False
 
-            if os.path.isdir(input_file_path):
-                self.process_recursively(partial_file_path)
+        # builders are loaded with the name of the file without its
+        # compression suffix, see :method:`BaseConfig.open`
+        name = logical_name(partial_file_path)
+        self._real_paths = {name: partial_file_path}
+        builder = self.load_builder(name)
+        if builder is None:
+            log.info(u'skip file %s' % force_unicode(input_file_path))
+            if self.CLAIM:
+                # give the claimed file back
+                return self.input_dir(), None, False
+            return None, None, False
+
+        log.info(u'match %s' % force_unicode(partial_file_path))
+        if self.dryrun:
+            # We are in dry-run, put back the files in input dir
+            return self.input_dir(), None, False
+
+        new_instances = None
+        stop = False
+        try:
+            if hasattr(self, 'postprocess_chunk'):
+                unhandled_errors = self.postprocess_by_chunks(builder)
             else:
-                if not os.path.exists(input_file_path):
-                    # the file might have been already moved
-                    # by a nested builder
-                    continue
+                new_instances, unhandled_errors = builder.process_and_save()
+        except StopConfig, e:
+            # this is a user controlled exception
+            msg = u'Import stopped for %s' % self
+            log.warning(msg, exc_info=sys.exc_info())
+            to_dir = self.error_dir()
+            stop = True
+        except PostponeBuilder, e:
+            # Implementor as asked to postpone current process
+            msg = u'Builder postponed for %s' % self
+            log.warning(msg, exc_info=sys.exc_info())
+            # Do not move files, keep them for next run
+            to_dir = self.input_dir()
+        except Exception, e:
+            msg = u'builder processing of %s failed' % input_file_path
+            log.error(msg, exc_info=sys.exc_info())
+            to_dir = self.error_dir()
+        else:
+            to_dir = unhandled_errors and self.error_dir() \
+                                          or self.done_dir()
+            if digest is not None and not unhandled_errors:
+                self.record_digest(digest, partial_file_path)
+        return to_dir, new_instances, stop
 
-                # --- Check file age
-                # Idea is to prevent from processing a file too much recent, to
-                # avoid processing file while they are downloaded in input dir
-                # and to minimize risk of missing dependency files
-                # If you don't care about this, just do not set it in settings
-                min_age = self.QUARANTINE  # seconds
-                if min_age > 0:
-                    st_mtime = os.stat(input_file_path).st_mtime
-                    age = time() - st_mtime
-                    if age < min_age:
-                        log.info(u"Skipping too recent file %s" % force_unicode(input_file_path))
-                        continue
+    def postprocess_by_chunks(self, builder):
+        """Runs ``builder`` and passes the resulting instances to
+        ``postprocess_chunk`` by chunks of
+        :attribute:`BaseConfig.POSTPROCESS_CHUNK_SIZE` instead of
+        gathering them for ``postprocess``.
 
-                # --- Load and process builder for file
-                builder = self.load_builder(partial_file_path)
-                if builder is None:
-                    log.info(u'skip file %s' % force_unicode(input_file_path))
+        If the builder does not override
+        :meth:`swallow.builder.BaseBuilder.process_and_save` instances are
+        streamed from :meth:`swallow.builder.BaseBuilder.iter_process` so
+        that at most one chunk of instances is in memory.
+
+        When files are processed by worker processes ``postprocess_chunk``
+        is called in the workers.
+
+        Returns ``unhandled_errors`` flag of the builder."""
+        size = self.POSTPROCESS_CHUNK_SIZE
+        stream = (
+            isinstance(builder, BaseBuilder)
+            and type(builder).process_and_save.im_func
+                is BaseBuilder.process_and_save.im_func
+        )
+        if stream:
+            instances = builder.iter_process()
+        else:
+            instances, unhandled_errors = builder.process_and_save()
+        chunk = []
+        for instance in instances:
+            chunk.append(instance)
+            if size and len(chunk) >= size:
+                self.postprocess_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.postprocess_chunk(chunk)
+        if stream:
+            unhandled_errors = builder.unhandled_errors
+        return unhandled_errors
+
+    def process_files_in_pool(self, partial_file_paths, instances):
+        """Dispatch ``partial_file_paths`` to the worker processes of the
+        pool, and move the files opened by each builder once its result
+        comes back.
+
+        Only a few files per worker are in flight at a time, so that
+        files moved by a nested builder are skipped and dispatching can stop
+        quickly when a builder raises :class:`swallow.exception.StopConfig`.
+        """
+        pending = deque()
+        partial_file_paths = iter(partial_file_paths)
+        stop = False
+        while True:
+            while not stop and len(pending) < self.workers * 2:
+                try:
+                    partial_file_path = partial_file_paths.next()
+                except StopIteration:
+                    break
+                if partial_file_path in self._opened:
                     continue
-                else:
-                    log.info(u'match %s' % force_unicode(partial_file_path))
-                    if not self.dryrun:
-                        try:
-                            new_instances, unhandled_errors = builder.process_and_save()
-                        except StopConfig, e:
-                            # this is a user controlled exception
-                            msg = u'Import stopped for %s' % self
-                            log.warning(msg, exc_info=sys.exc_info())
-                            to_dir = self.error_dir()
-                            break
-                        except PostponeBuilder, e:
-                            # Implementor as asked to postpone current process
-                            msg = u'Builder postponed for %s' % self
-                            log.warning(msg, exc_info=sys.exc_info())
-                            # Do not move files, keep them for next run
-                            to_dir = self.input_dir()
-                            continue  # to next file
-                        except Exception, e:
-                            msg = u'builder processing of %s failed' % input_file_path
-                            log.error(msg, exc_info=sys.exc_info())
-                            to_dir = self.error_dir()
-                        else:
-                            if hasattr(self, 'postprocess') and new_instances:
-                                instances.append(new_instances)
-                            to_dir = unhandled_errors and self.error_dir() \
-                                                              or self.done_dir()
-                        finally:
-                            self.mv_files_from_work_dir(to_dir=to_dir)
-                    else:
-                        # We are in dry-run, put back the files in input dir
-                        self.mv_files_from_work_dir(to_dir=self.input_dir())
-
-        # --- Clean old files from current input directory
+                if self.budget_exhausted():
+                    stop = True
+                    break
+                self._file_count += 1
+                result = self._pool.apply_async(
+                    _process_file_in_worker,
+                    (partial_file_path,)
+                )
+                pending.append(result)
+            if not pending:
+                break
+            to_dir, files, new_instances, stop_ = pending.popleft().get()
+            if to_dir is not None:
+                self._opened.update(files)
+                self.files = files
+                self.mv_files_from_work_dir(to_dir=to_dir)
+            if instances is not None and new_instances:
+                instances.append(new_instances)
+            # in flight files are still handled, but no new file is
+            # dispatched
+            stop = stop or stop_
+        return stop
+
+    def process_files(self, partial_file_paths, instances):
+        """Process ``partial_file_paths`` one after the other, returns
+        ``True`` if the run should stop"""
+        for partial_file_path in partial_file_paths:
+            if partial_file_path in self._opened:
+                # the file was already moved by a nested builder
+                continue
+            if self.budget_exhausted():
+                # keep remaining files for next run
+                return True
+            self._file_count += 1
+            to_dir, new_instances, stop = self.process_file(partial_file_path)
+            if to_dir is not None:
+                self.mv_files_from_work_dir(to_dir=to_dir)
+            if instances is not None and new_instances:
+                instances.append(new_instances)
+            if stop:
+                return True
+        return False
+
+    def clean_input(self, path, plan):
+        """Clean old files from input directory ``path`` according to
+        ``plan`` a :class:`swallow.util.ScanPlan`"""
+        if self._interrupted:
+            # files left in input dir for the next run should not be
+            # mistaken for secondary files
+            return
         if not self.dryrun:
             # Here is the simplest implementation to manage secondary files
             # i.e. files that has not been endpoint files
@@ -268,17 +985,227 @@ class BaseConfig(object):
             # (See for example ticket #14051 in Django Trac)
             # When the Implementor has used Config.open to manage these files,
             # they already have been moved away
-            for f in self.listdir(input):
-                input_file_path = os.path.join(input, f)
-                done_file_path = os.path.join(done, f)
-                if os.path.isdir(input_file_path):
+            for entry in plan.expired:
+                partial_file_path = os.path.join(path, entry.name)
+                if partial_file_path in self._opened:
+                    continue
+                if not self.in_shard(partial_file_path):
+                    # might be waiting for the worker of its shard
                     continue
-                grace_period = self.GRACE_PERIOD
-                st_mtime = os.stat(input_file_path).st_mtime
-                age = time() - st_mtime
-                if age > grace_period:
-                    log.info(u"Removing old file from input dir: %s" % force_unicode(input_file_path))
-                    move_file(input_file_path, done_file_path)
+                input_file_path = entry.path
+                if not os.path.exists(input_file_path):
+                    continue
+                done_file_path = self.archive_path(self.done_dir(), partial_file_path)
+                log.info(u"Removing old file from input dir: %s" % force_unicode(input_file_path))
+                self.transitions.move(input_file_path, done_file_path)
+
+    def scan_tree(self, path, plans, candidates):
+        """Recursively scans input directory ``path``, appends
+        ``(path, plan)`` to ``plans`` for each directory and
+        ``(partial_file_path, entry)`` to ``candidates`` for each file that
+        is ready to be processed"""
+        input, work, error, done = self.prepare_paths(path)
+        plan = ScanPlan(
+            self.scandir(input),
+            self.QUARANTINE,
+            self.GRACE_PERIOD,
+        )
+        plans.append((path, plan))
+        for entry in plan.entries:
+            f = entry.name
+            partial_file_path = os.path.join(path, f)
+            # For now, do not process non utf-8 file names  #FIXME
+            if not is_utf8(f):
+                if self.in_shard(partial_file_path):
+                    error_file_path = self.archive_path(self.error_dir(), f)
+                    self.transitions.move(entry.path, error_file_path)
+            elif entry.is_dir:
+                self.scan_tree(partial_file_path, plans, candidates)
+            elif not self.in_shard(partial_file_path):
+                continue  # processed by the worker of its shard
+            elif f in plan.ready:
+                candidates.append((partial_file_path, entry))
+            else:
+                log.info(u"Skipping too recent file %s" % force_unicode(entry.path))
+
+    def process_ordered(self):
+        """Process the files of the whole input directory in the order
+        given by ``ordering``.
+
+        ``ordering`` is either the name of an ordering of
+        :data:`swallow.config.ORDERINGS` or a callable which takes the list
+        of ``(partial_file_path, entry)`` tuples ready to be processed,
+        where ``entry`` is a :class:`swallow.util.ScanEntry`, and returns
+        them in the order they should be processed.
+
+        Unlike :method:`BaseConfig.process_recursively`, ``postprocess`` is
+        called once with the instances of the whole run."""
+        log.info(u'process_ordered %s' % self.ordering)
+        plans = []
+        candidates = []
+        self.scan_tree('', plans, candidates)
+
+        ordering = self.ordering
+        if not callable(ordering):
+            ordering = ORDERINGS[ordering]
+        partial_file_paths = [c[0] for c in ordering(candidates)]
+
+        instances = None
+        if hasattr(self, 'postprocess'):
+            instances = []
+
+        if self._pool is not None:
+            self.process_files_in_pool(partial_file_paths, instances)
+        else:
+            self.process_files(partial_file_paths, instances)
+
+        for path, plan in plans:
+            self.clean_input(path, plan)
+
+        if hasattr(self, 'postprocess'):
+            self.postprocess(instances)
+
+    def process_recursively(self, path=""):
+        """Recusively inspect :attribute:`BaseConfig.input_dir`
+        and process files using BFS
+
+        Recursivly inspect :attribute:`BaseConfig.input_dir`, loads
+        builder class through :method:`BaseConfig.load_builder` and
+        run processing.
+
+        If a pool of worker processes was started by
+        :method:`BaseConfig.run` the files of a directory are processed
+        in the workers, then its subdirectories are processed."""
+
+        if self._interrupted:
+            # keep remaining files for next run
+            return
+
+        instances = None
+        if hasattr(self, 'postprocess'):
+            instances = []
+
+        log.info(u'process_recursively %s' % path)
+
+        input, work, error, done = self.prepare_paths(path)
+
+        log.info(u'work_path %s' % work)
+
+        parallel = self._pool is not None
+        subdirectories = []  # only used in parallel
+        partial_file_paths = []  # only used in parallel
+
+        # Type and age of every entry are computed once, both quarantine
+        # and grace period decisions are taken from this snapshot
+        plan = ScanPlan(
+            self.scandir(input),
+            self.QUARANTINE,
+            self.GRACE_PERIOD,
+        )
+
+        for entry in plan.entries:
+            f = entry.name
+            # Relative file path from current path
+            partial_file_path = os.path.join(path, f)
+            # Absolute file path
+            input_file_path = os.path.join(input, f)
+
+            # For now, do not process non utf-8 file names  #FIXME
+            if not is_utf8(f):
+                if self.in_shard(partial_file_path):
+                    error_file_path = self.archive_path(self.error_dir(), f)
+                    self.transitions.move(input_file_path, error_file_path)
+                continue
+
+            if entry.is_dir:
+                if parallel:
+                    subdirectories.append(partial_file_path)
+                else:
+                    self.process_recursively(partial_file_path)
+                continue
+
+            if not self.in_shard(partial_file_path):
+                # processed by the worker of its shard
+                continue
+
+            # --- Check file age
+            # Idea is to prevent from processing a file too much recent, to
+            # avoid processing file while they are downloaded in input dir
+            # and to minimize risk of missing dependency files
+            # If you don't care about this, just do not set QUARANTINE
+            if f not in plan.ready:
+                log.info(u"Skipping too recent file %s" % force_unicode(input_file_path))
+                continue
+
+            if parallel:
+                partial_file_paths.append(partial_file_path)
+            else:
+                # --- Load and process builder for file
+                if self.process_files([partial_file_path], instances):
+                    break
+
+        if parallel:
+            self.process_files_in_pool(partial_file_paths, instances)
+            for partial_file_path in subdirectories:
+                self.process_recursively(partial_file_path)
+
+        self.clean_input(path, plan)
 
         if hasattr(self, 'postprocess'):
             self.postprocess(instances)
+
+
+def oldest_first(candidates):
+    """Files with the oldest modification time first"""
+    return sorted(candidates, key=lambda candidate: candidate[1].mtime)
+
+
+def smallest_first(candidates):
+    """Smallest files first"""
+    return sorted(candidates, key=lambda candidate: candidate[1].size)
+
+
+def round_robin(candidates):
+    """One file of each directory in turn, files of a directory are kept
+    in scan order"""
+    queues = OrderedDict()
+    for candidate in candidates:
+        directory = os.path.dirname(candidate[0])
+        queues.setdefault(directory, deque()).append(candidate)
+    ordered = []
+    while queues:
+        for directory in queues.keys():
+            queue = queues[directory]
+            ordered.append(queue.popleft())
+            if not queue:
+                del queues[directory]
+    return ordered
+
+
+ORDERINGS = {
+    'oldest': oldest_first,
+    'smallest': smallest_first,
+    'round-robin': round_robin,
+}
+
+
+# The config is inherited by worker processes when the pool forks them,
+# it is set by :func:`_init_worker`
+_worker_config = None
+
+
+def _init_worker(config):
+    """Initialize a worker process of :method:`BaseConfig.run` pool"""
+    global _worker_config
+    _worker_config = config
+
+
+def _process_file_in_worker(partial_file_path):
+    """Runs :method:`BaseConfig.process_file` in a worker process and
+    returns what the parent process needs to move the files"""
+    config = _worker_config
+    config.files = []
+    to_dir, new_instances, stop = config.process_file(partial_file_path)
+    # directories changed by the worker are not known to the parent
+    config.transitions.sync()
+    return to_dir, config.files, new_instances, stop
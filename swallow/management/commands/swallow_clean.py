@@ -6,7 +6,8 @@ from optparse import make_option
 from django.utils.importlib import import_module
 from django.core.management.base import BaseCommand
 
-from swallow.util import get_config
+from swallow.util import get_config, move_file, remove_empty_directories
+from swallow.util import Segment
 
 
 class Command(BaseCommand):
@@ -32,6 +33,11 @@ class Command(BaseCommand):
             dest='move',
             default=False,
             help='Move the selected files to the duplicate folder instead of deleting them'),
+        make_option('--pack',
+            action='store_true',
+            dest='pack',
+            default=False,
+            help='Pack the partitions older than --age into segments instead of deleting them'),
         )
 
     def handle(self, *config_module_names, **options):
@@ -51,6 +57,7 @@ class Command(BaseCommand):
         max_age = int(options['age'])
         dirs = options['dirs'].split(',')
         move = options['move']
+        pack = options['pack']
 
         if dryrun:
             msg = 'This is a dry run. '
@@ -66,26 +73,89 @@ class Command(BaseCommand):
                 # fetch swallow_dir
                 swallow_dir = '%s_dir' % dir_
                 swallow_dir = getattr(ConfigClass, swallow_dir)()
+                duplicate_path = getattr(ConfigClass, 'duplicate_dir')()
+
+                def clean_file(file_path, filename):
+                    if verbosity > 0:  # Use --verbosity=0 to make it quiet
+                        if move:
+                            self.stdout.write("%s is to be moved to %s\n" % (file_path, duplicate_path))
+                        else:
+                            self.stdout.write("%s is to be deleted\n" % file_path)
+                    if not dryrun:
+                        if move:
+                            if not os.path.exists(duplicate_path):
+                                os.mkdir(duplicate_path)
+                            new_file_path = os.path.join(duplicate_path, filename)
+                            move_file(file_path, new_file_path)
+                        else:
+                            os.remove(file_path)
+
+                # partitions older than max_age are cleaned as a whole
+                # without checking the age of their files,
+                # see BaseConfig.PARTITION and BaseConfig.pack
+                partitions = set()
+                segments = set()
+                if dir_ in ('done', 'error', 'duplicate'):
+                    before = time() - max_age
+                    partitions.update(ConfigClass.partitions(swallow_dir))
+                    if pack:
+                        for partition in ConfigClass.partitions(swallow_dir, before):
+                            if verbosity > 0:
+                                self.stdout.write("%s is to be packed\n" % partition)
+                        if not dryrun:
+                            ConfigClass.pack(swallow_dir, before)
+                        # segments are kept
+                        old = []
+                    else:
+                        old = ConfigClass.partitions(swallow_dir, before)
+                        old += ConfigClass.segments(swallow_dir, before)
+                    segments.update(ConfigClass.segments(swallow_dir))
+                    for partition in old:
+                        if move:
+                            if os.path.isdir(partition):
+                                for dirpath, _, filenames in os.walk(partition):
+                                    for filename in filenames:
+                                        clean_file(os.path.join(dirpath, filename), filename)
+                            else:
+                                segment = Segment(partition)
+                                for member in segment.members():
+                                    filename = member.filename.split('/')[-1]
+                                    if verbosity > 0:
+                                        self.stdout.write("%s/%s is to be moved to %s\n" % (
+                                            partition,
+                                            member.filename,
+                                            duplicate_path,
+                                        ))
+                                    if not dryrun:
+                                        segment.extract(
+                                            member.filename,
+                                            os.path.join(duplicate_path, filename)
+                                        )
+                                segment.close()
+                        elif verbosity > 0:
+                            self.stdout.write("%s is to be deleted\n" % partition)
+                        if not dryrun:
+                            if os.path.isdir(partition):
+                                shutil.rmtree(partition)
+                            else:
+                                os.remove(partition)
+                            remove_empty_directories(
+                                os.path.dirname(partition),
+                                swallow_dir
+                            )
 
                 # clean dir
-                for dirpath, _, filenames in os.walk(swallow_dir):
+                for dirpath, dirnames, filenames in os.walk(swallow_dir):
+                    dirnames[:] = [
+                        dirname for dirname in dirnames
+                        if os.path.join(dirpath, dirname) not in partitions
+                    ]
                     for filename in filenames:
                         file_path = os.path.join(dirpath, filename)
+                        if file_path in segments:
+                            continue
                         st_mtime = os.stat(file_path).st_mtime
                         age = time() - st_mtime
 
                         if age > max_age:
-                            duplicate_path = getattr(ConfigClass, 'duplicate_dir')()
-                            if verbosity > 0:  # Use --verbosity=0 to make it quiet
-                                if move:
-                                    self.stdout.write("%s is to be moved to %s\n" % (file_path, duplicate_path))
-                                else:
-                                    self.stdout.write("%s is to be deleted\n" % file_path)
-                            if not dryrun:
-                                if move:
-                                    if not os.path.exists(duplicate_path):
-                                        os.mkdir(duplicate_path)
-                                    new_file_path = os.path.join(duplicate_path, filename)
-                                    shutil.move(file_path, new_file_path)
-                                else:
-                                    os.remove(file_path)
+                            clean_file(file_path, filename)
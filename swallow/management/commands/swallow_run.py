@@ -1,9 +1,10 @@
 from optparse import make_option
 
 from django.utils.importlib import import_module
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from swallow.util import get_config
+from swallow.util import get_config, parse_shard
+from swallow.config import ORDERINGS
 
 class Command(BaseCommand):
     args = '<import_config_module import_config_module ...>'
@@ -15,10 +16,66 @@ class Command(BaseCommand):
             dest='dryrun',
             default=False,
             help="Pretend to do the import but don't do it"),
+        make_option('--workers',
+            action='store',
+            dest='workers',
+            type='int',
+            default=None,
+            help='Number of worker processes used to process files '
+                 '(defaults to the WORKERS attribute of the configuration)'),
+        make_option('--max-files',
+            action='store',
+            dest='max_files',
+            type='int',
+            default=None,
+            help='Max number of files processed by the run, other files '
+                 'are kept for the next run'),
+        make_option('--time-budget',
+            action='store',
+            dest='time_budget',
+            type='float',
+            default=None,
+            help='Time (in seconds) after which no new file is processed'),
+        make_option('--ordering',
+            action='store',
+            dest='ordering',
+            type='choice',
+            choices=sorted(ORDERINGS),
+            default=None,
+            help='Order in which files are processed: %s' % ', '.join(
+                '"%s"' % name for name in sorted(ORDERINGS)
+            )),
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Process every record even if it did not change since '
+                 'its last import'),
+        make_option('--worker-id',
+            action='store',
+            dest='worker_id',
+            default=None,
+            help='Id of the worker when files are claimed by several hosts '
+                 '(defaults to the WORKER_ID attribute of the configuration '
+                 'or to <host name>-<process id>)'),
+        make_option('--shard',
+            action='store',
+            dest='shard',
+            default=None,
+            help='Process only the files of shard i of N given as "i/N", '
+                 'files are assigned to shards by the hash of their key, '
+                 'their subdirectory by default'),
         )
 
     def handle(self, *args, **options):
         dryrun = options['dryrun']
+        workers = options['workers']
+        shard = None
+        if options['shard'] is not None:
+            try:
+                shard = parse_shard(options['shard'])
+            except ValueError, e:
+                raise CommandError(e)
 
         if dryrun:
             msg = 'This is a dry run. '
@@ -28,5 +85,14 @@ class Command(BaseCommand):
 
         for import_config_module in args:
             ConfigClass = get_config(import_config_module)
-            config = ConfigClass(dryrun)
+            config = ConfigClass(
+                dryrun,
+                workers,
+                max_files=options['max_files'],
+                time_budget=options['time_budget'],
+                ordering=options['ordering'],
+                force=options['force'],
+                worker_id=options['worker_id'],
+                shard=shard,
+            )
             config.run()
@@ -0,0 +1,63 @@
+import signal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from swallow.util import get_config, parse_shard
+from swallow.watch import Watcher, watch
+
+
+class Command(BaseCommand):
+    args = '<import_config_module import_config_module ...>'
+    help = ('Watch input directories of specified imports and process '
+            'files as soon as they land')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help="Pretend to do the import but don't do it"),
+        make_option('--tick',
+            action='store',
+            dest='tick',
+            type='float',
+            default=1.0,
+            help='Resolution (in seconds) of the quarantine timers'),
+        make_option('--shard',
+            action='store',
+            dest='shard',
+            default=None,
+            help='Process only the files of shard i of N given as "i/N"'),
+        )
+
+    def handle(self, *args, **options):
+        dryrun = options['dryrun']
+        tick = options['tick']
+        shard = None
+        if options['shard'] is not None:
+            try:
+                shard = parse_shard(options['shard'])
+            except ValueError, e:
+                raise CommandError(e)
+
+        if dryrun:
+            msg = 'This is a dry run. '
+            msg += 'Check that your logging config is correctly set '
+            msg += 'to see what happens'
+            self.stdout.write(msg)
+
+        watchers = []
+        for import_config_module in args:
+            ConfigClass = get_config(import_config_module)
+            config = ConfigClass(dryrun, shard=shard)
+            watchers.append(Watcher(config, tick))
+
+        def stop(signum, frame):
+            # let the current file be processed before stopping
+            for watcher in watchers:
+                watcher.stop()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        watch(watchers)
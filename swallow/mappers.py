@@ -1,13 +1,118 @@
 from lxml import etree
+import re
+import csv
 import json
+import hashlib
+
+from swallow.util import decompressed
+
+
+class MapperField(object):
+    """Declarative mapper property, its value is computed by
+    :meth:`MapperField.extract` the first time it is read and then
+    memoised in the mapper instance:
+
+      .. code-block:: python
+
+        class Mapper(BaseMapper):
+
+            title = MapperField(lambda mapper: mapper._content['title'],
+                                max_length=255)
+
+    - ``converter`` is applied to the value, if it is not ``None``
+    - ``default`` is returned instead of ``None``
+    - ``max_length`` truncates strings
+    """
+
+    def __init__(self, getter=None, converter=None, default=None,
+                 max_length=None):
+        self.getter = getter
+        self.converter = converter
+        self.default = default
+        self.max_length = max_length
+        self.name = None  # attribute name, found on first access
+
+    def extract(self, mapper):
+        """Returns the raw value of the field for ``mapper``"""
+        return self.getter(mapper)
+
+    def clean(self, value):
+        if value is not None and self.converter is not None:
+            value = self.converter(value)
+        if value is None:
+            return self.default
+        if self.max_length is not None and isinstance(value, basestring):
+            value = value[:self.max_length]
+        return value
+
+    def _find_name(self, owner):
+        for klass in owner.__mro__:
+            for name, value in vars(klass).iteritems():
+                if value is self:
+                    return name
+        raise AttributeError('field not found in %s' % owner)
+
+    def __get__(self, mapper, owner):
+        if mapper is None:
+            return self
+        if self.name is None:
+            self.name = self._find_name(owner)
+        value = self.clean(self.extract(mapper))
+        try:
+            # the instance attribute takes precedence over the field from now
+            mapper.__dict__[self.name] = value
+        except AttributeError:
+            # mapper without ``__dict__``, see :class:`RowMapper`
+            pass
+        return value
+
+
+class ColumnField(MapperField):
+    """Declarative :class:`RowMapper` property whose value is the value of
+    column ``column`` of the row"""
+
+    def __init__(self, column, converter=None, default=None,
+                 max_length=None):
+        super(ColumnField, self).__init__(
+            converter=converter,
+            default=default,
+            max_length=max_length,
+        )
+        self.column = column
+
+    def extract(self, mapper):
+        return mapper._get(self.column)
 
 
 class BaseMapper(object):
 
+    # subclasses without ``__slots__`` have a ``__dict__``
+    __slots__ = ('_content', '_builder')
+
     def __init__(self, content, builder=None):
         self._content = content
         self._builder = builder
 
+    @classmethod
+    def _declared_fields(cls):
+        """Returns the names of the :class:`MapperField` of the class"""
+        names = _declared_fields.get(cls)
+        if names is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                for name, value in vars(klass).iteritems():
+                    if isinstance(value, MapperField) and name not in names:
+                        names.append(name)
+            names.sort()
+            _declared_fields[cls] = names
+        return names
+
+    def _extract(self):
+        """Computes all the declared fields of the mapper at once, so that
+        its content is not needed anymore"""
+        for name in self._declared_fields():
+            getattr(self, name)
+
     @property
     def _instance_filters(self):
         """Should return a dictionnary used to get or create
@@ -20,12 +125,100 @@ class BaseMapper(object):
         several mappers """
         raise NotImplementedError()
 
+    @property
+    def _fingerprint(self):
+        """Should return a digest of the source content of the mapper,
+        used to skip mappers whose content did not change when
+        ``FINGERPRINTS`` is set on the builder.
+
+        ``None`` means that the mapper is always processed."""
+        return None
+
+
+# declared fields by mapper class, see :meth:`BaseMapper._declared_fields`
+_declared_fields = {}
+
+
+class XPathField(MapperField):
+    """Declarative :class:`XmlMapper` property whose value is the result of
+    XPath expression ``path`` evaluated on the item of the mapper:
+
+      .. code-block:: python
+
+        class Mapper(XmlMapper):
+
+            NAMESPACES = {'n': 'http://www.w3.org/2005/Atom'}
+
+            title = XPathField('n:title/text()', max_length=255)
+            updated = XPathField('n:updated', converter=parse_date)
+            tags = XPathField('n:category/@term', many=True)
+
+    The expression is compiled once per mapper class with the
+    ``NAMESPACES`` of the class. Elements are converted to their text.
+    If ``many`` is ``False`` the first result is used, else the list of
+    results, each of them cleaned like with :class:`MapperField`. The
+    result of a number, boolean or string expression is then a list of
+    one value."""
+
+    def __init__(self, path, converter=None, default=None, max_length=None,
+                 many=False):
+        super(XPathField, self).__init__(
+            converter=converter,
+            default=default,
+            max_length=max_length,
+        )
+        self.path = path
+        self.many = many
+        self._compiled = {}  # mapper class -> etree.XPath
+
+    def compiled(self, owner):
+        xpath = self._compiled.get(owner)
+        if xpath is None:
+            xpath = etree.XPath(
+                self.path,
+                namespaces=getattr(owner, 'NAMESPACES', None) or None,
+                # results do not keep a reference to the tree
+                smart_strings=False,
+            )
+            self._compiled[owner] = xpath
+        return xpath
+
+    def extract(self, mapper):
+        result = self.compiled(type(mapper))(mapper._item)
+        if not isinstance(result, list):
+            # number, boolean or string expression
+            if self.many:
+                return [result]
+            return result
+        values = []
+        for value in result:
+            if etree.iselement(value):
+                value = value.text
+            values.append(value)
+        if self.many:
+            return values
+        if values:
+            return values[0]
+        return None
+
+    def clean(self, value):
+        if self.many:
+            return [
+                super(XPathField, self).clean(v) for v in value
+            ]
+        return super(XPathField, self).clean(value)
+
 
 # FIXME: Remove this class from swallow
 class XmlMapper(BaseMapper):
     """Xml file mapper to access it's properties passed to
     :meth:`BaseConfig.populate`"""
 
+    NAMESPACES = {}  # Namespace prefixes used in :class:`XPathField`
+    PREEXTRACT = False  # If True, declared fields are all computed when
+                        # the mapper is created, see
+                        # :meth:`BaseMapper._extract`
+
     def __init__(self, item, content, builder=None):
         # content should be a path
         super(XmlMapper, self).__init__(content, builder)
@@ -36,7 +229,258 @@ class XmlMapper(BaseMapper):
         # The builder should have a fd property
         xml = etree.parse(builder.fd)
         root = xml.getroot()
-        yield cls(root, builder.content)
+        yield cls._create(root, builder)
+
+    @classmethod
+    def _create(cls, item, builder):
+        mapper = cls(item, builder.content, builder)
+        if cls.PREEXTRACT:
+            mapper._extract()
+        return mapper
+
+    @property
+    def _fingerprint(self):
+        """Digest of the canonical form of the item"""
+        c14n = etree.tostring(self._item, method='c14n')
+        return hashlib.sha1(c14n).hexdigest()
 
     def __str__(self):
         return '<%s %s>' % (type(self).__name__, self._content)
+
+
+class IterXmlMapper(XmlMapper):
+    """Xml mapper that streams the items of ``builder.fd`` instead of
+    parsing the whole document, so that memory does not grow with the size
+    of the file.
+
+    Items are the elements matching ``ITEM_TAG``, a tag name or a path of
+    tag names separated by ``/`` ending with the item tag. Names can be
+    prefixed by a namespace prefix of ``NAMESPACES`` or use the ``{uri}tag``
+    notation:
+
+      .. code-block:: python
+
+        class Mapper(IterXmlMapper):
+
+            ITEM_TAG = 'atom:feed/atom:entry'
+            NAMESPACES = {'atom': 'http://www.w3.org/2005/Atom'}
+
+    Once the next items are read, an item is cleared with the preceding
+    siblings of itself and its ancestors, so mappers should not be used
+    after they are processed. Items of the current batch of the builder,
+    see :attribute:`swallow.builder.BaseBuilder.BATCH_SIZE`, are kept.
+    """
+
+    ITEM_TAG = None  # Tag of the items, or path of tags ending with it
+    NAMESPACES = {}  # Namespace prefixes used in ITEM_TAG and XPathField
+    HUGE_TREE = True  # Disables security restrictions of libxml2 on the
+                      # depth of the tree and the size of text nodes
+    CHUNK_SIZE = 64 * 1024  # Bytes read from the file at once
+
+    _parsers = {}  # options -> idle parsers, parsers are reused
+
+    @classmethod
+    def _item_path(cls):
+        """Returns the list of tags of ``ITEM_TAG`` in ``{uri}tag``
+        notation"""
+        path = []
+        for name in _TAG.findall(cls.ITEM_TAG):
+            if ':' in name and not name.startswith('{'):
+                prefix, name = name.split(':', 1)
+                name = '{%s}%s' % (cls.NAMESPACES[prefix], name)
+            path.append(name)
+        return path
+
+    @classmethod
+    def _get_parser(cls, tag):
+        options = (tag, cls.HUGE_TREE)
+        parsers = cls._parsers.setdefault(options, [])
+        if parsers:
+            return parsers.pop()
+        return etree.XMLPullParser(
+            events=('end',),
+            tag=tag,
+            huge_tree=cls.HUGE_TREE,
+            resolve_entities=False,
+            no_network=True,
+        )
+
+    @classmethod
+    def _release_parser(cls, tag, parser):
+        cls._parsers[(tag, cls.HUGE_TREE)].append(parser)
+
+    @classmethod
+    def _iter_items(cls, fd, keep=1):
+        """Yields the items of file ``fd``, the last ``keep`` items are
+        not cleared yet"""
+        path = cls._item_path()
+        tag = path[-1]
+        ancestors = list(reversed(path[:-1]))
+        parser = cls._get_parser(tag)
+        pending = []  # items yielded and not cleared yet
+        data = True
+        while data:
+            data = fd.read(cls.CHUNK_SIZE)
+            if data:
+                parser.feed(data)
+            else:
+                parser.close()
+            for event, item in parser.read_events():
+                if ancestors and not _has_ancestors(item, ancestors):
+                    continue
+                while len(pending) >= keep:
+                    _clear(pending.pop(0))
+                pending.append(item)
+                yield item
+        # the parser is reused only if the whole file was parsed
+        cls._release_parser(tag, parser)
+
+    @classmethod
+    def _iter_mappers(cls, builder):
+        # The builder should have a fd property
+        keep = getattr(builder, 'BATCH_SIZE', None) or 1
+        for item in cls._iter_items(builder.fd, keep):
+            yield cls._create(item, builder)
+
+
+# a tag of a path, optionally in ``{uri}tag`` notation
+_TAG = re.compile(r'(?:\{[^}]*\})?[^/]+')
+
+
+def _has_ancestors(element, tags):
+    """Returns ``True`` if the closest ancestors of ``element`` have
+    ``tags``, from parent to root"""
+    ancestors = element.iterancestors()
+    for tag in tags:
+        ancestor = next(ancestors, None)
+        if ancestor is None or ancestor.tag != tag:
+            return False
+    return True
+
+
+def _clear(element):
+    """Frees ``element`` and the elements parsed before it"""
+    element.clear()
+    for node in [element] + list(element.iterancestors()):
+        parent = node.getparent()
+        if parent is None:
+            break
+        while node.getprevious() is not None:
+            del parent[0]
+
+
+class RowMapper(BaseMapper):
+    """Base class of the mappers of line oriented files: each line of
+    ``builder.fd`` is a row and a mapper. The file is read line by line and
+    can be gzip compressed.
+
+    Columns of the row are available as attributes of the mapper, or can be
+    declared with :class:`ColumnField`. Mappers have no ``__dict__`` so
+    that they are light, subclasses should declare ``__slots__ = ()``."""
+
+    __slots__ = ('_line',)
+
+    def __init__(self, content, builder=None, line=None):
+        super(RowMapper, self).__init__(content, builder)
+        # :param line: raw line of the row
+        self._line = line
+
+    @classmethod
+    def _iter_lines(cls, builder):
+        return decompressed(builder.fd)
+
+    def _get(self, column):
+        """Returns the value of ``column``, ``None`` if the row does not
+        have it"""
+        raise NotImplementedError()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._get(name)
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def _fingerprint(self):
+        """Digest of the raw line"""
+        return hashlib.sha1(self._line).hexdigest()
+
+    def __str__(self):
+        return '<%s %s>' % (type(self).__name__, self._line.strip()[:80])
+
+
+class JsonLinesMapper(RowMapper):
+    """Mapper of a JSON lines file (one JSON object per line)"""
+
+    __slots__ = ()
+
+    @classmethod
+    def _iter_mappers(cls, builder):
+        # The builder should have a fd property
+        for line in cls._iter_lines(builder):
+            if line.strip():
+                yield cls(json.loads(line), builder, line)
+
+    def _get(self, column):
+        return self._content.get(column)
+
+    def __getattr__(self, name):
+        # undeclared columns are attributes only if the row has them
+        if name.startswith('_') or name not in self._content:
+            raise AttributeError(name)
+        return self._content[name]
+
+
+class CsvMapper(RowMapper):
+    """Mapper of a CSV file whose columns are ``COLUMNS``, or are read from
+    the first line if ``COLUMNS`` is ``None``. Without ``COLUMNS`` nor
+    ``HEADER``, columns are their positions: ``ColumnField(0)``. Values are
+    decoded from ``ENCODING``, empty values are ``None``"""
+
+    __slots__ = ()
+
+    COLUMNS = None  # Names of the columns
+    HEADER = True  # If True, the first line holds names of the columns
+    DIALECT = 'excel'  # csv module dialect or dialect class
+    DELIMITER = None  # If set, overrides the delimiter of DIALECT
+    ENCODING = 'utf-8'  # Encoding of the file
+
+    @classmethod
+    def _iter_mappers(cls, builder):
+        # The builder should have a fd property
+        lines = cls._iter_lines(builder)
+        options = {}
+        if cls.DELIMITER is not None:
+            options['delimiter'] = cls.DELIMITER
+        # blank lines are skipped once parsed, as quoted values can
+        # span several lines
+        rows = (row for row in csv.reader(lines, cls.DIALECT, **options)
+                if row)
+        columns = cls.COLUMNS
+        if cls.HEADER:
+            header = next(rows, None)
+            if columns is None:
+                columns = header or ()
+        if columns is None:
+            index = None
+        else:
+            index = dict((name, i) for i, name in enumerate(columns))
+        for row in rows:
+            row = [value.decode(cls.ENCODING) or None for value in row]
+            # the raw line is used for fingerprints only
+            line = '\x1f'.join(v.encode('utf-8') if v else '' for v in row)
+            yield cls((index, row), builder, line)
+
+    def _get(self, column):
+        index, row = self._content
+        if index is not None:
+            i = index[column]
+        elif isinstance(column, (int, long)):
+            i = column
+        else:
+            raise KeyError(column)
+        if i < len(row):
+            return row[i]
+        return None
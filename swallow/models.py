@@ -7,9 +7,12 @@ import functools
 from lxml import etree
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 
+from swallow.util import Segment, smart_decode
+
 
 def normalize(string):
     return slugify(string.lower())
@@ -70,104 +73,284 @@ class Matching(models.Model):
     class from_matching(object):
         """Populator method decorator that inject in the decorated method the
         result of the match modulo the result of ``post_process_match``
-        callback"""
+        callback.
+
+        If ``batch`` is set and the builder has a ``BATCH_SIZE``, the
+        matching is evaluated for the whole batch of mappers with
+        :meth:`Matching.match_many` before they are processed, see
+        :meth:`swallow.builder.BaseBuilder.prefetch_matchings`."""
 
         def __init__(
                 self, matching_name,
                 first_match=False,
-                post_process_match=None
+                post_process_match=None,
+                batch=False,
             ):
             self.matching_name = matching_name
             self.first_match = first_match
             self.post_process_match = post_process_match
+            self.batch = batch
 
         def __call__(self, func):
             this = self
 
             @functools.wraps(func)
             def wrapper(self):
-                matching = Matching.objects.get(name=this.matching_name)
-                match = matching.match(self._mapper, this.first_match)
+                try:
+                    match = self._builder.matched(this, self._mapper)
+                except KeyError:
+                    # the matching is fetched once per run
+                    matching = self._builder.lookup(
+                        Matching,
+                        name=this.matching_name,
+                    )
+                    match = matching.match(self._mapper, this.first_match)
                 if this.post_process_match is not None:
                     match = this.post_process_match(match)
                 values = func(self, match)
                 return values
+            wrapper.from_matching = this
             return wrapper
 
     def match(self, mapper, first_match=False):
         """Returns values or the first value if ``first_match`` is
         set that matches the mapper according the matching xml file.
+
+        See :meth:`swallow.models.CompiledMatching.match`.
         """
         # FIXME: first_match should not be used anymore
+        return self.compile().match(mapper, first_match)
+
+    def match_many(self, mappers, first_match=False):
+        """Same as :meth:`Matching.match` for a list of mappers, returns
+        the list of their results.
+
+        See :meth:`swallow.models.CompiledMatching.match_many`.
+        """
+        return self.compile().match_many(mappers, first_match)
+
+    def _compile_key(self):
+        """Identifies the content of the matching file"""
+        try:
+            mtime = os.path.getmtime(self.file.path)
+        except (NotImplementedError, OSError):
+            # the storage has no local path
+            mtime = None
+        return self.file.name, mtime
+
+    def compile(self):
+        """Returns the :class:`swallow.models.CompiledMatching` of the
+        matching file, which is cached per process until the file or the
+        matching is modified"""
+        key = self._compile_key()
+        cached = _compiled_matchings.get(self.pk)
+        if cached is not None and cached[0] == key:
+            return cached[1]
         self.file.open()
         xml = etree.parse(self.file)
         self.file.close()
-
-        output = []  # holds values to be returned
-                     # only used if ``first_match`` is ``False``
+        compiled = CompiledMatching(xml)
+        if self.pk is not None:
+            _compiled_matchings[self.pk] = (key, compiled)
+        return compiled
+
+
+class CompiledMatching(object):
+    """Rules of a matching file indexed by mapper property and value.
+
+    Each ``set`` of the file is a list of groups of rules, one group per
+    mapper property. A set matches if a rule of each of its groups
+    matches, so evaluating the matching for a mapper only needs to look up
+    the values of its properties in the index of the rules, and count the
+    groups matched by each set."""
+
+    def __init__(self, xml):
+        self.default = xml.getroot().get('default', None)
+        self.columns = []  # value of each map
+        self.map_of = []  # index of the map of each set
+        self.sizes = []  # number of groups of each set
+        self.always = set()  # sets without rules, they always match
+        self.names = []  # mapper properties used by rules
+        self.loose_names = set()  # properties used by loose rules
+        self.strict = {}  # (property, value) -> set ids
+        self.loose = {}  # (property, normalized value) -> set ids
 
         for map in xml.iterfind('//map'):
-            # a possible return value
-            column = map.find('column').text
-
-            matched_set = False
-            for set in map.iterfind('set'):
-                # build the set of rules
-                # set of rules is a dictionary::
-                #
-                #   {
-                #       'title': False,
-                #       'suptitle': False
-                #   }
-                #
-                # The value of a key is True if at least
-                # one rule matched
-                match = dict()
-                for rule in set.iterchildren():
+            self.columns.append(map.find('column').text)
+            map_id = len(self.columns) - 1
+            for set_ in map.iterfind('set'):
+                set_id = len(self.map_of)
+                self.map_of.append(map_id)
+                names = []
+                for rule in set_.iterchildren():
                     # Do not consider XML comments <!-- like this -->
                     if isinstance(rule, etree._Comment):
                         continue
                     name = rule.tag
-                    loose = rule.get('loose-compare')
-                    loose = loose == 'yes'  # Cast to boolean
-                    v1 = rule.text
-                    v2 = getattr(mapper, name)
-                    if loose:
-                        v1 = normalize(v1)
-                        v2 = normalize(v2)
-                    if v1 == v2:
-                        match[name] = True
+                    if name not in names:
+                        names.append(name)
+                    if name not in self.names:
+                        self.names.append(name)
+                    if rule.get('loose-compare') == 'yes':
+                        self.loose_names.add(name)
+                        index, value = self.loose, normalize(rule.text)
                     else:
-                        v = match.get(name, None)
-                        if v is None:
-                            match[name] = False
-                matched = True
-                for v in match.values():
-                    if not v:
-                        matched = False
-                        break
-
-                if matched:
-                    # the set matched no need to test other set
-                    # for another match one is enough
-                    # if we get here the set matched so the map matched
-                    if first_match:
-                        return column
-
-                    matched_set = True
-                    break  # no need to try another set
-            if matched_set:
-                output.append(column)
+                        index, value = self.strict, rule.text
+                    ids = index.setdefault((name, value), [])
+                    if set_id not in ids:
+                        ids.append(set_id)
+                self.sizes.append(len(names))
+                if not names:
+                    self.always.add(set_id)
+
+    def match(self, mapper, first_match=False):
+        """Returns the value of each map with a set that matches ``mapper``
+        or the first one if ``first_match`` is set. If no map matches
+        the default value of the file is returned if any.
+
+        Each property of ``mapper`` used by the rules is read and normalized
+        once."""
+        hits = [self.hits(name, getattr(mapper, name)) for name in self.names]
+        return self.result(hits, first_match)
+
+    def match_many(self, mappers, first_match=False):
+        """Returns the list of the results of :meth:`CompiledMatching.match`
+        for each of ``mappers``.
+
+        The values of each property are read for every mapper first, then
+        each distinct value is looked up and normalized once, and the result
+        is computed once per distinct combination of values."""
+        columns = []
+        for name in self.names:
+            distinct = {}  # value -> set ids matched by the value
+            column = []
+            for mapper in mappers:
+                value = getattr(mapper, name)
+                try:
+                    hits = distinct.get(value)
+                    if hits is None:
+                        hits = distinct[value] = self.hits(name, value)
+                except TypeError:
+                    # unhashable value
+                    hits = self.hits(name, value)
+                column.append(hits)
+            columns.append(column)
+        if columns:
+            rows = zip(*columns)
+        else:
+            rows = [()] * len(mappers)
+        results = {}  # ids of the hits of a row -> result
+        output = []
+        for row in rows:
+            key = tuple(id(hits) for hits in row)
+            result = results.get(key)
+            if result is None:
+                result = results[key] = self.result(row, first_match)
+            if isinstance(result, list):
+                # do not share the list between mappers
+                result = list(result)
+            output.append(result)
+        return output
+
+    def hits(self, name, value):
+        """Returns the ids of the sets with a rule about property ``name``
+        that matches ``value``"""
+        keys = [(self.strict, value)]
+        if name in self.loose_names:
+            keys.append((self.loose, normalize(value)))
+        hits = []
+        for index, value in keys:
+            try:
+                hits.extend(index.get((name, value), ()))
+            except TypeError:
+                # unhashable values can not be equal to a rule text
+                pass
+        return frozenset(hits)
+
+    def result(self, hits, first_match=False):
+        """Returns the value(s) of the maps matched given ``hits``, the set
+        ids matched by each property of :attribute:`CompiledMatching.names`"""
+        matched = {}  # set id -> number of groups matched
+        for ids in hits:
+            for set_id in ids:
+                matched[set_id] = matched.get(set_id, 0) + 1
+        maps = frozenset(
+            self.map_of[set_id]
+            for set_id, count in matched.iteritems()
+            if count == self.sizes[set_id]
+        ).union(self.map_of[set_id] for set_id in self.always)
+        output = [self.columns[map_id] for map_id in sorted(maps)]
+        if first_match and output:
+            return output[0]
         if not output:
-            default = dict(xml.getroot().items()).get('default', None)
-            if default is not None:
+            if self.default is not None:
                 if first_match:
-                    return default
+                    return self.default
                 else:
-                    output.append(default)
+                    output.append(self.default)
         return output
 
 
+# compiled matchings by matching pk, see :meth:`Matching.compile`
+_compiled_matchings = {}
+
+
+def _forget_compiled_matching(sender, instance, **kwargs):
+    _compiled_matchings.pop(instance.pk, None)
+
+
+post_save.connect(_forget_compiled_matching, sender=Matching)
+post_delete.connect(_forget_compiled_matching, sender=Matching)
+
+
+class ImportedFile(models.Model):
+    """Fingerprint of a file successfully imported by a configuration.
+
+    Used when :attribute:`swallow.config.BaseConfig.DEDUPLICATE` is set to
+    move re-delivered files to
+    :method:`swallow.config.BaseConfig.duplicate_dir` without processing
+    them again."""
+
+    # :param config: name of the configuration class
+    config = models.CharField(max_length=250, db_index=True)
+
+    # :param digest: hex digest of the content of the file
+    digest = models.CharField(max_length=64)
+
+    # :param path: path of the file relative to input dir when it was
+    #              imported
+    path = models.CharField(max_length=1024)
+
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('config', 'digest'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.config, self.path)
+
+
+class MapperFingerprint(models.Model):
+    """Digest of the source content of the last mapper successfully
+    imported for an instance, see
+    :attribute:`swallow.builder.BaseBuilder.FINGERPRINTS`"""
+
+    # :param model: ``app_label.model`` of the instance
+    model = models.CharField(max_length=250)
+
+    # :param key: digest of the filters used to get the instance
+    key = models.CharField(max_length=40)
+
+    # :param digest: digest of the source content of the mapper
+    digest = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = (('model', 'key'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.model, self.key)
+
+
 class VirtualFileSystemElement(models.Model):
     """Handles virtual directory which might be a representation of
     a file/directory found on the filesystem"""
@@ -177,12 +360,25 @@ class VirtualFileSystemElement(models.Model):
                 ("reset_filesystemelement", "Reset a file to be run again by configuration"),
             )
 
-    def __init__(self, name, path=None):
+    PREVIEW_SIZE = 200  # Number of bytes of files shown by the admin
+
+    def __init__(self, name, path=None, member=None, segment=False):
         # if path is None it's a pure virtual element
         # self.pk will be name
         super(VirtualFileSystemElement, self).__init__(name)
         self.path = path
-        if path is not None:
+        # :param member: ``zipfile.ZipInfo`` of the element if it is a file
+        #                archived in segment ``path``, see
+        #                :class:`swallow.util.Segment`
+        self.member = member
+        # :param segment: ``True`` if ``path`` is a segment, it is browsed
+        #                 like a directory
+        self.segment = segment
+        if member is not None:
+            mtime = time.mktime(member.date_time + (0, 0, -1))
+            self._creation_date = time.ctime(mtime)
+            self._modification_date = time.ctime(mtime)
+        elif path is not None:
             (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(path)
             self._creation_date = time.ctime(ctime)
             self._modification_date = time.ctime(mtime)
@@ -197,9 +393,28 @@ class VirtualFileSystemElement(models.Model):
         return self._modification_date
 
     def is_dir(self):
-        if self.path is None:
+        if self.path is None or self.member is not None:
             return False
-        return os.path.isdir(self.path)
+        return self.segment or os.path.isdir(self.path)
+
+    def preview(self):
+        """First bytes of the file"""
+        if self.path is None or self.is_dir():
+            return ''
+        if self.member is not None:
+            segment = Segment(self.path)
+            try:
+                f = segment.open(self.member.filename)
+                content = f.read(self.PREVIEW_SIZE)
+            finally:
+                segment.close()
+        else:
+            f = open(self.path, 'rb')
+            try:
+                content = f.read(self.PREVIEW_SIZE)
+            finally:
+                f.close()
+        return smart_decode(content)
 
     def name(self):
         if (self.is_dir()
@@ -219,8 +434,13 @@ class SwallowConfiguration(models.Model):
         # pk is a configuration class
         super(SwallowConfiguration, self).__init__(configuration)
         self.input_count = len(os.listdir(configuration.input_dir()))
-        self.error_count = len(os.listdir(configuration.error_dir()))
-        self.done_count = len(os.listdir(configuration.done_dir()))
+        # done and error dirs might be partitioned, see BaseConfig.PARTITION
+        self.error_count = configuration.archived_count(
+            configuration.error_dir()
+        )
+        self.done_count = configuration.archived_count(
+            configuration.done_dir()
+        )
 
     def name(self):
         name = self.pk.__name__
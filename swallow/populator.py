@@ -23,6 +23,16 @@ class BasePopulator(object):
     """
 
 
+    # If set to ``True`` new instances without m2m or related fields to
+    # populate are inserted by batches of ``BULK_CREATE_BATCH_SIZE`` see
+    # :meth:`swallow.builder.BaseBuilder.defer_create`
+    _bulk_create = False
+
+    # If set to ``False`` m2m fields are not cleared before their populator
+    # method is called, which should then use :meth:`BasePopulator._sync_m2m`
+    # so that only the changed rows are written
+    _clear_m2m = True
+
     def __init__(self, mapper, instance, modified, builder):
         self._mapper = mapper
         self._instance = instance
@@ -89,8 +99,30 @@ class BasePopulator(object):
         is cached and only done once in the instance lifetime.
         """
         if not name in self._matching_values_cache:
-            matching = Matching.objects.get(name=name)
+            matching = self._builder.lookup(Matching, name=name)
             match = matching.match(self._mapper)
             self._matching_values_cache[name] = match
         return self._matching_values_cache[name]
 
+    def _sync_m2m(self, field_name, objects, **defaults):
+        """Sets the related objects of m2m field ``field_name`` to
+        ``objects``, ``defaults`` are the values of the other fields of the
+        through model, if any. Use it with ``_clear_m2m = False``:
+
+          .. code-block:: python
+
+            class Populator(BasePopulator):
+
+                _clear_m2m = False
+
+                @Matching.from_matching('SECTIONS')
+                def sections(self, sections):
+                    self._sync_m2m('sections', sections, weight=self._mapper.weight)
+
+        See :meth:`swallow.builder.BaseBuilder.sync_m2m_field`"""
+        return self._builder.sync_m2m_field(
+            self._instance,
+            field_name,
+            objects,
+            defaults,
+        )
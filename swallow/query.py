@@ -1,10 +1,13 @@
 import os
 import bisect
 
+from time import mktime
+
 from sneak.query import ListQuerySet
 
 from swallow.models import VirtualFileSystemElement, SwallowConfiguration
-from swallow.util import get_configurations
+from swallow.util import get_configurations, split_segment, Segment
+from swallow.util import SEGMENT_SUFFIX
 
 
 class QueryResult(ListQuerySet):
@@ -81,27 +84,77 @@ class VirtualFileSystemQuerySet(ListQuerySet):
                 # this maps one to one with ``fs``
                 # modification_date of ``fs[i]`` is ``modification_date[i]``
                 modification_dates = []
-                for f in os.listdir(path):
-                    full_path = os.path.join(path, f)
+                # partitions packed in segments are browsed like directories
+                # see BaseConfig.pack
+                segment_path, prefix = split_segment(path)
+                if segment_path is not None:
+                    elements = self._segment_elements(
+                        segment_path,
+                        prefix,
+                        os.path.join(configuration_name, swallow_directory),
+                        path_components,
+                    )
+                else:
+                    elements = []
+                    archive = (
+                        configuration.PARTITION
+                        and swallow_directory in ('done', 'error', 'duplicate')
+                    )
+                    for f in os.listdir(path):
+                        full_path = os.path.join(path, f)
+                        modification_date = -os.stat(full_path).st_mtime
+                        name_tail = list(path_components)
+                        name_tail.append(f)
+                        name = os.path.join(
+                            configuration_name,
+                            swallow_directory,
+                            *name_tail
+                        )
+                        fse = VirtualFileSystemElement(
+                            name,
+                            full_path,
+                            segment=archive and f.endswith(SEGMENT_SUFFIX),
+                        )
+                        elements.append((modification_date, fse))
+                for modification_date, fse in elements:
                     # locate the insertion point of full_path.modification_date
                     # and insert in the same place in ``fs``
-                    modification_date = -os.stat(full_path).st_mtime
                     index = bisect.bisect_left(
                         modification_dates,
                         modification_date,
                     )
                     modification_dates.insert(index, modification_date)
-                    name_tail = list(path_components)
-                    name_tail.append(f)
-                    name = os.path.join(
-                        configuration_name,
-                        swallow_directory,
-                        *name_tail
-                    )
-                    fse = VirtualFileSystemElement(name, full_path)
                     fs.insert(index, fse)
         return QueryResult(fs)
 
+    def _segment_elements(self, segment_path, prefix, root, path_components):
+        """Returns the ``(modification_date, element)`` list of the files
+        and directories of directory ``prefix`` of segment
+        ``segment_path``"""
+        elements = []
+        directories = set()
+        if prefix:
+            prefix += '/'
+        segment = Segment(segment_path)
+        try:
+            for member in segment.members():
+                if not member.filename.startswith(prefix):
+                    continue
+                tail = member.filename[len(prefix):].split('/')
+                name = os.path.join(root, *(list(path_components) + tail[:1]))
+                if len(tail) > 1:
+                    # a virtual directory
+                    if tail[0] not in directories:
+                        directories.add(tail[0])
+                        elements.append((0, VirtualFileSystemElement(name)))
+                    continue
+                fse = VirtualFileSystemElement(name, segment_path, member)
+                modification_date = -mktime(member.date_time + (0, 0, -1))
+                elements.append((modification_date, fse))
+        finally:
+            segment.close()
+        return elements
+
 
 class SwallowConfigurationQuerySet(ListQuerySet):
     """Custom QuerySet object to list Swallow configurations listed
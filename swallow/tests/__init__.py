@@ -46,3 +46,5 @@ from config import *
 from transactions import *
 from builder import *
 from populator import *
+from watch import *
+from mappers import *
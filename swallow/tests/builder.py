@@ -1,15 +1,22 @@
 from django.test import TestCase
 from django.test import TransactionTestCase
+from django.db import transaction, connection, DatabaseError
+from django.db.models.signals import post_save
 
 from swallow.exception import StopImport, StopMapper, StopBuilder, StopConfig
 
+from swallow import builder as builder_module
 from swallow.builder import BaseBuilder
+from swallow.config import BaseConfig
+from swallow.util import LookupCache
 
 from swallow.populator import BasePopulator
 from swallow.mappers import BaseMapper
 
 from swallow.tests import RelatedM2M
+from swallow.tests import Article, Section, ArticleToSection
 from swallow.tests import ModelForBuilderTests
+from swallow.models import MapperFingerprint
 
 
 class BuilderNotImplementedErrorsTests(TestCase):
@@ -85,6 +92,121 @@ class BuilderGetOrCreateTests(TestCase):
         self.assertEqual(db_instance, instance)
 
 
+class BuilderPrefetchTests(TestCase):
+
+    class Builder(BaseBuilder):
+
+        Model = ModelForBuilderTests
+
+    class Mapper(BaseMapper):
+
+        @property
+        def _instance_filters(self):
+            return self._content
+
+    def test_prefetch_single_field(self):
+        ModelForBuilderTests(simple_field=1).save()
+        ModelForBuilderTests(simple_field=2).save()
+        mappers = [
+            self.Mapper({'simple_field': 1}),
+            self.Mapper({'simple_field': '2'}),
+            self.Mapper({'simple_field': 3}),
+        ]
+        builder = self.Builder(None, None)
+        self.assertNumQueries(1, builder.prefetch_instances, mappers)
+
+        instances = []
+        def get_or_create():
+            for mapper in mappers:
+                instances.append(builder.get_or_create_instance(mapper))
+        self.assertNumQueries(0, get_or_create)
+        self.assertIsNotNone(instances[0].pk)
+        self.assertEqual(1, instances[0].simple_field)
+        self.assertIsNotNone(instances[1].pk)
+        self.assertEqual(2, instances[1].simple_field)
+        self.assertIsNone(instances[2].pk)
+        self.assertEqual(3, instances[2].simple_field)
+
+    def test_prefetch_null(self):
+        """Instances whose filter value is NULL are prefetched like they are
+        looked up one by one"""
+        null = ModelForBuilderTests.objects.create(simple_field=1)
+        ModelForBuilderTests.objects.create(simple_field=2, second_field=2)
+        mappers = [
+            self.Mapper({'second_field': None}),
+            self.Mapper({'second_field': 2}),
+            self.Mapper({'second_field': 3}),
+        ]
+        one_by_one = [
+            self.Builder(None, None).get_or_create_instance(mapper).pk
+            for mapper in mappers
+        ]
+        builder = self.Builder(None, None)
+        self.assertNumQueries(1, builder.prefetch_instances, mappers)
+        batched = []
+        def get_or_create():
+            for mapper in mappers:
+                batched.append(builder.get_or_create_instance(mapper).pk)
+        self.assertNumQueries(0, get_or_create)
+        self.assertEqual(one_by_one, batched)
+        self.assertEqual(null.pk, batched[0])
+
+        # only NULL values
+        builder = self.Builder(None, None)
+        builder.prefetch_instances(mappers[:1])
+        self.assertNumQueries(0, builder.get_or_create_instance, mappers[0])
+
+    def test_prefetch_compound(self):
+        ModelForBuilderTests(simple_field=1, second_field=1).save()
+        mappers = [
+            self.Mapper({'simple_field': 1, 'second_field': 1}),
+            self.Mapper({'simple_field': 1, 'second_field': 2}),
+        ]
+        builder = self.Builder(None, None)
+        self.assertNumQueries(1, builder.prefetch_instances, mappers)
+
+        instance = builder.get_or_create_instance(mappers[0])
+        self.assertIsNotNone(instance.pk)
+        instance = builder.get_or_create_instance(mappers[1])
+        self.assertIsNone(instance.pk)
+
+    def test_prefetch_multiple_objects(self):
+        ModelForBuilderTests(simple_field=1).save()
+        ModelForBuilderTests(simple_field=1).save()
+        mapper = self.Mapper({'simple_field': 1})
+        builder = self.Builder(None, None)
+        builder.prefetch_instances([mapper])
+        self.assertRaises(
+            ModelForBuilderTests.MultipleObjectsReturned,
+            builder.get_or_create_instance,
+            mapper
+        )
+
+    def test_prefetch_same_filters(self):
+        """The second mapper with the same filters is looked up in
+        database since the first one might have created the instance"""
+        mappers = [
+            self.Mapper({'simple_field': 1}),
+            self.Mapper({'simple_field': 1}),
+        ]
+        builder = self.Builder(None, None)
+        builder.prefetch_instances(mappers)
+        instance = builder.get_or_create_instance(mappers[0])
+        self.assertIsNone(instance.pk)
+        instance.save()
+        instance = builder.get_or_create_instance(mappers[1])
+        self.assertIsNotNone(instance.pk)
+
+    def test_prefetch_unsupported_filters(self):
+        """Filters which are not plain field names are not prefetched"""
+        ModelForBuilderTests(simple_field=1).save()
+        mapper = self.Mapper({'simple_field__lte': 1})
+        builder = self.Builder(None, None)
+        self.assertNumQueries(0, builder.prefetch_instances, [mapper])
+        instance = builder.get_or_create_instance(mapper)
+        self.assertIsNotNone(instance.pk)
+
+
 class BuilderSetFieldTests(TestCase):
 
     def test_field_is_a_one_to_one(self):
@@ -150,6 +272,154 @@ class BuilderSetFieldTests(TestCase):
         self.assertIsNone(instance.simple_field)
 
 
+class BuilderPopulationPlanTests(TestCase):
+
+    def _populator(self):
+
+        class Populator(BasePopulator):
+
+            _fields_one_to_one = ('simple_field',)
+            _fields_if_instance_already_exists = ('second_field', 'm2m')
+            _fields_if_instance_modified_from_last_import = ('m2m',)
+
+            def second_field(self):
+                self._instance.second_field = 2
+
+            def m2m(self):
+                pass
+
+        return Populator
+
+    def test_compile(self):
+        """Only the fields to set that have a mapper property or a populator
+        method are in the plan"""
+        Populator = self._populator()
+        builder = BaseBuilder(None, None)
+        instance = ModelForBuilderTests(simple_field=1)
+
+        plan = builder.population_plan(Populator(None, instance, False, builder), instance)
+        self.assertEqual(
+            [('simple_field', None), ('second_field', Populator.second_field)],
+            plan.fields
+        )
+        self.assertEqual(['m2m'], plan.m2m)
+        self.assertEqual([], plan.related)
+
+        instance.save()
+        plan = builder.population_plan(Populator(None, instance, False, builder), instance)
+        self.assertEqual(['second_field'], [name for name, method in plan.fields])
+        self.assertEqual(['m2m'], plan.m2m)
+
+        plan = builder.population_plan(Populator(None, instance, True, builder), instance)
+        self.assertEqual([], plan.fields)
+        self.assertEqual(['m2m'], plan.m2m)
+
+    def test_cache(self):
+        """Plans are compiled once per model, populator class and state"""
+        Populator = self._populator()
+        builder = BaseBuilder(None, None)
+        instance = ModelForBuilderTests(simple_field=1)
+        populator = Populator(None, instance, False, builder)
+        plan = builder.population_plan(populator, instance)
+        populator = Populator(None, ModelForBuilderTests(), False, builder)
+        self.assertTrue(plan is builder.population_plan(populator, instance))
+
+        builder.CACHE_POPULATION_PLANS = False
+        self.assertFalse(plan is builder.population_plan(populator, instance))
+
+
+class BuilderLookupTests(TestCase):
+
+    def setUp(self):
+        self.sections = [Section.objects.create(name=str(i)) for i in range(3)]
+
+    def test_lookup(self):
+        """Instances and missing instances are looked up once"""
+        builder = BaseBuilder(None, None)
+        with self.assertNumQueries(2):
+            for i in range(3):
+                self.assertEqual(self.sections[1], builder.lookup(Section, name='1'))
+                self.assertRaises(
+                    Section.DoesNotExist,
+                    builder.lookup,
+                    Section,
+                    name='spam',
+                )
+        self.assertEqual(4, builder.lookups.hits)
+        self.assertEqual(2, builder.lookups.misses)
+
+    def test_shared_by_nested_builders(self):
+        """Builders of the same config share the cache"""
+        config = BaseConfig()
+        builder = BaseBuilder(None, config)
+        nested = BaseBuilder(None, config, True)
+        builder.lookup(Section, name='1')
+        with self.assertNumQueries(0):
+            nested.lookup(Section, name='1')
+
+    def test_lru(self):
+        """Least recently used instances are evicted"""
+        lookups = LookupCache(size=2)
+        lookups.get(Section, name='0')
+        lookups.get(Section, name='1')
+        lookups.get(Section, name='0')
+        lookups.get(Section, name='2')  # evicts '1'
+        self.assertEqual(2, len(lookups))
+        with self.assertNumQueries(0):
+            lookups.get(Section, name='0')
+            lookups.get(Section, name='2')
+        with self.assertNumQueries(1):
+            lookups.get(Section, name='1')
+
+    def test_preload(self):
+        """Preloaded tables are not queried again"""
+        lookups = LookupCache(size=0)
+        Section.objects.create(name='1')
+        with self.assertNumQueries(1):
+            self.assertEqual(3, lookups.preload(Section, 'name'))
+            self.assertEqual(self.sections[2], lookups.get(Section, name='2'))
+            self.assertRaises(
+                Section.DoesNotExist,
+                lookups.get,
+                Section,
+                name='spam',
+            )
+            self.assertRaises(
+                Section.MultipleObjectsReturned,
+                lookups.get,
+                Section,
+                name='1',
+            )
+        lookups.clear()
+        with self.assertNumQueries(1):
+            lookups.get(Section, name='2')
+
+    def test_preload_normalized(self):
+        """Values of preloaded tables and of lookups are converted to the
+        type of their field"""
+        article = Article.objects.create(title='a')
+        link = ArticleToSection.objects.create(
+            article=article,
+            section=self.sections[1],
+            weight=1,
+        )
+        lookups = LookupCache(size=0)
+        with self.assertNumQueries(2):
+            lookups.preload(Section, 'id')
+            lookups.preload(ArticleToSection, 'section')
+            section = self.sections[2]
+            self.assertEqual(section, lookups.get(Section, id=str(section.pk)))
+            self.assertEqual(section, lookups.get(Section, id=long(section.pk)))
+            self.assertEqual(
+                link,
+                lookups.get(ArticleToSection, section=self.sections[1])
+            )
+            self.assertEqual(
+                link,
+                lookups.get(ArticleToSection, section=str(self.sections[1].pk))
+            )
+
+
 class BuilderSetM2MFieldTests(TestCase):
 
     def test_populate_through_method(self):
@@ -198,6 +468,70 @@ class BuilderSetM2MFieldTests(TestCase):
         self.assertEqual(0, instance.m2m.count())
 
 
+    def test_sync_m2m(self):
+        """Only the difference between the current and the wanted related
+        objects is written"""
+
+        class Populator(BasePopulator):
+
+            _clear_m2m = False
+
+            def m2m(self):
+                self._sync_m2m('m2m', self._mapper)
+
+        builder = BaseBuilder(None, None)
+        instance = ModelForBuilderTests(simple_field=1)
+        instance.save()
+        related = [RelatedM2M.objects.create() for i in range(3)]
+        instance.m2m.add(related[0], related[1])
+
+        populator = Populator([related[1], related[2].pk], instance, None, builder)
+        builder.set_m2m_field(populator, instance, 'm2m')
+        self.assertEqual(
+            [related[1].pk, related[2].pk],
+            sorted(instance.m2m.values_list('pk', flat=True))
+        )
+
+        # nothing changed: only the current rows are fetched
+        with self.assertNumQueries(1):
+            builder.set_m2m_field(populator, instance, 'm2m')
+
+    def test_sync_m2m_through_defaults(self):
+        """Rows of a through model are inserted with ``defaults`` and the
+        rows that are kept are updated"""
+        builder = BaseBuilder(None, None)
+        article = Article.objects.create(title='title', kind='', author='')
+        sections = [Section.objects.create(name=str(i)) for i in range(3)]
+        ArticleToSection.objects.create(
+            article=article,
+            section=sections[0],
+            weight=1,
+        )
+
+        added, removed = builder.sync_m2m_field(
+            article,
+            'sections',
+            sections[1:] + sections[:1],
+            {'weight': 2},
+        )
+        self.assertEqual(set([sections[1].pk, sections[2].pk]), added)
+        self.assertEqual(set(), removed)
+        self.assertEqual(
+            [2, 2, 2],
+            [r.weight for r in ArticleToSection.objects.filter(article=article)]
+        )
+
+        added, removed = builder.sync_m2m_field(
+            article,
+            'sections',
+            [sections[2]],
+            {'weight': 2},
+        )
+        self.assertEqual(set(), added)
+        self.assertEqual(set([sections[0].pk, sections[1].pk]), removed)
+        self.assertEqual([sections[2]], list(article.sections.all()))
+
+
 class BuilderProcessAndSaveTests(TransactionTestCase):
 
     def test_full_builder(self):
@@ -251,6 +585,539 @@ class BuilderProcessAndSaveTests(TransactionTestCase):
         self.assertFalse(unhandled_errors)
         self.assertEqual(7, len(instances))
 
+    def test_iter_process(self):
+        """Check that iter_process yields instances one by one"""
+
+        class Builder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+
+            class Mapper(BaseMapper):
+
+                @classmethod
+                def _iter_mappers(cls, builder):
+                    for i in [1, 2, 3]:
+                        yield cls(i)
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self._content}
+
+            class Populator(BasePopulator):
+
+                _fields_one_to_one = ()
+                _fields_if_instance_already_exists = []
+                _fields_if_instance_modified_from_last_import = []
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+        builder = Builder(None, None)
+        instances = builder.iter_process()
+        instance = instances.next()
+        self.assertEqual(1, instance.simple_field)
+        # following mappers are not processed yet
+        self.assertEqual(1, ModelForBuilderTests.objects.count())
+        self.assertEqual([2, 3], [i.simple_field for i in instances])
+        self.assertFalse(builder.unhandled_errors)
+
+    def test_batch_size(self):
+        """A builder with ``BATCH_SIZE`` gives the same result as a builder
+        without it"""
+
+        class Builder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+
+            class Mapper(BaseMapper):
+
+                @classmethod
+                def _iter_mappers(cls, builder):
+                    for i in [1, 2, 3, 3, 4, 5, 1]:
+                        yield cls(i)
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self._content}
+
+                @property
+                def second_field(self):
+                    return self._content * 10
+
+            class Populator(BasePopulator):
+
+                _fields_one_to_one = ('second_field',)
+                _fields_if_instance_already_exists = None
+                _fields_if_instance_modified_from_last_import = None
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+        ModelForBuilderTests(simple_field=2).save()
+        ModelForBuilderTests(simple_field=4).save()
+
+        class BatchBuilder(Builder):
+            BATCH_SIZE = 3
+
+        builder = BatchBuilder(None, None)
+        instances, unhandled_errors = builder.process_and_save()
+
+        self.assertFalse(unhandled_errors)
+        self.assertEqual(7, len(instances))
+        self.assertEqual(5, ModelForBuilderTests.objects.count())
+        for instance in ModelForBuilderTests.objects.all():
+            self.assertEqual(instance.simple_field * 10, instance.second_field)
+
+    def test_bulk_create(self):
+        """New instances are inserted by batches when the populator
+        ``_bulk_create`` flag is set"""
+
+        class Builder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+            BULK_CREATE_BATCH_SIZE = 3
+
+            class Mapper(BaseMapper):
+
+                @classmethod
+                def _iter_mappers(cls, builder):
+                    for i in [1, 2, 3, 2, 4, 5, 6, 7]:
+                        yield cls(i)
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self._content}
+
+                @property
+                def second_field(self):
+                    return self._content * 10
+
+            class Populator(BasePopulator):
+
+                _bulk_create = True
+                _fields_one_to_one = ('second_field',)
+                _fields_if_instance_already_exists = None
+                _fields_if_instance_modified_from_last_import = None
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+            def bulk_create(self, instances):
+                self.batches.append([i.simple_field for i in instances])
+                # like bulk_create from Django 1.4, primary keys are not set
+                for instance in instances:
+                    ModelForBuilderTests.objects.create(
+                        simple_field=instance.simple_field,
+                        second_field=instance.second_field,
+                    )
+
+        ModelForBuilderTests(simple_field=1).save()
+
+        builder = Builder(None, None)
+        builder.batches = []
+        instances, unhandled_errors = builder.process_and_save()
+
+        self.assertFalse(unhandled_errors)
+        # the second mapper with ``2`` flushes the pending instances
+        self.assertEqual([[2, 3], [4, 5, 6], [7]], builder.batches)
+        self.assertEqual(8, len(instances))
+        # primary keys of inserted instances are fetched back
+        for instance in instances:
+            self.assertEqual(
+                instance.simple_field,
+                ModelForBuilderTests.objects.get(pk=instance.pk).simple_field
+            )
+        self.assertEqual(7, ModelForBuilderTests.objects.count())
+        for instance in ModelForBuilderTests.objects.all():
+            self.assertEqual(instance.simple_field * 10, instance.second_field)
+
+    def test_bulk_create_with_relations(self):
+        """Instances with m2m to populate are saved one by one"""
+
+        class Builder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+
+            class Mapper(BaseMapper):
+
+                @classmethod
+                def _iter_mappers(cls, builder):
+                    for i in [1, 2]:
+                        yield cls(i)
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self._content}
+
+            class Populator(BasePopulator):
+
+                _bulk_create = True
+                _fields_one_to_one = ()
+                _fields_if_instance_already_exists = None
+                _fields_if_instance_modified_from_last_import = None
+
+                def m2m(self):
+                    related = RelatedM2M()
+                    related.save()
+                    self._instance.m2m.add(related)
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+            def bulk_create(self, instances):
+                raise AssertionError('bulk_create should not be called')
+
+        builder = Builder(None, None)
+        instances, unhandled_errors = builder.process_and_save()
+
+        self.assertFalse(unhandled_errors)
+        self.assertEqual(2, len(instances))
+        self.assertEqual(2, RelatedM2M.objects.count())
+
+    def _track_changes_builder(self, values, **attributes):
+
+        class Builder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+            TRACK_CHANGES = True
+
+            class Mapper(BaseMapper):
+
+                @classmethod
+                def _iter_mappers(cls, builder):
+                    for value in values:
+                        yield cls(value)
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self._content[0]}
+
+                @property
+                def second_field(self):
+                    if self._content[1] is None:
+                        raise ValueError(self._content)
+                    return self._content[1]
+
+            class Populator(BasePopulator):
+
+                _fields_one_to_one = ('second_field',)
+                _fields_if_instance_already_exists = None
+                _fields_if_instance_modified_from_last_import = None
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+        for name, value in attributes.items():
+            setattr(Builder, name, value)
+        return Builder(None, None)
+
+    def test_track_changes(self):
+        """Unchanged instances are not saved again"""
+        saved = []
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance.simple_field)
+        post_save.connect(on_save, sender=ModelForBuilderTests)
+        try:
+            values = [(1, 10), (2, 20), (3, 30)]
+            builder = self._track_changes_builder(values)
+            builder.process_and_save()
+            self.assertEqual([1, 2, 3], saved)
+            self.assertEqual(0, builder.saves_skipped)
+
+            # ``'20'`` is converted by the field so it is not a change
+            values = [(1, 10), (2, '20'), (3, 31)]
+            builder = self._track_changes_builder(values)
+            instances, unhandled_errors = builder.process_and_save()
+            self.assertEqual(3, len(instances))
+            self.assertEqual([1, 2, 3, 3], saved)
+            self.assertEqual(2, builder.saves_skipped)
+            self.assertEqual(
+                31,
+                ModelForBuilderTests.objects.get(simple_field=3).second_field
+            )
+        finally:
+            post_save.disconnect(on_save, sender=ModelForBuilderTests)
+
+    def test_track_changes_update_with_queryset(self):
+        """Changes are saved with ``QuerySet.update``"""
+        values = [(1, 10)]
+        builder = self._track_changes_builder(values)
+        builder.process_and_save()
+
+        saved = []
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance.simple_field)
+        post_save.connect(on_save, sender=ModelForBuilderTests)
+        try:
+            values = [(1, 11)]
+            builder = self._track_changes_builder(
+                values,
+                UPDATE_WITH_QUERYSET=True
+            )
+            builder.process_and_save()
+            self.assertEqual([], saved)
+            self.assertEqual(
+                11,
+                ModelForBuilderTests.objects.get(simple_field=1).second_field
+            )
+        finally:
+            post_save.disconnect(on_save, sender=ModelForBuilderTests)
+
+    def _fingerprints_builder(self, values, config=None, **attributes):
+
+        class Builder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+            FINGERPRINTS = True
+
+            class Mapper(BaseMapper):
+
+                @classmethod
+                def _iter_mappers(cls, builder):
+                    for value in values:
+                        yield cls(value)
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self._content[0]}
+
+                @property
+                def _fingerprint(self):
+                    return str(self._content)
+
+                @property
+                def second_field(self):
+                    if self._content[1] is None:
+                        raise ValueError(self._content)
+                    return self._content[1]
+
+            class Populator(BasePopulator):
+
+                _fields_one_to_one = ('second_field',)
+                _fields_if_instance_already_exists = None
+                _fields_if_instance_modified_from_last_import = None
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+        for name, value in attributes.items():
+            setattr(Builder, name, value)
+        return Builder(None, config)
+
+    def test_fingerprints(self):
+        """Mappers whose content did not change are not processed"""
+        values = [(1, 10), (2, 20)]
+        builder = self._fingerprints_builder(values)
+        instances, unhandled_errors = builder.process_and_save()
+        self.assertEqual(2, len(instances))
+        self.assertEqual(0, builder.mappers_unchanged)
+        self.assertEqual(2, MapperFingerprint.objects.count())
+
+        for second, attributes in ((21, {}), (22, {'BATCH_SIZE': 10})):
+            values = [(1, 10), (2, second)]
+            builder = self._fingerprints_builder(values, **attributes)
+            instances, unhandled_errors = builder.process_and_save()
+            self.assertEqual(1, builder.mappers_unchanged)
+            # the instance of the unchanged mapper is returned too
+            self.assertEqual([1, 2], [i.simple_field for i in instances])
+            self.assertTrue(all(i.pk for i in instances))
+            self.assertEqual(
+                second,
+                ModelForBuilderTests.objects.get(simple_field=2).second_field
+            )
+
+        # force reprocessing
+        class Config(object):
+            force = True
+        builder = self._fingerprints_builder(values, Config())
+        instances, unhandled_errors = builder.process_and_save()
+        self.assertEqual(0, builder.mappers_unchanged)
+        self.assertEqual(2, len(instances))
+
+    def test_fingerprints_deleted_instance(self):
+        """An unchanged mapper is processed again if its instance was
+        deleted"""
+        values = [(1, 10), (2, 20)]
+        builder = self._fingerprints_builder(values)
+        builder.process_and_save()
+        for attributes in ({}, {'BATCH_SIZE': 10}):
+            ModelForBuilderTests.objects.filter(simple_field=1).delete()
+            builder = self._fingerprints_builder(values, **attributes)
+            instances, unhandled_errors = builder.process_and_save()
+            self.assertEqual(1, builder.mappers_unchanged)
+            self.assertEqual(2, ModelForBuilderTests.objects.count())
+
+    def test_fingerprint_keys(self):
+        """Fingerprint keys depend on the builder and on normalized
+        values of the filters"""
+        builder = self._fingerprints_builder([])
+        self.assertEqual(
+            builder._fingerprint_key({'simple_field': 1}),
+            builder._fingerprint_key({'simple_field': u'1'}),
+        )
+        other = self._fingerprints_builder([], Populator=type(
+            'OtherPopulator',
+            (builder.Populator,),
+            {},
+        ))
+        self.assertNotEqual(
+            builder._fingerprint_key({'simple_field': 1}),
+            other._fingerprint_key({'simple_field': 1}),
+        )
+
+    def test_commit_every(self):
+        """Mappers are processed in a transaction committed by chunks and
+        a failing mapper is rolled back to its savepoint"""
+        commit = transaction.commit
+        savepoint = transaction.savepoint
+        savepoint_commit = transaction.savepoint_commit
+        savepoint_rollback = transaction.savepoint_rollback
+        commits = []
+        savepoints = []
+        rollbacks = []
+
+        def count_commits(*args, **kwargs):
+            commits.append(ModelForBuilderTests.objects.count())
+            return commit(*args, **kwargs)
+
+        def count_savepoints(*args, **kwargs):
+            # the database of the tests may not support savepoints
+            savepoints.append('s%s' % len(savepoints))
+            return savepoints[-1]
+
+        # the second field of the third mapper can not be computed
+        values = [(1, 10), (2, 20), (3, None), (4, 40), (5, 50)]
+        builder = self._fingerprints_builder(
+            values,
+            FINGERPRINTS=False,
+            COMMIT_EVERY=2,
+        )
+        uses_savepoints = connection.features.uses_savepoints
+        connection.features.uses_savepoints = True
+        transaction.commit = count_commits
+        transaction.savepoint = count_savepoints
+        transaction.savepoint_commit = lambda sid, *args, **kwargs: None
+        transaction.savepoint_rollback = lambda sid, *args, **kwargs: (
+            rollbacks.append(sid)
+        )
+        try:
+            instances, unhandled_errors = builder.process_and_save()
+        finally:
+            connection.features.uses_savepoints = uses_savepoints
+            transaction.commit = commit
+            transaction.savepoint = savepoint
+            transaction.savepoint_commit = savepoint_commit
+            transaction.savepoint_rollback = savepoint_rollback
+        self.assertTrue(unhandled_errors)
+        self.assertEqual([1, 2, 4, 5], [i.simple_field for i in instances])
+        # every two mappers, then at the end
+        self.assertEqual([2, 3, 4], commits)
+        self.assertEqual(['s2'], rollbacks)
+        self.assertFalse(transaction.is_managed())
+
+    def test_commit_every_without_savepoints(self):
+        """Without savepoints, the transaction is committed before each
+        mapper so that the writes of a failing mapper are rolled back"""
+        def failing_field(mapper):
+            if mapper._content[1] is None:
+                # the mapper fails halfway
+                Section(name='partial').save()
+                raise ValueError(mapper._content)
+            return mapper._content[1]
+
+        values = [(1, 10), (2, 20), (3, None), (4, 40), (5, 50)]
+        builder = self._fingerprints_builder(
+            values,
+            FINGERPRINTS=False,
+            COMMIT_EVERY=2,
+        )
+        builder.Mapper.second_field = property(failing_field)
+        uses_savepoints = connection.features.uses_savepoints
+        connection.features.uses_savepoints = False
+        try:
+            instances, unhandled_errors = builder.process_and_save()
+        finally:
+            connection.features.uses_savepoints = uses_savepoints
+        self.assertTrue(unhandled_errors)
+        self.assertEqual([1, 2, 4, 5], [i.simple_field for i in instances])
+        self.assertEqual(
+            [1, 2, 4, 5],
+            sorted(ModelForBuilderTests.objects.values_list(
+                'simple_field',
+                flat=True,
+            ))
+        )
+        self.assertFalse(Section.objects.filter(name='partial').exists())
+        self.assertFalse(transaction.is_managed())
+
+    def test_commit_every_managed(self):
+        """Nested builders do not handle the transaction"""
+        commit = transaction.commit
+        commits = []
+        transaction.commit = lambda *args, **kwargs: commits.append(args)
+        try:
+            builder = self._fingerprints_builder(
+                [(1, 10), (2, 20)],
+                FINGERPRINTS=False,
+                COMMIT_EVERY=1,
+            )
+            builder.managed = True
+            builder.process_and_save()
+        finally:
+            transaction.commit = commit
+        self.assertEqual([], commits)
+
+    def test_no_savepoints_without_chunks(self):
+        """Without COMMIT_EVERY nor COMMIT_INTERVAL, a DatabaseError closes
+        the connection, even in a managed transaction"""
+        is_managed = transaction.is_managed
+        savepoint = transaction.savepoint
+        close_connection = builder_module.close_connection
+        savepoints = []
+        closes = []
+
+        def failing_field(mapper):
+            if mapper._content[1] is None:
+                raise DatabaseError(mapper._content)
+            return mapper._content[1]
+
+        builder = self._fingerprints_builder(
+            [(1, 10), (2, None)],
+            FINGERPRINTS=False,
+        )
+        builder.Mapper.second_field = property(failing_field)
+        transaction.is_managed = lambda *args, **kwargs: True
+        transaction.savepoint = lambda *args, **kwargs: savepoints.append(args)
+        builder_module.close_connection = lambda: closes.append(True)
+        try:
+            instances, unhandled_errors = builder.process_and_save()
+        finally:
+            transaction.is_managed = is_managed
+            transaction.savepoint = savepoint
+            builder_module.close_connection = close_connection
+        self.assertTrue(unhandled_errors)
+        self.assertEqual([1], [i.simple_field for i in instances])
+        self.assertEqual([], savepoints)
+        self.assertEqual([True], closes)
+
     def test_skip_builder(self):
         """Tests that it skip for every mapper but one"""
 
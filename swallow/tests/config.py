@@ -1,19 +1,36 @@
 import os
+import sys
+import bz2
+import time
+import errno
+import gzip
 import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.db import transaction, IntegrityError
+from django.core.management import call_command
 
 try:
     from django.test.utils import override_settings
 except ImportError:
     from override_settings import override_settings
 
-from . import Article
+from . import Article, Section, ModelForBuilderTests
 from integration import ArticleConfig
 from base import BaseSwallowTests
 
+from swallow import config as config_module
 from swallow.config import BaseConfig
-from swallow.mappers import XmlMapper
+from swallow.management.commands import swallow_run
+from swallow.mappers import XmlMapper, BaseMapper
 from swallow.populator import BasePopulator
 from swallow.builder import BaseBuilder
+from swallow.models import ImportedFile, SwallowConfiguration
+from swallow.util import ScanPlan, ScanEntry, scan_directory
+from swallow.util import decompressed, logical_name, DecompressedFile
+from swallow.util import FileTransitions, Segment, split_segment, ZIP_EPOCH
+from swallow.util import parse_shard, makedirs
 
 
 CURRENT_PATH = os.path.dirname(__file__)
@@ -143,3 +160,1140 @@ class PostProcessTest(BaseSwallowTests):
             self.assertEqual(3, len(config.__flag__))
             for x in config.__flag__:
                 self.assertTrue(x)
+
+
+class LookupRunTest(BaseSwallowTests):
+    """Check that looked up instances are shared by the builders of a
+    run and forgotten at the end of the run"""
+
+    class PostProcessConfig(BaseConfig):
+
+        def load_builder(self, spam):
+
+            class LookupBuilder(BaseBuilder):
+
+                def process_and_save(self):
+                    return [self.lookup(Section, name='section')], False
+
+            return LookupBuilder(spam, self)
+
+        def postprocess(self, instances):
+            self.__flag__ = instances
+
+    def test_lookups(self):
+        Section.objects.create(name='section')
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.PostProcessConfig()
+            with self.assertNumQueries(1):
+                config.run()
+            self.assertEqual(3, len(config.__flag__))
+            self.assertEqual(0, len(config.lookups))
+
+
+class CompressedInputTest(BaseSwallowTests):
+    """Check that compressed files are processed with their name without
+    compression suffix and stay compressed"""
+
+    class CompressedConfig(BaseConfig):
+
+        def load_builder(self, partial_file_path):
+            config = self
+
+            class Builder(object):
+
+                def __init__(self):
+                    self.lines = list(config.open(partial_file_path))
+
+                def process_and_save(self):
+                    return [(partial_file_path, self.lines)], False
+
+            return Builder()
+
+        def postprocess(self, instances):
+            self.__flag__ = instances
+
+    def test_compressed(self):
+        content = ''.join('line %s\n' % i for i in range(1000))
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.CompressedConfig()
+            input_dir = config.input_dir()
+            os.makedirs(input_dir)
+            f = gzip.open(os.path.join(input_dir, 'a.txt.gz'), 'wb')
+            # concatenated streams
+            f.write(content[:100])
+            f.close()
+            f = gzip.open(os.path.join(input_dir, 'b.txt.gz'), 'wb')
+            f.write(content)
+            f.close()
+            with open(os.path.join(input_dir, 'a.txt.gz'), 'ab') as f:
+                f.write(open(os.path.join(input_dir, 'b.txt.gz'), 'rb').read())
+            f = bz2.BZ2File(os.path.join(input_dir, 'c.txt.bz2'), 'wb')
+            f.write(content)
+            f.close()
+            with open(os.path.join(input_dir, 'd.txt'), 'wb') as f:
+                f.write(content)
+
+            config.run()
+
+            results = dict(
+                (name, ''.join(lines)) for [(name, lines)] in config.__flag__
+            )
+            self.assertEqual(
+                ['a.txt', 'b.txt', 'c.txt', 'd.txt'],
+                sorted(results)
+            )
+            self.assertEqual(content[:100] + content, results['a.txt'])
+            for name in ('b.txt', 'c.txt', 'd.txt'):
+                self.assertEqual(content, results[name])
+            self.assertEqual(
+                ['a.txt.gz', 'b.txt.gz', 'c.txt.bz2', 'd.txt'],
+                sorted(os.listdir(config.done_dir()))
+            )
+
+    def test_open_logical_name(self):
+        """Secondary files can be opened without compression suffix"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.CompressedConfig()
+            input_dir = config.input_dir()
+            os.makedirs(input_dir)
+            f = gzip.open(os.path.join(input_dir, 'e.txt.gz'), 'wb')
+            f.write('spam\neggs')
+            f.close()
+            config.prepare_paths('')
+            f = config.open('e.txt')
+            self.assertEqual('spam\n', f.readline())
+            self.assertEqual('eggs', f.read())
+            f.close()
+            self.assertEqual(['e.txt.gz'], config.files)
+
+
+class DecompressedFileTests(TestCase):
+
+    def test_small_chunks(self):
+        content = ''.join('line %s\n' % i for i in range(100))
+        stream = bz2.compress(content[:50]) + bz2.compress(content[50:])
+        f = decompressed(StringIO(stream))
+        self.assertTrue(isinstance(f, DecompressedFile))
+        f.CHUNK_SIZE = 7
+        self.assertEqual('line 0\n', f.readline())
+        self.assertEqual('line', f.read(4))
+        self.assertEqual(content[11:], ''.join(f))
+        self.assertEqual('', f.read())
+
+    def test_not_compressed(self):
+        f = StringIO('spam')
+        self.assertTrue(decompressed(f) is f)
+        self.assertEqual('spam', f.read())
+        f = StringIO('BZh, the start of a plain file')
+        self.assertTrue(decompressed(f) is f)
+        self.assertEqual('BZh, the start of a plain file', f.read())
+        self.assertEqual('spam', logical_name('spam'))
+        self.assertEqual('spam.xml', logical_name('spam.xml.xz'))
+
+
+class CrossDeviceTransitions(FileTransitions):
+    """Behaves as if ``input`` and ``done`` were on different devices"""
+
+    def _rename(self, src, dst):
+        if src.split(os.sep)[-2] != dst.split(os.sep)[-2]:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        os.rename(src, dst)
+
+
+class FileTransitionsTests(BaseSwallowTests):
+
+    def _write(self, path, content):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+
+    def _read(self, path):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_move(self):
+        src = os.path.join(self.import_dir, 'input', 'a.xml')
+        done = os.path.join(self.import_dir, 'done')
+        journal = os.path.join(self.import_dir, 'journal')
+        for policy in ('none', 'file', 'batch'):
+            transitions = CrossDeviceTransitions(journal, policy, 1)
+            transitions.BLOCK_SIZE = 3
+            self._write(src, 'spam and eggs')
+            dst = transitions.move(src, os.path.join(done, 'a.xml'))
+            self.assertFalse(os.path.exists(src))
+            self.assertEqual('spam and eggs', self._read(dst))
+            self.assertEqual(['a.xml'], os.listdir(done))
+            self.assertEqual(2, len(self._read(journal).splitlines()))
+            self.assertEqual([(src, dst)], transitions.recover())
+            self.assertEqual('', self._read(journal))
+            os.remove(dst)
+            transitions.close()
+
+    def test_concurrent_makedirs(self):
+        """the destination directory is created by another worker
+        between the move and its own makedirs"""
+        src = os.path.join(self.import_dir, 'input', 'a.xml')
+        done = os.path.join(self.import_dir, 'done', 'sub')
+        self._write(src, 'spam')
+        real_makedirs = os.makedirs
+
+        def racing_makedirs(path, *args):
+            real_makedirs(path, *args)
+            real_makedirs(path, *args)
+
+        os.makedirs = racing_makedirs
+        try:
+            dst = FileTransitions().move(src, os.path.join(done, 'a.xml'))
+        finally:
+            os.makedirs = real_makedirs
+        self.assertEqual('spam', self._read(dst))
+
+    def test_existing_destination(self):
+        done = os.path.join(self.import_dir, 'done')
+        os.makedirs(done)
+        transitions = FileTransitions()
+        for content in ('spam', 'spam', 'eggs', 'bacon'):
+            src = os.path.join(self.import_dir, 'input', 'a.xml')
+            self._write(src, content)
+            # into an existing directory
+            transitions.move(src, done)
+            self.assertFalse(os.path.exists(src))
+        self.assertEqual(['a.xml', 'a.xml.1', 'a.xml.2'], sorted(os.listdir(done)))
+        self.assertEqual('bacon', self._read(os.path.join(done, 'a.xml')))
+        self.assertEqual('spam', self._read(os.path.join(done, 'a.xml.1')))
+        self.assertEqual('eggs', self._read(os.path.join(done, 'a.xml.2')))
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, FileTransitions, None, 'always')
+
+
+class RecoverTest(BaseSwallowTests):
+    """Check that files left in work dir by a crash are processed by the
+    next run"""
+
+    class RecoverConfig(BaseConfig):
+
+        def load_builder(self, partial_file_path):
+            config = self
+
+            class Builder(object):
+
+                def __init__(self):
+                    config.open(partial_file_path).close()
+
+                def process_and_save(self):
+                    if config.crash:
+                        raise KeyboardInterrupt()
+                    config.processed.append(partial_file_path)
+                    return [], False
+
+            return Builder()
+
+    def test_recover(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.RecoverConfig()
+            config.processed = []
+            config.crash = True
+            os.makedirs(os.path.join(config.input_dir(), 'sub'))
+            for name in ('a.xml', os.path.join('sub', 'b.xml')):
+                f = open(os.path.join(config.input_dir(), name), 'w')
+                f.write(name)
+                f.close()
+            self.assertRaises(KeyboardInterrupt, config.run)
+            self.assertEqual(1, len(os.listdir(config.work_dir())))
+
+            # a move interrupted between its record and the rename
+            transitions = config.transitions
+            input_path = os.path.join(config.input_dir(), 'sub', 'b.xml')
+            work_path = os.path.join(config.work_dir(), 'sub', 'b.xml')
+            transitions._begin(input_path, work_path)
+            transitions.close()
+
+            config = self.RecoverConfig()
+            config.processed = []
+            config.crash = False
+            config.run()
+            self.assertEqual(
+                ['a.xml', os.path.join('sub', 'b.xml')],
+                sorted(config.processed)
+            )
+            self.assertEqual(['sub'], os.listdir(config.work_dir()))
+            self.assertEqual([], os.listdir(os.path.dirname(work_path)))
+            self.assertEqual('', open(config.journal_file()).read())
+
+
+class PartitionConfig(BaseConfig):
+
+    PARTITION = '%Y/%m/%d/%H'
+
+    def load_builder(self, partial_file_path):
+        config = self
+
+        class Builder(object):
+
+            def __init__(self):
+                config.open(partial_file_path).close()
+
+            def process_and_save(self):
+                return [], partial_file_path.endswith('.err')
+
+        return Builder()
+
+
+class PartitionTest(BaseSwallowTests):
+    """Check that files are moved below partitions of done and error dirs
+    and that old partitions are cleaned as a whole"""
+
+    def _touch(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        open(path, 'w').close()
+
+    def test_partition(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = PartitionConfig()
+            for name in ('a.xml', 'sub/b.xml', 'c.err'):
+                self._touch(os.path.join(config.input_dir(), name))
+            partition = config.partition()
+            config.run()
+            done = os.path.join(config.done_dir(), partition)
+            error = os.path.join(config.error_dir(), partition)
+            self.assertEqual(['a.xml', 'sub'], sorted(os.listdir(done)))
+            self.assertEqual(['b.xml'], os.listdir(os.path.join(done, 'sub')))
+            self.assertEqual(['c.err'], os.listdir(error))
+            self.assertEqual(
+                (partition, 'sub/b.xml'),
+                config.split_partition(partition + '/sub/b.xml')
+            )
+            self.assertEqual(('', 'sub/b.xml'), config.split_partition('sub/b.xml'))
+
+    def test_archived_count(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = PartitionConfig()
+            os.makedirs(config.input_dir())
+            config.run()
+            # root dirs exist even without files to move
+            self.assertTrue(os.path.isdir(config.done_dir()))
+            self.assertTrue(os.path.isdir(config.error_dir()))
+            for name in ('a.xml', 'sub/b.xml', 'c.err'):
+                self._touch(os.path.join(config.input_dir(), name))
+            PartitionConfig().run()
+            self._touch(os.path.join(config.done_dir(), 'd.xml'))
+            configuration = SwallowConfiguration(PartitionConfig)
+            self.assertEqual(3, configuration.done_count)
+            self.assertEqual(1, configuration.error_count)
+
+    def test_clean(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            done_dir = PartitionConfig.done_dir()
+            now = time.time()
+            old = PartitionConfig.partition(now - 3 * 3600)
+            older = PartitionConfig.partition(now - 30 * 24 * 3600)
+            recent = PartitionConfig.partition(now)
+            for partition in (old, older, recent):
+                self._touch(os.path.join(done_dir, partition, 'sub', 'a.xml'))
+            # not partitioned, too recent
+            self._touch(os.path.join(done_dir, 'b.xml'))
+            self.assertEqual(
+                [os.path.join(done_dir, older), os.path.join(done_dir, old)],
+                PartitionConfig.partitions(done_dir, now - 3600)
+            )
+            call_command(
+                'swallow_clean',
+                'swallow.tests.config.PartitionConfig',
+                dirs='done',
+                age='3600',
+                verbosity=0,
+            )
+            self.assertEqual(
+                [os.path.join(done_dir, recent)],
+                PartitionConfig.partitions(done_dir)
+            )
+            self.assertTrue(os.path.exists(os.path.join(done_dir, 'b.xml')))
+            # emptied parents of old partitions are removed
+            self.assertEqual(
+                sorted(['b.xml', recent[:4]]),
+                sorted(os.listdir(done_dir))
+            )
+
+
+class PackConfig(PartitionConfig):
+
+    PACK = True
+
+
+class PackTest(BaseSwallowTests):
+    """Check that closed partitions are packed into segments from which
+    files are read and restored one by one"""
+
+    def _write(self, path, content):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+
+    def test_pack(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = PackConfig()
+            done_dir = config.done_dir()
+            old = config.partition(time.time() - 2 * 3600)
+            self._write(os.path.join(done_dir, old, 'a.xml'), 'spam')
+            self._write(os.path.join(done_dir, old, 'sub', 'b.xml'), 'eggs')
+            self._write(os.path.join(config.input_dir(), 'c.xml'), 'bacon')
+            config.run()
+
+            # the current partition stays open
+            self.assertEqual(
+                [os.path.join(done_dir, config.partition())],
+                config.partitions(done_dir)
+            )
+            path = os.path.join(done_dir, old + '.zip')
+            self.assertEqual([path], config.segments(done_dir))
+            self.assertEqual(
+                (config.partition(time.time() - 2 * 3600), 'sub/b.xml'),
+                config.split_partition(old + '.zip/sub/b.xml')
+            )
+            self.assertEqual(
+                (path, 'sub/b.xml'),
+                split_segment(os.path.join(path, 'sub', 'b.xml'))
+            )
+            segment = Segment(path)
+            self.assertEqual(
+                ['a.xml', 'sub/b.xml'],
+                [member.filename for member in segment.members()]
+            )
+            self.assertEqual('eggs', segment.open('sub/b.xml').read())
+            segment.close()
+            # files of the segment and of the current partition
+            self.assertEqual(3, config.archived_count(done_dir))
+
+            # files packed again are skipped, others are renamed
+            self._write(os.path.join(done_dir, old, 'a.xml'), 'spam')
+            self._write(os.path.join(done_dir, old, 'sub', 'b.xml'), 'ham')
+            self.assertEqual(2, config.pack(done_dir))
+            self.assertFalse(os.path.exists(os.path.join(done_dir, old)))
+            self.assertEqual(
+                ['a.xml', 'sub/b.xml', 'sub/b.xml.1'],
+                [member.filename for member in segment.members()]
+            )
+
+            target = os.path.join(config.input_dir(), 'sub', 'b.xml')
+            segment.extract('sub/b.xml', target)
+            self.assertEqual('eggs', open(target).read())
+            segment.remove(['sub/b.xml', 'sub/b.xml.1'])
+            self.assertEqual(
+                ['a.xml'],
+                [member.filename for member in segment.members()]
+            )
+            segment.remove(['a.xml'])
+            self.assertFalse(os.path.exists(path))
+
+    def test_pack_old_files(self):
+        """Files older than zip timestamps are packed with the oldest one"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = PackConfig()
+            config.prepare_paths('')
+            done_dir = config.done_dir()
+            old = config.partition(time.time() - 2 * 3600)
+            for name, content in (('a.xml', 'spam'), ('b.xml', 'eggs' * 1000)):
+                path = os.path.join(done_dir, old, name)
+                self._write(path, content)
+                os.utime(path, (0, 0))
+            self.assertEqual(2, config.pack(done_dir))
+            segment = Segment(os.path.join(done_dir, old + '.zip'))
+            self.assertEqual(
+                [ZIP_EPOCH, ZIP_EPOCH],
+                [member.date_time for member in segment.members()]
+            )
+            # kept members are copied when the segment is rewritten
+            segment.remove(['a.xml'])
+            self.assertEqual(['b.xml'], [m.filename for m in segment.members()])
+            self.assertEqual('eggs' * 1000, segment.open('b.xml').read())
+            segment.close()
+
+    def test_pack_concurrent_move(self):
+        """A file moved in a partition while it is packed stays there"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = PackConfig()
+            config.prepare_paths('')
+            done_dir = config.done_dir()
+            old = config.partition(time.time() - 2 * 3600)
+            self._write(os.path.join(done_dir, old, 'a.xml'), 'spam')
+            late = os.path.join(done_dir, old, 'sub', 'b.xml')
+            add = Segment.add
+
+            def add_then_move(segment, directory, fsync=False):
+                paths = add(segment, directory, fsync)
+                self._write(late, 'eggs')
+                return paths
+
+            Segment.add = add_then_move
+            try:
+                self.assertEqual(1, config.pack(done_dir))
+            finally:
+                Segment.add = add
+            self.assertTrue(os.path.exists(late))
+            self.assertFalse(
+                os.path.exists(os.path.join(done_dir, old, 'a.xml'))
+            )
+            self.assertEqual(1, config.pack(done_dir))
+            self.assertFalse(os.path.exists(os.path.join(done_dir, old)))
+            self.assertEqual(
+                ['a.xml', 'sub/b.xml'],
+                [member.filename for member in
+                 Segment(os.path.join(done_dir, old + '.zip')).members()]
+            )
+
+
+class ClaimConfig(BaseConfig):
+
+    CLAIM = True
+
+    def load_builder(self, partial_file_path):
+        config = self
+
+        class Builder(object):
+
+            def __init__(self):
+                config.open(partial_file_path).close()
+
+            def process_and_save(self):
+                config.processed.append(partial_file_path)
+                return [], False
+
+        return Builder()
+
+
+class ClaimTest(BaseSwallowTests):
+    """Check that workers sharing input dir claim each file once and that
+    files of workers whose lease expired are reclaimed"""
+
+    def _write(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        open(path, 'w').close()
+
+    def _config(self, worker_id):
+        config = ClaimConfig(worker_id=worker_id)
+        config.processed = []
+        return config
+
+    def test_claim(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            first = self._config('first')
+            second = self._config('second')
+            self._write(os.path.join(first.input_dir(), 'a.xml'))
+            self.assertTrue(first.claim('a.xml'))
+            self.assertFalse(second.claim('a.xml'))
+            self.assertEqual(['a.xml'], first.files)
+            self.assertEqual([], second.files)
+            self.assertTrue(os.path.exists(
+                os.path.join(first.work_dir(), 'first', 'a.xml')
+            ))
+            # the builder of the other worker skips the file
+            self.assertEqual((None, None, False), second.process_file('a.xml'))
+
+    def test_reclaim(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config('alive')
+            work_dir = config.work_dir()
+            self._write(os.path.join(config.input_dir(), 'a.xml'))
+            # a worker which stopped long ago
+            self._write(os.path.join(work_dir, 'dead', 'sub', 'b.xml'))
+            self._write(os.path.join(work_dir, 'dead.lease'))
+            old = time.time() - 2 * config.LEASE_DURATION
+            os.utime(os.path.join(work_dir, 'dead.lease'), (old, old))
+            # a running worker
+            self._write(os.path.join(work_dir, 'busy', 'c.xml'))
+            self._write(os.path.join(work_dir, 'busy.lease'))
+            # left by a previous worker with the same id
+            self._write(os.path.join(work_dir, 'alive', 'd.xml'))
+
+            config.run()
+            # reclaimed files are moved back to input dir before it is
+            # scanned
+            self.assertEqual(
+                ['a.xml', 'd.xml', 'sub/b.xml'],
+                sorted(config.processed)
+            )
+            self.assertEqual(
+                ['busy', 'busy.lease'],
+                sorted(os.listdir(work_dir))
+            )
+            self.assertEqual(
+                ['a.xml', 'd.xml', 'sub'],
+                sorted(os.listdir(config.done_dir()))
+            )
+
+    def test_lost_lease(self):
+        """Files reclaimed while the lease was lost are left to the worker
+        which reclaimed them"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config('slow')
+            self._write(os.path.join(config.input_dir(), 'a.xml'))
+            process_file = config.process_file
+
+            def process_then_lose(partial_file_path):
+                result = process_file(partial_file_path)
+                # another worker reclaims the lease meanwhile
+                os.rename(
+                    os.path.join(config.working_dir(), partial_file_path),
+                    os.path.join(config.input_dir(), partial_file_path),
+                )
+                config._lease.lost = True
+                return result
+
+            config.process_file = process_then_lose
+            config.run()
+            self.assertEqual(['a.xml'], config.processed)
+            self.assertEqual(['a.xml'], os.listdir(config.input_dir()))
+            self.assertFalse(os.path.exists(config.done_dir())
+                             and os.listdir(config.done_dir()))
+
+
+class ShardTest(BaseSwallowTests):
+    """Check that shards split the files of input dir by key"""
+
+    class ShardConfig(BaseConfig):
+
+        GRACE_PERIOD = -1  # secondary files are cleaned at once
+
+        def load_builder(self, partial_file_path):
+            if partial_file_path.endswith('.dep'):
+                return None  # a secondary file
+            config = self
+
+            class Builder(object):
+
+                def __init__(self):
+                    config.open(partial_file_path).close()
+
+                def process_and_save(self):
+                    config.processed.append(partial_file_path)
+                    return [], False
+
+            return Builder()
+
+    def test_shards(self):
+        names = ['top%s.xml' % i for i in range(5)]
+        for desk in ('desk1', 'desk2', 'desk3', 'desk4'):
+            names.extend(
+                os.path.join(desk, name) for name in ('a.xml', 'b.xml', 'c.dep')
+            )
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.ShardConfig()
+            for name in names:
+                path = os.path.join(config.input_dir(), name)
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+
+            processed = []
+            for index in range(3):
+                config = self.ShardConfig(shard=(index, 3))
+                config.processed = []
+                config.run()
+                processed.append(config.processed)
+                # files of the other shards, secondary ones included, are
+                # left in input dir
+                left = [
+                    os.path.relpath(os.path.join(dirpath, f), config.input_dir())
+                    for dirpath, dirnames, filenames in os.walk(config.input_dir())
+                    for f in filenames
+                ]
+                self.assertTrue(left or index == 2)
+                for name in left:
+                    self.assertFalse(config.in_shard(name))
+            self.assertEqual(
+                sorted(name for name in names if not name.endswith('.dep')),
+                sorted(sum(processed, []))
+            )
+            for desk in ('desk1', 'desk2', 'desk3', 'desk4'):
+                # files of a desk are processed by one shard
+                self.assertEqual(1, len([
+                    files for files in processed
+                    if [name for name in files if name.startswith(desk)]
+                ]))
+            self.assertEqual(
+                ['desk1', 'desk2', 'desk3', 'desk4'],
+                sorted(os.listdir(config.input_dir()))
+            )
+            for desk in ('desk1', 'desk2', 'desk3', 'desk4'):
+                self.assertEqual([], os.listdir(os.path.join(config.input_dir(), desk)))
+
+    def test_concurrent_shards(self):
+        """A shard starting does not recover the files another shard is
+        processing"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            first = self.ShardConfig(shard=(0, 2))
+            second = self.ShardConfig(shard=(1, 2))
+            second.processed = []
+            names = [
+                os.path.join('desk%s' % i, 'a.xml') for i in range(10)
+            ]
+            for name in names:
+                path = os.path.join(first.input_dir(), name)
+                os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            name = [n for n in names if first.in_shard(n)][0]
+            # the first shard is processing ``name``
+            first.prepare_paths('')
+            first.open(name).close()
+            second.run()
+            self.assertTrue(
+                os.path.exists(os.path.join(first.work_dir(), name))
+            )
+            self.assertFalse(name in second.processed)
+            self.assertEqual(
+                sorted(n for n in names if second.in_shard(n)),
+                sorted(second.processed)
+            )
+            self.assertNotEqual(
+                first.transitions.journal,
+                second.transitions.journal
+            )
+            self.assertEqual(
+                [(os.path.join(first.input_dir(), name),
+                  os.path.join(first.work_dir(), name))],
+                FileTransitions(first.transitions.journal).recover()
+            )
+
+    def test_parse_shard(self):
+        self.assertEqual((1, 4), parse_shard('1/4'))
+        self.assertRaises(ValueError, parse_shard, '4/4')
+        self.assertRaises(ValueError, parse_shard, 'spam')
+        self.assertRaises(ValueError, self.ShardConfig, shard=(-1, 2))
+        stderr = StringIO()
+        self.assertRaises(
+            SystemExit,
+            call_command,
+            'swallow_run',
+            'swallow.tests.config.PartitionConfig',
+            shard='2/2',
+            stderr=stderr,
+        )
+        self.assertIn('shard index', stderr.getvalue())
+
+    def test_concurrent_prepare_paths(self):
+        """directories created by another shard meanwhile are not an
+        error, a file in their place is"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.ShardConfig(shard=(0, 2))
+            config.prepare_paths('')
+            exists = os.path.exists
+            os.path.exists = lambda path: False
+            try:
+                config.prepare_paths('')
+            finally:
+                os.path.exists = exists
+            self.assertTrue(os.path.isdir(config.done_dir()))
+
+            path = os.path.join(config.done_dir(), 'spam')
+            open(path, 'w').close()
+            self.assertRaises(OSError, makedirs, path)
+
+
+class ParallelTest(BaseSwallowTests):
+    """Check that files are processed by worker processes when
+    ``WORKERS`` is set, and that the parent process moves them"""
+
+    class ParallelConfig(BaseConfig):
+
+        WORKERS = 2
+
+        def load_builder(self, partial_file_path):
+            config = self
+
+            class ParallelBuilder(object):
+
+                def __init__(self):
+                    config.open(partial_file_path).close()
+
+                def process_and_save(self):
+                    return [os.getpid()], False
+
+            return ParallelBuilder()
+
+        def postprocess(self, instances):
+            self.__flag__ = instances
+
+    def test_parallel(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.ParallelConfig()
+            config.run()
+
+            self.assertEqual(3, len(config.__flag__))
+            for pids in config.__flag__:
+                self.assertNotEqual(os.getpid(), pids[0])
+            self.assertEqual(0, len(os.listdir(config.input_dir())))
+            self.assertEqual(0, len(os.listdir(config.work_dir())))
+            self.assertEqual(3, len(os.listdir(config.done_dir())))
+
+    def test_workers_argument(self):
+        """``workers`` argument takes precedence over ``WORKERS``"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.ParallelConfig(workers=1)
+            config.run()
+
+            self.assertEqual(3, len(config.__flag__))
+            for pids in config.__flag__:
+                self.assertEqual(os.getpid(), pids[0])
+            self.assertEqual(3, len(os.listdir(config.done_dir())))
+
+    def test_parent_connection(self):
+        """workers save instances with their own connection, the parent
+        process can still use its connection after the run"""
+        class SavingConfig(self.ParallelConfig):
+
+            def load_builder(self, partial_file_path):
+                config = self
+
+                class SavingBuilder(object):
+
+                    def __init__(self):
+                        config.open(partial_file_path).close()
+
+                    def process_and_save(self):
+                        section = Section(name=partial_file_path)
+                        section.save()
+                        return [section], False
+
+                return SavingBuilder()
+
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = SavingConfig()
+            shutil.copytree(self.ParallelConfig().input_dir(),
+                            config.input_dir())
+            config.run()
+
+            self.assertEqual(3, len(config.__flag__))
+            for sections in config.__flag__:
+                self.assertNotEqual(None, sections[0].pk)
+            Section(name='parent').save()
+            self.assertTrue(Section.objects.filter(name='parent').exists())
+            self.assertEqual(3, len(os.listdir(config.done_dir())))
+
+
+class ScanTests(BaseSwallowTests):
+
+    def test_scan_directory(self):
+        path = os.path.join(self.import_dir, 'articleconfig')
+        entries = scan_directory(path)
+        self.assertEqual(['input'], [entry.name for entry in entries])
+        self.assertTrue(entries[0].is_dir)
+        self.assertIsNone(entries[0].mtime)
+
+        path = os.path.join(path, 'input')
+        entries = scan_directory(path, ['ski.xml', 'missing.xml'])
+        self.assertEqual(1, len(entries))
+        self.assertFalse(entries[0].is_dir)
+        self.assertIsNotNone(entries[0].mtime)
+
+    def test_scan_plan(self):
+        entries = [
+            ScanEntry('dir', '/dir', True, None),
+            ScanEntry('new', '/new', False, 95),
+            ScanEntry('ready', '/ready', False, 80),
+            ScanEntry('old', '/old', False, 10),
+        ]
+        plan = ScanPlan(entries, 10, 60, now=100)
+        self.assertEqual(set(['ready', 'old']), plan.ready)
+        self.assertEqual(['old'], [entry.name for entry in plan.expired])
+
+        plan = ScanPlan(entries, 0, 60, now=100)
+        self.assertEqual(set(['new', 'ready', 'old']), plan.ready)
+
+    def test_listdir_override(self):
+        """Only the files returned by an overriden ``listdir`` are
+        processed"""
+
+        class ListdirConfig(PostProcessTest.PostProcessConfig):
+
+            def listdir(self, dir):
+                return [f for f in os.listdir(dir) if f != 'test_file0']
+
+        ListdirConfig.__name__ = 'PostProcessConfig'
+
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = ListdirConfig()
+            config.run()
+
+            self.assertEqual(2, len(config.__flag__))
+
+
+class DeduplicateTest(BaseSwallowTests):
+    """Check that files whose content was already imported are moved to
+    duplicate dir without being processed"""
+
+    class DeduplicateConfig(BaseConfig):
+
+        DEDUPLICATE = True
+
+        def load_builder(self, partial_file_path):
+            config = self
+
+            class DeduplicateBuilder(object):
+
+                def __init__(self):
+                    config.open(partial_file_path).close()
+
+                def process_and_save(self):
+                    config.processed.append(partial_file_path)
+                    return [], False
+
+            return DeduplicateBuilder()
+
+    def _write(self, config, name, content):
+        f = open(os.path.join(config.input_dir(), name), 'w')
+        f.write(content)
+        f.close()
+
+    def test_deduplicate(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.DeduplicateConfig()
+            config.processed = []
+            os.makedirs(config.input_dir())
+            self._write(config, 'a.xml', 'foo')
+            config.run()
+            self.assertEqual(['a.xml'], config.processed)
+
+            # same content, new name
+            self._write(config, 'b.xml', 'foo')
+            self._write(config, 'c.xml', 'bar')
+            config.run()
+
+            self.assertEqual(['a.xml', 'c.xml'], config.processed)
+            self.assertEqual(['b.xml'], os.listdir(config.duplicate_dir()))
+            self.assertEqual(
+                ['a.xml', 'c.xml'],
+                sorted(os.listdir(config.done_dir()))
+            )
+            self.assertEqual(0, len(os.listdir(config.work_dir())))
+            self.assertEqual(2, ImportedFile.objects.count())
+
+    def test_vanished_file(self):
+        """A file removed before its digest is computed is skipped"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.DeduplicateConfig()
+            config.processed = []
+            os.makedirs(config.input_dir())
+            self._write(config, 'a.xml', 'foo')
+            self._write(config, 'b.xml', 'bar')
+            file_digest = config_module.file_digest
+
+            def remove_then_digest(path):
+                if os.path.basename(path) == 'a.xml':
+                    os.remove(path)
+                return file_digest(path)
+
+            config_module.file_digest = remove_then_digest
+            try:
+                config.run()
+            finally:
+                config_module.file_digest = file_digest
+            self.assertEqual(['b.xml'], config.processed)
+            self.assertEqual(['b.xml'], os.listdir(config.done_dir()))
+
+    def test_record_digest_conflict(self):
+        """A digest recorded meanwhile rolls back to a savepoint"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.DeduplicateConfig()
+            get_or_create = ImportedFile.objects.get_or_create
+            savepoint_rollback = transaction.savepoint_rollback
+            rollbacks = []
+
+            def conflict(*args, **kwargs):
+                raise IntegrityError('duplicate')
+
+            ImportedFile.objects.get_or_create = conflict
+            transaction.savepoint_rollback = rollbacks.append
+            try:
+                config.record_digest('digest', 'a.xml')
+            finally:
+                del ImportedFile.objects.get_or_create
+                transaction.savepoint_rollback = savepoint_rollback
+            self.assertEqual(1, len(rollbacks))
+            self.assertEqual(get_or_create, ImportedFile.objects.get_or_create)
+
+
+class BoundedRunTest(BaseSwallowTests):
+    """Check ``max_files``, ``time_budget`` and ``ordering``"""
+
+    class BoundedConfig(BaseConfig):
+
+        GRACE_PERIOD = 0
+
+        def load_builder(self, partial_file_path):
+            config = self
+
+            class BoundedBuilder(object):
+
+                def __init__(self):
+                    config.open(partial_file_path).close()
+
+                def process_and_save(self):
+                    config.processed.append(partial_file_path)
+                    return [], False
+
+            return BoundedBuilder()
+
+    def _config(self, **kwargs):
+        config = self.BoundedConfig(**kwargs)
+        config.processed = []
+        input_dir = config.input_dir()
+        files = (
+            # path, size, mtime
+            ('a/1', 30, 1000),
+            ('a/2', 10, 3000),
+            ('a/3', 20, 5000),
+            ('b/1', 50, 2000),
+            ('b/2', 40, 4000),
+        )
+        for path, size, mtime in files:
+            path = os.path.join(input_dir, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'w')
+            f.write('x' * size)
+            f.close()
+            os.utime(path, (mtime, mtime))
+        return config
+
+    def test_max_files(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config(max_files=2)
+            config.run()
+
+            self.assertEqual(2, len(config.processed))
+            # the other files are kept for the next run even if they
+            # are older than GRACE_PERIOD
+            input_dir = config.input_dir()
+            remaining = os.listdir(os.path.join(input_dir, 'a'))
+            remaining += os.listdir(os.path.join(input_dir, 'b'))
+            self.assertEqual(3, len(remaining))
+
+            config.run()
+            self.assertEqual(4, len(config.processed))
+
+    def test_time_budget(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config(time_budget=0)
+            config.run()
+
+            self.assertEqual([], config.processed)
+
+    def test_oldest(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config(ordering='oldest')
+            config.run()
+
+            self.assertEqual(
+                ['a/1', 'b/1', 'a/2', 'b/2', 'a/3'],
+                config.processed
+            )
+
+    def test_smallest(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config(ordering='smallest', max_files=3)
+            config.run()
+
+            self.assertEqual(['a/2', 'a/3', 'a/1'], config.processed)
+
+    def test_round_robin(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self._config(ordering='round-robin')
+            config.run()
+
+            directories = [os.path.dirname(p) for p in config.processed]
+            self.assertEqual(5, len(directories))
+            self.assertNotEqual(directories[0], directories[1])
+            self.assertNotEqual(directories[1], directories[2])
+            self.assertNotEqual(directories[2], directories[3])
+
+    def test_invalid_ordering(self):
+        self.assertRaises(ValueError, self.BoundedConfig, ordering='spam')
+        parser = swallow_run.Command().create_parser('manage.py', 'swallow_run')
+        options, args = parser.parse_args(['--ordering', 'round-robin'])
+        self.assertEqual('round-robin', options.ordering)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(
+                SystemExit,
+                parser.parse_args,
+                ['--ordering', 'spam'],
+            )
+        finally:
+            sys.stderr = stderr
+
+
+class PostProcessChunkTest(BaseSwallowTests):
+    """Check that ``postprocess_chunk`` receives the instances of
+    each file by chunks"""
+
+    class ChunkBuilder(BaseBuilder):
+
+        Model = ModelForBuilderTests
+
+        class Mapper(BaseMapper):
+
+            @classmethod
+            def _iter_mappers(cls, builder):
+                for i in range(5):
+                    yield cls(i)
+
+            @property
+            def _instance_filters(self):
+                return {'simple_field': self._content}
+
+        class Populator(BasePopulator):
+
+            _fields_one_to_one = ()
+            _fields_if_instance_already_exists = []
+            _fields_if_instance_modified_from_last_import = []
+
+        def __init__(self, content, config):
+            super(PostProcessChunkTest.ChunkBuilder, self).__init__(content, config)
+            config.open(content).close()
+
+        def skip(self, mapper):
+            return False
+
+        def instance_is_locally_modified(self, instance):
+            return False
+
+    class ChunkConfig(BaseConfig):
+
+        POSTPROCESS_CHUNK_SIZE = 2
+
+        def load_builder(self, partial_file_path):
+            return PostProcessChunkTest.ChunkBuilder(partial_file_path, self)
+
+        def postprocess_chunk(self, instances):
+            self.chunks.append([i.simple_field for i in instances])
+
+        def postprocess(self, instances):
+            self.postprocessed = instances
+
+    def test_postprocess_chunk(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = self.ChunkConfig()
+            config.chunks = []
+            os.makedirs(config.input_dir())
+            open(os.path.join(config.input_dir(), 'file'), 'w').close()
+            config.run()
+
+            self.assertEqual([[0, 1], [2, 3], [4]], config.chunks)
+            # instances are not gathered for postprocess
+            self.assertEqual([], config.postprocessed)
+            self.assertEqual(['file'], os.listdir(config.done_dir()))
@@ -103,6 +103,27 @@ class ArticlePopulator(BasePopulator):
         self._instance.primary_sections.add(section)
 
 
+class SyncArticlePopulator(ArticlePopulator):
+    """Same as :class:`ArticlePopulator` but m2m fields are synchronised
+    instead of cleared and added again"""
+
+    _clear_m2m = False
+
+    @Matching.from_matching(
+        'SECTIONS',
+        post_process_match=_fetch_section_from_constants)
+    def sections(self, sections):
+        self._sync_m2m('sections', sections, weight=self._mapper.weight)
+
+    @Matching.from_matching(
+        'SECTIONS',
+        first_match=True,
+        post_process_match=_fetch_section_from_constant,
+        )
+    def primary_sections(self, section):
+        self._sync_m2m('primary_sections', [section])
+
+
 class ArticleBuilder(BaseBuilder):
 
     Mapper = ArticleMapper
@@ -123,6 +144,11 @@ class ArticleBuilder(BaseBuilder):
         return instance.modified_by != 'swallow'
 
 
+class SyncArticleBuilder(ArticleBuilder):
+
+    Populator = SyncArticlePopulator
+
+
 class ArticleConfig(BaseConfig):
 
     def load_builder(self, partial_file_path):
@@ -138,6 +164,15 @@ class ArticleConfig(BaseConfig):
             return instance.modified_by != 'swallow'
 
 
+class SyncArticleConfig(ArticleConfig):
+
+    def load_builder(self, partial_file_path):
+        filename = os.path.basename(partial_file_path)
+        if re.match(r'^\w+\.xml$', filename) is not None:
+            return SyncArticleBuilder(partial_file_path, self)
+        return None
+
+
 expected_values_initial = {
     'Article Ski': {
         'kind':'DEPECHE',
@@ -310,6 +345,38 @@ class IntegrationTests(TransactionTestCase):
             self._test_input_is_empty()
             self._test_done_has_files()
 
+    def test_run_with_sync(self):
+        """Check that synchronised m2m fields end up like cleared ones and
+        that rows of unchanged relations are kept"""
+
+        def copy_imports():
+            import_dir = os.path.join(CURRENT_PATH, 'import')
+            shutil.copytree(
+                os.path.join(import_dir, 'articleconfig'),
+                os.path.join(import_dir, 'syncarticleconfig'),
+            )
+
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            copy_imports()
+            SyncArticleConfig().run()
+            self._test_articles(expected_values_initial)
+            kept = set(
+                ArticleToSection.objects.exclude(
+                    article__title='Article Bilboquet'
+                ).values_list('pk', flat=True)
+            )
+
+            self._update_imports()
+            copy_imports()
+            SyncArticleConfig().run()
+            self._test_articles(expected_values_after_update)
+            self.assertEqual(
+                kept,
+                set(ArticleToSection.objects.exclude(
+                    article__title='Article Bilboquet'
+                ).values_list('pk', flat=True))
+            )
+
     def test_run_with_update_and_modification(self):
         """Check that update is properly done when instances in db were
         modified"""
@@ -0,0 +1,292 @@
+import gzip
+import json
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from swallow.builder import BaseBuilder
+from swallow.populator import BasePopulator
+from swallow.mappers import IterXmlMapper, BaseMapper, MapperField, XPathField
+from swallow.mappers import JsonLinesMapper, CsvMapper, ColumnField
+from swallow.tests import ModelForBuilderTests
+
+
+ATOM = 'http://www.w3.org/2005/Atom'
+
+
+feed = """<?xml version="1.0"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>feed</title>
+  %s
+  <other><entry><title>not an item</title></entry></other>
+</feed>""" % '\n  '.join(
+    '<entry><title>entry %s</title></entry>' % i for i in range(10)
+)
+
+
+class Builder(object):
+
+    BATCH_SIZE = None
+
+    def __init__(self, content):
+        self.content = 'feed.atom'
+        self.fd = StringIO(content)
+
+
+class EntryMapper(IterXmlMapper):
+
+    ITEM_TAG = 'atom:feed/atom:entry'
+    NAMESPACES = {'atom': ATOM}
+    CHUNK_SIZE = 16
+
+    @property
+    def title(self):
+        return self._item.findtext('{%s}title' % ATOM)
+
+
+class IterXmlMapperTests(TestCase):
+
+    def test_iter_mappers(self):
+        titles = []
+        siblings = []
+        for mapper in EntryMapper._iter_mappers(Builder(feed)):
+            titles.append(mapper.title)
+            siblings.append(len(mapper._item.getparent()))
+        self.assertEqual(['entry %s' % i for i in range(10)], titles)
+        # previous items are removed from the tree
+        self.assertTrue(max(siblings) <= 3)
+
+    def test_batch(self):
+        """Items of the current batch are not cleared"""
+        builder = Builder(feed)
+        builder.BATCH_SIZE = 4
+        mappers = EntryMapper._iter_mappers(builder)
+        batch = [mappers.next() for i in range(4)]
+        self.assertEqual(
+            ['entry %s' % i for i in range(4)],
+            [mapper.title for mapper in batch]
+        )
+        mappers.next()
+        self.assertEqual(None, batch[0].title)
+        self.assertEqual('entry 1', batch[1].title)
+
+    def test_clark_notation(self):
+
+        class Mapper(EntryMapper):
+
+            ITEM_TAG = '{%s}entry' % ATOM
+
+        mappers = list(Mapper._iter_mappers(Builder(feed)))
+        self.assertEqual(11, len(mappers))
+
+    def test_parser_reuse(self):
+        list(EntryMapper._iter_mappers(Builder(feed)))
+        parsers = EntryMapper._parsers[('{%s}entry' % ATOM, True)]
+        parser = parsers[0]
+        list(EntryMapper._iter_mappers(Builder(feed)))
+        self.assertEqual([parser], parsers)
+
+    def test_entities_are_not_resolved(self):
+        xml = """<?xml version="1.0"?>
+<!DOCTYPE feed [<!ENTITY secret SYSTEM "file:///etc/passwd">]>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <entry><title>&secret;</title></entry>
+</feed>"""
+        mapper, = EntryMapper._iter_mappers(Builder(xml))
+        self.assertFalse(mapper.title)
+
+
+class DeclaredEntryMapper(EntryMapper):
+
+    title = XPathField('atom:title', max_length=5)
+    number = XPathField(
+        'substring-after(atom:title, " ")',
+        converter=int,
+    )
+    missing = XPathField('atom:missing/text()', default='default')
+    links = XPathField('atom:link/@href', many=True)
+    counts = XPathField('count(atom:link)', converter=int, many=True)
+
+
+class MapperFieldTests(TestCase):
+
+    def test_xpath_fields(self):
+        mappers = []
+        for mapper in DeclaredEntryMapper._iter_mappers(Builder(feed)):
+            mapper._extract()
+            mappers.append(mapper)
+        self.assertEqual(['entry'] * 10, [m.title for m in mappers])
+        self.assertEqual(range(10), [m.number for m in mappers])
+        self.assertEqual('default', mappers[0].missing)
+        self.assertEqual([], mappers[0].links)
+        # a number expression gives a list of one value
+        self.assertEqual([0], mappers[0].counts)
+
+    def test_memoise(self):
+        calls = []
+
+        class Mapper(BaseMapper):
+
+            value = MapperField(lambda mapper: calls.append(1) or mapper._content)
+
+        mapper = Mapper('spam')
+        self.assertEqual('spam', mapper.value)
+        self.assertEqual('spam', mapper.value)
+        self.assertEqual(1, len(calls))
+        self.assertTrue(isinstance(Mapper.value, MapperField))
+
+    def test_preextract(self):
+        """Declared fields are computed when mappers are created"""
+
+        class Mapper(DeclaredEntryMapper):
+
+            PREEXTRACT = True
+
+        mappers = list(Mapper._iter_mappers(Builder(feed)))
+        # items are cleared but fields were extracted before
+        self.assertEqual(None, mappers[0]._item.findtext('{%s}title' % ATOM))
+        self.assertEqual(range(10), [m.number for m in mappers])
+        self.assertEqual(
+            ['counts', 'links', 'missing', 'number', 'title'],
+            Mapper._declared_fields()
+        )
+
+    def test_compiled_once(self):
+        mapper = list(DeclaredEntryMapper._iter_mappers(Builder(feed)))[0]
+        field = DeclaredEntryMapper.__dict__['title']
+        xpath = field.compiled(DeclaredEntryMapper)
+        self.assertTrue(xpath is field.compiled(DeclaredEntryMapper))
+        # values do not keep the tree alive
+        self.assertFalse(hasattr(mapper.title, 'getparent'))
+
+
+def gzipped(content):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(content)
+    f.close()
+    return out.getvalue()
+
+
+jsonlines = '\n'.join(
+    json.dumps({'simple_field': i, 'second_field': i * 10})
+    for i in range(5)
+) + '\n\n'
+
+
+csvlines = 'id;label\n1;one\n2;\n3;tr\xc3\xa8s\n'
+
+
+class RowMapperTests(TestCase):
+
+    def test_json_lines(self):
+        for content in (jsonlines, gzipped(jsonlines)):
+            mappers = list(JsonLinesMapper._iter_mappers(Builder(content)))
+            self.assertEqual(range(5), [m.simple_field for m in mappers])
+            self.assertFalse(hasattr(mappers[0], '__dict__'))
+            self.assertRaises(AttributeError, getattr, mappers[0], 'spam')
+            self.assertNotEqual(mappers[0]._fingerprint, mappers[1]._fingerprint)
+
+    def test_csv(self):
+
+        class Mapper(CsvMapper):
+
+            __slots__ = ()
+
+            DELIMITER = ';'
+
+            id = ColumnField('id', converter=int)
+
+        for content in (csvlines, gzipped(csvlines)):
+            mappers = list(Mapper._iter_mappers(Builder(content)))
+            self.assertEqual([1, 2, 3], [m.id for m in mappers])
+            self.assertEqual([u'one', None, u'tr\xe8s'], [m.label for m in mappers])
+
+        Mapper.COLUMNS = ('ID', 'LABEL')
+        mappers = list(Mapper._iter_mappers(Builder(csvlines)))
+        self.assertEqual(u'one', mappers[0].LABEL)
+        Mapper.HEADER = False
+        mappers = list(Mapper._iter_mappers(Builder(csvlines)))
+        self.assertEqual(u'label', mappers[0].LABEL)
+
+    def test_json_lines_default(self):
+
+        class Mapper(JsonLinesMapper):
+
+            __slots__ = ()
+
+            missing = ColumnField('missing', default=42)
+
+        mapper = list(Mapper._iter_mappers(Builder(jsonlines)))[0]
+        self.assertEqual(42, mapper.missing)
+        self.assertEqual(None, mapper._get('spam'))
+
+    def test_csv_multiline(self):
+
+        class Mapper(CsvMapper):
+
+            __slots__ = ()
+
+            DELIMITER = ';'
+
+        content = 'id;label\n\n1;"one\n\ntwo"\n\n2;three\n'
+        mappers = list(Mapper._iter_mappers(Builder(content)))
+        self.assertEqual([u'1', u'2'], [m.id for m in mappers])
+        self.assertEqual(u'one\n\ntwo', mappers[0].label)
+
+    def test_csv_positions(self):
+
+        class Mapper(CsvMapper):
+
+            __slots__ = ()
+
+            DELIMITER = ';'
+            HEADER = False
+
+            id = ColumnField(0)
+            label = ColumnField(1)
+            extra = ColumnField(2, default=u'none')
+
+        mappers = list(Mapper._iter_mappers(Builder(csvlines)))
+        self.assertEqual([u'id', u'1', u'2', u'3'], [m.id for m in mappers])
+        self.assertEqual(u'one', mappers[1].label)
+        self.assertEqual(u'none', mappers[1].extra)
+        self.assertRaises(AttributeError, getattr, mappers[1], 'spam')
+
+    def test_builder(self):
+
+        class RowBuilder(BaseBuilder):
+
+            Model = ModelForBuilderTests
+            BATCH_SIZE = 2
+
+            class Mapper(JsonLinesMapper):
+
+                __slots__ = ()
+
+                @property
+                def _instance_filters(self):
+                    return {'simple_field': self.simple_field}
+
+            class Populator(BasePopulator):
+
+                _bulk_create = True
+                _fields_one_to_one = ('simple_field', 'second_field')
+                _fields_if_instance_already_exists = None
+                _fields_if_instance_modified_from_last_import = None
+
+            def skip(self, mapper):
+                return False
+
+            def instance_is_locally_modified(self, instance):
+                return False
+
+        builder = RowBuilder(None, None)
+        builder.fd = StringIO(gzipped(jsonlines))
+        instances, unhandled_errors = builder.process_and_save()
+        self.assertFalse(unhandled_errors)
+        self.assertEqual(
+            [0, 10, 20, 30, 40],
+            list(ModelForBuilderTests.objects.order_by('simple_field').values_list(
+                'second_field', flat=True))
+        )
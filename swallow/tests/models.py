@@ -5,7 +5,10 @@ from django.core.files.base import ContentFile
 from django.test import TestCase
 from django.conf import settings
 
-from swallow.models import Matching
+from swallow.models import Matching, CompiledMatching
+from swallow.builder import BaseBuilder
+from swallow.tests import ModelForBuilderTests
+from swallow.populator import BasePopulator
 
 
 xml = """
@@ -95,3 +98,130 @@ class MatchingTests(TestCase):
         mapper = DummyMapper('random', u'thing')
         value = self.matching.match(mapper, first_match=True)
         self.assertEqual('DEFAULT', value)
+
+    def test_match_first_match(self):
+        mapper = DummyMapper('foo', 'baz')
+        value = self.matching.match(mapper, first_match=True)
+        self.assertEqual('FOOBARBAZ', value)
+        mapper = DummyMapper('baz', 'nothing')
+        value = self.matching.match(mapper, first_match=True)
+        self.assertEqual('BAZ', value)
+
+    def test_match_unhashable(self):
+        mapper = DummyMapper(['foo'], 'baz')
+        value = self.matching.match(mapper)
+        self.assertEqual(['DEFAULT'], value)
+
+
+xml_without_default = """
+<maps>
+  <map>
+    <column>ANY</column>
+    <set>
+       <!-- no rule -->
+    </set>
+  </map>
+  <map>
+    <column>MIXED</column>
+    <set>
+       <title>Foo</title>
+       <title loose-compare="yes">Bar Baz</title>
+    </set>
+  </map>
+</maps>"""
+
+
+class CompiledMatchingTests(TestCase):
+
+    def setUp(self):
+        settings.MEDIA_ROOT = '/tmp'
+        self.matching = Matching(name='COMPILED')
+        self.matching.file.save(
+            'swallow_matchings/compiled.xml',
+            ContentFile(xml_without_default),
+            save=True
+        )
+
+    def test_match(self):
+        mapper = DummyMapper('BAR-baz', None)
+        self.assertEqual(['ANY', 'MIXED'], self.matching.match(mapper))
+        mapper = DummyMapper('foo', None)
+        self.assertEqual(['ANY'], self.matching.match(mapper))
+        self.assertEqual('ANY', self.matching.match(mapper, first_match=True))
+
+    def test_cache(self):
+        """Matchings are compiled once per process until they are saved"""
+        compiled = self.matching.compile()
+        matching = Matching.objects.get(name='COMPILED')
+        self.assertTrue(compiled is matching.compile())
+
+        matching.file.save(
+            'swallow_matchings/compiled.xml',
+            ContentFile(xml),
+            save=True
+        )
+        self.assertFalse(compiled is matching.compile())
+        mapper = DummyMapper('bar', 'nothing')
+        self.assertEqual(['BAR'], matching.match(mapper))
+
+
+class MatchManyTests(TestCase):
+
+    def setUp(self):
+        settings.MEDIA_ROOT = '/tmp'
+        self.matching = Matching(name='MANY')
+        self.matching.file.save(
+            'swallow_matchings/many.xml',
+            ContentFile(xml),
+            save=True
+        )
+        self.mappers = [
+            DummyMapper('foo', 'baz'),
+            DummyMapper('bar', 'nothing'),
+            DummyMapper('foo', 'baz'),
+            DummyMapper(['foo'], u'éèçàæœ et voilà'),
+            DummyMapper('random', u'thing'),
+        ]
+
+    def test_match_many(self):
+        """Results are the same as :meth:`Matching.match`"""
+        for first_match in (False, True):
+            self.assertEqual(
+                [self.matching.match(m, first_match) for m in self.mappers],
+                self.matching.match_many(self.mappers, first_match),
+            )
+        results = self.matching.match_many(self.mappers)
+        self.assertFalse(results[0] is results[2])
+
+    def test_from_matching_batch(self):
+        """Matchings of a batch are evaluated before the populator methods
+        are called"""
+
+        class Populator(BasePopulator):
+
+            @Matching.from_matching('MANY', batch=True)
+            def title(self, values):
+                return values
+
+            @Matching.from_matching('MANY', first_match=True)
+            def suptitle(self, value):
+                return value
+
+        class Builder(BaseBuilder):
+            pass
+
+        Builder.Populator = Populator
+        builder = Builder(None, None)
+        builder.prefetch_matchings(self.mappers)
+
+        match = CompiledMatching.match
+        CompiledMatching.match = None
+        try:
+            for mapper in self.mappers:
+                populator = Populator(mapper, ModelForBuilderTests(), False, builder)
+                self.assertEqual(self.matching.match_many([mapper])[0], populator.title())
+        finally:
+            CompiledMatching.match = match
+        # matchings without ``batch`` are evaluated mapper by mapper
+        populator = Populator(self.mappers[0], ModelForBuilderTests(), False, builder)
+        self.assertEqual('FOOBARBAZ', populator.suptitle())
@@ -0,0 +1,212 @@
+import os
+import signal
+from time import time, sleep
+from StringIO import StringIO
+
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from override_settings import override_settings
+
+from django.core.management import call_command
+
+from base import BaseSwallowTests
+
+from swallow.config import BaseConfig
+from swallow.watch import TimerWheel, Watcher
+from swallow.management.commands import swallow_watch
+
+
+class TimerWheelTests(BaseSwallowTests):
+
+    def test_advance(self):
+        wheel = TimerWheel(tick=1, size=8, now=100)
+        wheel.schedule(101, 'a')
+        wheel.schedule(103, 'b')
+        wheel.schedule(120, 'c')  # more than one turn of the wheel
+        wheel.schedule(50, 'd')  # already elapsed
+        self.assertEqual(4, len(wheel))
+
+        self.assertEqual(['d'], wheel.advance(100.5))
+        self.assertEqual(['a'], wheel.advance(101))
+        self.assertEqual(['b'], wheel.advance(110))
+        self.assertEqual([], wheel.advance(119))
+        self.assertEqual(['c'], wheel.advance(120))
+        self.assertEqual(0, len(wheel))
+        self.assertIsNone(wheel.timeout())
+
+    def test_timeout(self):
+        """The timeout is the delay before the earliest item, not before
+        the next tick"""
+        wheel = TimerWheel(tick=1, size=8, now=100)
+        wheel.schedule(120, 'a')  # more than one turn of the wheel
+        self.assertEqual(20, wheel.timeout(100))
+        wheel.schedule(105, 'b')
+        self.assertEqual(5, wheel.timeout(100))
+        self.assertEqual(0, wheel.timeout(106))
+        self.assertEqual(['b'], wheel.advance(106))
+        self.assertEqual(14, wheel.timeout(106))
+
+
+class WatchConfig(BaseConfig):
+
+    def load_builder(self, partial_file_path):
+        config = self
+
+        class WatchBuilder(object):
+
+            def __init__(self):
+                config.open(partial_file_path).close()
+
+            def process_and_save(self):
+                return [partial_file_path], False
+
+        return WatchBuilder()
+
+    def postprocess(self, instances):
+        self.processed.extend(instances)
+
+
+class FailingWatchConfig(WatchConfig):
+
+    def load_builder(self, partial_file_path):
+        if partial_file_path.startswith('fail'):
+            raise ValueError(partial_file_path)
+        return super(FailingWatchConfig, self).load_builder(partial_file_path)
+
+
+class WatcherTests(BaseSwallowTests):
+
+    def _wait(self, watcher, condition, timeout=5):
+        start = time()
+        while not condition() and time() - start < timeout:
+            watcher.handle_events()
+            watcher.handle_timers()
+            sleep(0.01)
+
+    def test_watch(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = WatchConfig()
+            config.processed = []
+            input_dir = config.input_dir()
+            os.makedirs(input_dir)
+            open(os.path.join(input_dir, 'before'), 'w').close()
+
+            watcher = Watcher(config, tick=0.01)
+            watcher.start()
+            # files already in input dir are processed at startup
+            self.assertEqual([['before']], config.processed)
+
+            open(os.path.join(input_dir, 'after'), 'w').close()
+            os.makedirs(os.path.join(input_dir, 'sub'))
+            self._wait(watcher, lambda: len(watcher.directories) == 2)
+            open(os.path.join(input_dir, 'sub', 'nested'), 'w').close()
+            self._wait(watcher, lambda: len(config.processed) == 3)
+            watcher.close()
+
+            processed = sorted(p[0] for p in config.processed)
+            self.assertEqual(['after', 'before', 'sub/nested'], processed)
+            self.assertEqual(
+                ['after', 'before', 'sub'],
+                sorted(os.listdir(config.done_dir()))
+            )
+            self.assertEqual(
+                ['nested'],
+                os.listdir(os.path.join(config.done_dir(), 'sub'))
+            )
+
+    def test_failing_builder(self):
+        """A file whose builder fails is moved to error dir and the watcher
+        goes on"""
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            config = FailingWatchConfig()
+            config.processed = []
+            input_dir = config.input_dir()
+            os.makedirs(input_dir)
+
+            watcher = Watcher(config, tick=0.01)
+            watcher.start()
+            open(os.path.join(input_dir, 'fail'), 'w').close()
+            open(os.path.join(input_dir, 'ok'), 'w').close()
+            error_file_path = os.path.join(config.error_dir(), 'fail')
+            self._wait(
+                watcher,
+                lambda: config.processed and os.path.exists(error_file_path)
+            )
+            watcher.close()
+
+            self.assertEqual([['ok']], config.processed)
+            self.assertEqual(['fail'], os.listdir(config.error_dir()))
+            self.assertEqual(['ok'], os.listdir(config.done_dir()))
+            self.assertEqual([], os.listdir(input_dir))
+
+
+class WatchCommandTests(BaseSwallowTests):
+    """Check the options of ``swallow_watch``, the loop itself is replaced
+    so that the command returns"""
+
+    def setUp(self):
+        super(WatchCommandTests, self).setUp()
+        self.watched = []
+        self._watch = swallow_watch.watch
+        swallow_watch.watch = self.watched.extend
+        self._handlers = [
+            signal.getsignal(signal.SIGTERM),
+            signal.getsignal(signal.SIGINT),
+        ]
+
+    def tearDown(self):
+        for watcher in self.watched:
+            watcher.close()
+        swallow_watch.watch = self._watch
+        signal.signal(signal.SIGTERM, self._handlers[0])
+        signal.signal(signal.SIGINT, self._handlers[1])
+        super(WatchCommandTests, self).tearDown()
+
+    def test_watchers(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            call_command(
+                'swallow_watch',
+                'swallow.tests.watch.WatchConfig',
+                'swallow.tests.watch.FailingWatchConfig',
+                tick=0.5,
+                shard='1/2',
+                stdout=StringIO(),
+            )
+        self.assertEqual(
+            [WatchConfig, FailingWatchConfig],
+            [type(watcher.config) for watcher in self.watched]
+        )
+        for watcher in self.watched:
+            self.assertEqual(0.5, watcher.wheel.tick)
+            self.assertEqual((1, 2), watcher.config.shard)
+            self.assertFalse(watcher.config.dryrun)
+
+        # signals stop the watchers once the current file is processed
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+        self.assertTrue(all(watcher.stopped for watcher in self.watched))
+
+    def test_dry_run(self):
+        with override_settings(SWALLOW_DIRECTORY=self.SWALLOW_DIRECTORY):
+            stdout = StringIO()
+            call_command(
+                'swallow_watch',
+                'swallow.tests.watch.WatchConfig',
+                dryrun=True,
+                stdout=stdout,
+            )
+        self.assertTrue(self.watched[0].config.dryrun)
+        self.assertIn('dry run', stdout.getvalue())
+
+    def test_invalid_shard(self):
+        stderr = StringIO()
+        self.assertRaises(
+            SystemExit,
+            call_command,
+            'swallow_watch',
+            'swallow.tests.watch.WatchConfig',
+            shard='2/2',
+            stderr=stderr,
+        )
+        self.assertIn('shard index', stderr.getvalue())
+        self.assertEqual([], self.watched)
@@ -1,12 +1,45 @@
 import os
+import bz2
+import zlib
+import errno
+import stat
+import hashlib
 import logging
 import shutil
+import socket
+import zipfile
+import threading
 import traceback
 
+from time import time, mktime, localtime
+from collections import OrderedDict
+
 from django.conf import settings
+from django.db.models import Model
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import ForeignKey
 from django.utils.importlib import import_module
 
 
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        # Python 2 backport, see https://pypi.python.org/pypi/scandir
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        # Python 2 backport, see https://pypi.python.org/pypi/backports.lzma
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
 log = logging.getLogger('swallow.util')
 
 
@@ -46,25 +79,1032 @@ def smart_decode(s):
         return s.decode('latin-1')
 
 
-def move_file(src, dst):
-    log.info(u'move %s to %s', smart_decode(src), smart_decode(dst))
+def file_digest(path, blocksize=1024 * 1024):
+    """Returns the sha1 hex digest of the file at ``path``, the file is
+    read by blocks of ``blocksize`` bytes"""
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.xz')
+
+
+def _xz_decompressor():
+    if lzma is None:
+        raise IOError('xz files need the backports.lzma package')
+    return lzma.LZMADecompressor()
+
+
+# magic number -> decompressor factory, the bzip2 magic number is followed
+# by the block size, from '1' to '9', so that plain files starting with
+# 'BZh' are not taken for bzip2 files
+COMPRESSIONS = (
+    ('\x1f\x8b', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+) + tuple(
+    ('BZh%s' % size, bz2.BZ2Decompressor) for size in range(1, 10)
+) + (
+    ('\xfd7zXZ\x00', _xz_decompressor),
+)
+
+
+def logical_name(path):
+    """Returns ``path`` without its compression suffix if any"""
+    root, ext = os.path.splitext(path)
+    if ext in COMPRESSION_SUFFIXES:
+        return root
+    return path
+
+
+class DecompressedFile(object):
+    """Read only file object that decompresses ``fd`` on the fly with
+    decompressors created by ``factory``. Concatenated streams are
+    decompressed one after the other."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fd, factory):
+        self.fd = fd
+        self.factory = factory
+        self.name = getattr(fd, 'name', None)
+        self._decompressor = factory()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Decompresses the next chunk of ``fd``"""
+        data = self.fd.read(self.CHUNK_SIZE)
+        if not data:
+            self._eof = True
+            return
+        out = []
+        while data:
+            try:
+                out.append(self._decompressor.decompress(data))
+            except EOFError:
+                # previous stream ended exactly at the end of a chunk
+                self._decompressor = self.factory()
+                continue
+            unused = self._decompressor.unused_data
+            if unused:
+                if unused == data and not out[-1]:
+                    raise IOError('invalid compressed data in %s' % self.name)
+                # a new stream starts
+                self._decompressor = self.factory()
+            data = unused
+        self._buffer = self._buffer[self._pos:] + ''.join(out)
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._eof:
+                self._fill()
+            size = len(self._buffer) - self._pos
+        while len(self._buffer) - self._pos < size and not self._eof:
+            self._fill()
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buffer.find('\n', self._pos)
+            if end >= 0 or self._eof:
+                break
+            self._fill()
+        if end < 0:
+            end = len(self._buffer)
+        else:
+            end += 1
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        line = self._buffer[self._pos:end]
+        self._pos = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def decompressed(fd):
+    """Returns a :class:`DecompressedFile` reading the decompressed content
+    of ``fd`` if it is gzip, bzip2 or xz compressed, else ``fd``.
+    ``fd`` should be seekable, it is returned as is otherwise"""
+    if not hasattr(fd, 'seek'):
+        return fd
+    magic = fd.read(max(len(magic) for magic, factory in COMPRESSIONS))
+    fd.seek(0)
+    for prefix, factory in COMPRESSIONS:
+        if magic.startswith(prefix):
+            return DecompressedFile(fd, factory)
+    return fd
+
+
+FSYNC_POLICIES = ('none', 'file', 'batch')
+
+
+def fsync_directory(path):
+    """Flushes the entries of directory ``path`` to disk"""
+    fd = os.open(path, os.O_RDONLY)
     try:
-        shutil.move(src, dst)
-    except shutil.Error, exception:
-        # most likely the file already exists
-        log.debug(u"can't move %s to %s" % (smart_decode(src), smart_decode(dst)))
-        dst_file = os.path.join(dst, os.path.basename(src))
-        if os.path.exists(dst_file):
-            # if the file already exists the import failed previously
-            # no need to move this file again since afp xml files
-            # are properly versionned we are assured that it's the
-            # same file
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def makedirs(path):
+    """Creates directory ``path`` and its parents, a directory created
+    meanwhile by another process is not an error"""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def same_content(path, other):
+    """Returns ``True`` if files ``path`` and ``other`` have the same
+    content"""
+    if os.path.getsize(path) != os.path.getsize(other):
+        return False
+    return file_digest(path) == file_digest(other)
+
+
+def _escape(path):
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path.encode('string_escape')
+
+
+def _unescape(field):
+    return field.decode('string_escape')
+
+
+class FileTransitions(object):
+    """Moves files between swallow directories.
+
+    Files are renamed when the source and the destination are on the same
+    file system, else they are copied by blocks to a temporary name next
+    to the destination which is renamed once complete, then the source is
+    removed. A file is never visible partially written under its
+    destination name.
+
+    If ``journal`` is a path, every transition is appended to this file
+    before it starts and once it is done, so that the transitions
+    interrupted by a crash are completed by
+    :meth:`FileTransitions.recover`.
+
+    ``fsync`` is the durability policy, one of :data:`FSYNC_POLICIES`:
+
+    - ``'none'``: nothing is flushed explicitly, the system decides
+    - ``'file'``: the journal, copied data and changed directories are
+      flushed with each transition
+    - ``'batch'``: the journal and changed directories are flushed by
+      :meth:`FileTransitions.sync` every ``batch_size`` transitions,
+      copied data is still flushed before its source is removed
+    """
+
+    BLOCK_SIZE = 1024 * 1024  # Size of the blocks of copied files
+    TEMP_SUFFIX = '.swallow-tmp'  # Suffix of files being copied
+
+    def __init__(self, journal=None, fsync='none', batch_size=100):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync policy should be one of %s, not %r' % (
+                ', '.join(FSYNC_POLICIES),
+                fsync,
+            ))
+        self.journal = journal
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self._fd = None  # journal file descriptor, opened on first record
+        self._count = 0  # transitions recorded by this process
+        self._unsynced = 0  # transitions done since last sync
+        self._dirty = set()  # directories to flush on next sync
+
+    def move(self, src, dst):
+        """Moves file ``src`` to ``dst``, a file path or an existing
+        directory, and returns the new path of the file. Missing
+        directories of ``dst`` are created.
+
+        If ``dst`` exists with the same content ``src`` is removed, if its
+        content differs it is kept aside with a numbered suffix."""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        log.info(u'move %s to %s', smart_decode(src), smart_decode(dst))
+        directory = os.path.dirname(dst)
+        if directory:
+            makedirs(directory)
+        if os.path.exists(dst):
+            if same_content(src, dst):
+                # the file was already moved by a previous run
+                log.info(u'%s already exists, remove %s' % (
+                    smart_decode(dst),
+                    smart_decode(src),
+                ))
+                tid = self._begin(src, dst)
+                os.remove(src)
+                self._dirty_directories(os.path.dirname(src))
+                self._end(tid)
+                return dst
+            aside = dst
+            n = 0
+            while os.path.exists(aside):
+                n += 1
+                aside = '%s.%s' % (dst, n)
+            log.warning(u'%s already exists, keep it as %s' % (
+                smart_decode(dst),
+                smart_decode(aside),
+            ))
+            tid = self._begin(dst, aside)
+            self._transfer(dst, aside)
+            self._end(tid)
+        tid = self._begin(src, dst)
+        self._transfer(src, dst)
+        self._end(tid)
+        return dst
+
+    def claim(self, src, dst):
+        """Renames ``src`` to ``dst`` and returns ``True``, or ``False`` if
+        ``src`` vanished meanwhile, claimed by another process for
+        instance. Missing directories of ``dst`` are created.
+
+        Unlike :meth:`FileTransitions.move` the file is never copied, so
+        that only one process can claim it, ``src`` and ``dst`` should be
+        on the same file system."""
+        log.info(u'claim %s to %s', smart_decode(src), smart_decode(dst))
+        directory = os.path.dirname(dst)
+        if directory:
+            makedirs(directory)
+        tid = self._begin(src, dst)
+        try:
+            self._rename(src, dst)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            log.info(u'%s was claimed by another process' % smart_decode(src))
+            claimed = False
+        else:
+            self._dirty_directories(os.path.dirname(src), directory)
+            claimed = True
+        self._end(tid)
+        return claimed
+
+    def _rename(self, src, dst):
+        os.rename(src, dst)
+
+    def _transfer(self, src, dst):
+        """Renames ``src`` to ``dst`` or copies it if they are on different
+        devices, ``dst`` is replaced if it exists"""
+        try:
+            self._rename(src, dst)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._copy(src, dst)
             os.remove(src)
-        else:  # arg! it's something else
-               # keep the file we don't want to loose data
-            msg = '%s is buggy, tried to move to error but failed' % src
-            log_msg = format_exception(exception, msg)
-            log.error(log_msg)
+            self._dirty_directories(os.path.dirname(src))
+        else:
+            self._dirty_directories(os.path.dirname(src), os.path.dirname(dst))
+
+    def _copy(self, src, dst):
+        """Copies ``src`` to a temporary file renamed ``dst`` once flushed
+        according to the fsync policy"""
+        tmp = dst + self.TEMP_SUFFIX
+        source = open(src, 'rb')
+        try:
+            target = open(tmp, 'wb')
+            try:
+                while True:
+                    block = source.read(self.BLOCK_SIZE)
+                    if not block:
+                        break
+                    target.write(block)
+                if self.fsync != 'none':
+                    target.flush()
+                    os.fsync(target.fileno())
+            finally:
+                target.close()
+            shutil.copystat(src, tmp)
+            os.rename(tmp, dst)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            source.close()
+        if self.fsync != 'none':
+            # the source is removed next
+            fsync_directory(os.path.dirname(dst) or '.')
+
+    def _dirty_directories(self, *directories):
+        if self.fsync == 'file':
+            for directory in directories:
+                fsync_directory(directory or '.')
+        elif self.fsync == 'batch':
+            self._dirty.update(directories)
+
+    def _record(self, fields, flush):
+        if self.journal is None:
+            return
+        if self._fd is None:
+            directory = os.path.dirname(self.journal)
+            if directory:
+                makedirs(directory)
+            self._fd = os.open(
+                self.journal,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0644
+            )
+        # one write per record so that concurrent processes do not mix them
+        os.write(self._fd, '\t'.join(_escape(f) for f in fields) + '\n')
+        if flush and self.fsync == 'file':
+            os.fsync(self._fd)
+
+    def _begin(self, src, dst):
+        self._count += 1
+        tid = '%s.%s' % (os.getpid(), self._count)
+        self._record(('begin', tid, src, dst), True)
+        return tid
+
+    def _end(self, tid):
+        # the end of a transition need not be flushed, completing it again
+        # does nothing
+        self._record(('end', tid), False)
+        self._unsynced += 1
+        if self.fsync == 'batch' and self._unsynced >= self.batch_size:
+            self.sync()
+
+    def sync(self):
+        """Flushes the journal and the directories changed since last call
+        if the policy is not ``'none'``"""
+        if self._fd is not None and self.fsync != 'none':
+            os.fsync(self._fd)
+        for directory in self._dirty:
+            try:
+                fsync_directory(directory or '.')
+            except OSError:
+                pass  # the directory was removed
+        self._dirty.clear()
+        self._unsynced = 0
+
+    def truncate(self):
+        """Empties the journal, no transition should be in progress"""
+        self.sync()
+        if self._fd is not None:
+            os.ftruncate(self._fd, 0)
+        elif self.journal is not None and os.path.exists(self.journal):
+            open(self.journal, 'wb').close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def recover(self):
+        """Completes the transitions of the journal interrupted by a crash,
+        then empties the journal.
+
+        Returns the list of ``(origin, path)`` of the files which are
+        still at the destination of journaled transitions, where ``origin``
+        is the path of the file before the first of them."""
+        if self.journal is None or not os.path.exists(self.journal):
+            return []
+        pending = OrderedDict()  # id -> (src, dst) of unfinished transitions
+        located = OrderedDict()  # path -> origin
+        f = open(self.journal, 'rb')
+        try:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # the record was not completely written
+                fields = [_unescape(field) for field in line[:-1].split('\t')]
+                if fields[0] == 'begin' and len(fields) == 4:
+                    pending[fields[1]] = (fields[2], fields[3])
+                elif fields[0] == 'end' and fields[1] in pending:
+                    src, dst = pending.pop(fields[1])
+                    located[dst] = located.pop(src, src)
+        finally:
+            f.close()
+        for src, dst in pending.values():
+            tmp = dst + self.TEMP_SUFFIX
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if os.path.exists(src):
+                log.warning(u'complete interrupted move of %s to %s' % (
+                    smart_decode(src),
+                    smart_decode(dst),
+                ))
+                try:
+                    self._transfer(src, dst)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue  # moved meanwhile by another process
+            elif not os.path.exists(dst):
+                continue
+            located[dst] = located.pop(src, src)
+        self.truncate()
+        return [
+            (origin, path) for path, origin in located.items()
+            if os.path.exists(path)
+        ]
+
+
+# used by :func:`move_file`, without journal
+_transitions = FileTransitions()
+
+
+def move_file(src, dst):
+    """Moves file ``src`` to ``dst`` without journal, see
+    :meth:`FileTransitions.move`"""
+    return _transitions.move(src, dst)
+
+
+def remove_empty_directories(path, root):
+    """Removes directory ``path`` and its parents up to ``root`` excluded as
+    long as they are empty"""
+    root = os.path.normpath(root)
+    path = os.path.normpath(path)
+    while path != root and path.startswith(root + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break  # not empty
+        path = os.path.dirname(path)
+
+
+def default_worker_id():
+    """Returns ``<host name>-<process id>``"""
+    return '%s-%s' % (socket.gethostname(), os.getpid())
+
+
+LEASE_SUFFIX = '.lease'
+
+
+class Lease(object):
+    """Lease file held by a worker, see
+    :attribute:`swallow.config.BaseConfig.CLAIM`.
+
+    While the lease is held, a thread updates the modification time of the
+    file every third of ``duration`` seconds. A lease not updated for
+    ``duration`` seconds is expired. Times are read from the modification
+    times of the files, so that hosts sharing the directory over NFS
+    compare times given by the same clock, the one of the server."""
+
+    def __init__(self, path, duration):
+        self.path = path
+        self.duration = duration
+        self.lost = False  # set if the lease was reclaimed while held
+        self._stop = None
+        self._thread = None
+
+    def acquire(self):
+        """Creates the lease file and starts the heartbeat"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            makedirs(directory)
+        f = open(self.path, 'w')
+        try:
+            f.write('%s %s\n' % (socket.gethostname(), os.getpid()))
+        finally:
+            f.close()
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.duration / 3.0):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                log.error(u'lease %s was lost' % smart_decode(self.path))
+                self.lost = True
+                return
+
+    def now(self):
+        """Returns the current time of the clock which dates leases"""
+        os.utime(self.path, None)
+        return os.stat(self.path).st_mtime
+
+    def expired(self, path, now):
+        """Returns ``True`` if lease file ``path`` expired at time ``now``,
+        see :meth:`Lease.now`"""
+        return now - os.stat(path).st_mtime > self.duration
+
+    def release(self, remove=True):
+        """Stops the heartbeat and removes the lease file if ``remove`` is
+        ``True``"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+SEGMENT_SUFFIX = '.zip'
+
+
+def file_crc32(path, blocksize=1024 * 1024):
+    """Returns the CRC-32 of the file at ``path`` as stored in zip files"""
+    crc = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+    finally:
+        f.close()
+    return crc & 0xffffffff
+
+
+def split_segment(path):
+    """Returns ``(segment, name)`` if ``path`` is the path of file ``name``
+    archived in segment ``segment``, else ``(None, path)``"""
+    head = path
+    tail = []
+    while head and head != os.sep:
+        if head.endswith(SEGMENT_SUFFIX) and os.path.isfile(head):
+            return head, '/'.join(reversed(tail))
+        head, name = os.path.split(head)
+        tail.append(name)
+    return None, path
+
+
+# zip timestamps can not be older
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def _write_member(archive, info, source):
+    """Writes the member ``info`` of zip ``archive`` with the content read
+    by blocks from file object ``source``, like ``ZipFile.write`` does for
+    a path but with the timestamp of ``info``"""
+    archive._writecheck(info)
+    archive._didModify = True
+    info.flag_bits = 0x00
+    info.header_offset = archive.fp.tell()
+    info.CRC = crc = 0
+    info.compress_size = compress_size = 0
+    # compressed size can be larger than uncompressed size
+    zip64 = archive._allowZip64 and info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    archive.fp.write(info.FileHeader(zip64))
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    else:
+        compressor = None
+    file_size = 0
+    while True:
+        block = source.read(FileTransitions.BLOCK_SIZE)
+        if not block:
+            break
+        file_size += len(block)
+        crc = zlib.crc32(block, crc) & 0xffffffff
+        if compressor is not None:
+            block = compressor.compress(block)
+            compress_size += len(block)
+        archive.fp.write(block)
+    if compressor is not None:
+        block = compressor.flush()
+        compress_size += len(block)
+        archive.fp.write(block)
+        info.compress_size = compress_size
+    else:
+        info.compress_size = file_size
+    info.CRC = crc
+    info.file_size = file_size
+    # the header is written again with the CRC and sizes
+    position = archive.fp.tell()
+    archive.fp.seek(info.header_offset, 0)
+    archive.fp.write(info.FileHeader(zip64))
+    archive.fp.seek(position, 0)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+
+
+class Segment(object):
+    """Zip archive of the files of a partition of done, error or duplicate
+    dir, see :meth:`swallow.config.BaseConfig.pack`.
+
+    Files are compressed one by one and the central directory of the
+    archive is the index of their offsets, a file is read or restored
+    without decompressing the others. The archive is rewritten to a
+    temporary file renamed once complete when it is modified."""
+
+    def __init__(self, path):
+        self.path = path
+        self._archive = None
+
+    @property
+    def archive(self):
+        if self._archive is None:
+            self._archive = zipfile.ZipFile(self.path, 'r', allowZip64=True)
+        return self._archive
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def members(self):
+        """Returns the ``zipfile.ZipInfo`` of the files of the segment"""
+        return self.archive.infolist()
+
+    def open(self, name):
+        """Returns file ``name`` of the segment opened"""
+        return self.archive.open(name)
+
+    def extract(self, name, dst):
+        """Writes file ``name`` of the segment to ``dst``"""
+        directory = os.path.dirname(dst)
+        if directory:
+            makedirs(directory)
+        info = self.archive.getinfo(name)
+        tmp = dst + FileTransitions.TEMP_SUFFIX
+        source = self.open(name)
+        try:
+            target = open(tmp, 'wb')
+            try:
+                while True:
+                    block = source.read(FileTransitions.BLOCK_SIZE)
+                    if not block:
+                        break
+                    target.write(block)
+            finally:
+                target.close()
+            mtime = mktime(info.date_time + (0, 0, -1))
+            os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, dst)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            source.close()
+
+    def _rewrite(self, write, fsync, append=True):
+        """Calls ``write`` with the archive opened on a temporary copy of
+        the segment, or an empty archive if ``append`` is ``False``, then
+        replaces the segment with it"""
+        self.close()
+        tmp = self.path + FileTransitions.TEMP_SUFFIX
+        if append and os.path.exists(self.path):
+            shutil.copyfile(self.path, tmp)
+            mode = 'a'
+        else:
+            mode = 'w'
+        try:
+            archive = zipfile.ZipFile(tmp, mode, zipfile.ZIP_DEFLATED, True)
+            try:
+                result = write(archive)
+            finally:
+                archive.close()
+            if fsync:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return result
+
+    def add(self, directory, fsync=False):
+        """Appends the files of ``directory`` to the segment, created if
+        needed, and returns the paths of the files now in the segment, that
+        can be removed.
+
+        Files already in the segment with the same content are skipped, a
+        file with the name of another one is added with a numbered
+        suffix."""
+        def write(archive):
+            infos = dict((info.filename, info) for info in archive.infolist())
+            paths = []
+            for dirpath, dirnames, filenames in os.walk(directory):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, directory).replace(os.sep, '/')
+                    info = infos.get(name)
+                    if info is not None:
+                        if (info.file_size == os.path.getsize(path)
+                            and info.CRC == file_crc32(path)):
+                            # packed by an interrupted call
+                            paths.append(path)
+                            continue
+                        n = 0
+                        aside = name
+                        while aside in infos:
+                            n += 1
+                            aside = '%s.%s' % (name, n)
+                        name = aside
+                    st = os.stat(path)
+                    # files moved with old or zeroed times
+                    date_time = max(localtime(st.st_mtime)[:6], ZIP_EPOCH)
+                    info = zipfile.ZipInfo(name, date_time)
+                    info.external_attr = (st.st_mode & 0xFFFF) << 16L
+                    info.file_size = st.st_size
+                    if os.path.splitext(name)[1] in COMPRESSION_SUFFIXES:
+                        info.compress_type = zipfile.ZIP_STORED
+                    else:
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                    f = open(path, 'rb')
+                    try:
+                        _write_member(archive, info, f)
+                    finally:
+                        f.close()
+                    infos[name] = info
+                    paths.append(path)
+            return paths
+        return self._rewrite(write, fsync)
+
+    def remove(self, names, fsync=False):
+        """Removes files ``names`` from the segment, the segment is removed
+        once empty"""
+        names = set(names)
+        self.close()
+        source = zipfile.ZipFile(self.path, 'r', allowZip64=True)
+        try:
+            infos = [
+                info for info in source.infolist()
+                if info.filename not in names
+            ]
+            if infos:
+                def write(archive):
+                    # members are copied by blocks, they might not fit
+                    # in memory
+                    for info in infos:
+                        copy = zipfile.ZipInfo(info.filename, info.date_time)
+                        copy.external_attr = info.external_attr
+                        copy.compress_type = info.compress_type
+                        copy.file_size = info.file_size
+                        member = source.open(info)
+                        try:
+                            _write_member(archive, copy, member)
+                        finally:
+                            member.close()
+                self._rewrite(write, fsync, append=False)
+        finally:
+            source.close()
+        if not infos:
+            os.remove(self.path)
+
+
+class ScanEntry(object):
+    """An entry of a directory scanned by :func:`scan_directory`"""
+
+    __slots__ = ('name', 'path', 'is_dir', 'mtime', 'size')
+
+    def __init__(self, name, path, is_dir, mtime, size=None):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        # :param mtime: modification time, ``None`` for directories
+        self.mtime = mtime
+        # :param size: size in bytes, ``None`` for directories
+        self.size = size
+
+    def __repr__(self):
+        return '<ScanEntry %s>' % self.name
+
+
+def scan_directory(path, names=None):
+    """Return the entries of directory ``path`` as a list of
+    :class:`ScanEntry` with at most one system call per entry.
+
+    ``os.scandir`` (or the ``scandir`` package) is used if it is available
+    so that the type of the entries is known without a call to ``stat``.
+    If ``names`` is provided only these entries are scanned.
+
+    Entries that vanish during the scan are ignored."""
+    entries = []
+    if names is None and _scandir is not None:
+        for entry in _scandir(path):
+            try:
+                if entry.is_dir():
+                    entries.append(ScanEntry(entry.name, entry.path, True, None))
+                else:
+                    st = entry.stat()
+                    entries.append(ScanEntry(
+                        entry.name,
+                        entry.path,
+                        False,
+                        st.st_mtime,
+                        st.st_size,
+                    ))
+            except OSError:
+                continue  # the entry vanished or is a broken link
+        return entries
+    if names is None:
+        names = os.listdir(path)
+    for name in names:
+        full_path = os.path.join(path, name)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            continue  # the entry vanished or is a broken link
+        if stat.S_ISDIR(st.st_mode):
+            entries.append(ScanEntry(name, full_path, True, None))
+        else:
+            entries.append(ScanEntry(
+                name,
+                full_path,
+                False,
+                st.st_mtime,
+                st.st_size,
+            ))
+    return entries
+
+
+class ScanPlan(object):
+    """Decisions taken for the entries of one directory snapshot.
+
+    - ``entries`` are the scanned entries, in scan order
+    - ``ready`` is the set of names of files older than ``quarantine``
+    - ``expired`` is the list of file entries older than ``grace_period``
+    """
+
+    def __init__(self, entries, quarantine, grace_period, now=None):
+        if now is None:
+            now = time()
+        self.entries = entries
+        self.ready = set()
+        self.expired = []
+        for entry in entries:
+            if entry.is_dir:
+                continue
+            age = now - entry.mtime
+            if quarantine <= 0 or age >= quarantine:
+                self.ready.add(entry.name)
+            if age > grace_period:
+                self.expired.append(entry)
+
+
+def normalize_value(field, value):
+    """Convert ``value`` of ``field`` so that values coming from a mapper
+    and from an instance can be compared"""
+    if isinstance(field, ForeignKey):
+        if isinstance(value, Model):
+            value = getattr(value, field.rel.get_related_field().attname)
+        field = field.rel.get_related_field()
+    return field.to_python(value)
+
+
+class LookupCache(object):
+    """Cache of model instances looked up by field values, see
+    :meth:`swallow.builder.BaseBuilder.lookup`.
+
+    Instances are kept in least recently used order, at most ``size`` of
+    them. Lookups without result are cached too. Tables loaded with
+    :meth:`LookupCache.preload` are kept until the cache is cleared and
+    are not queried again."""
+
+    _MISSING = object()  # cached lookup without result
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (model, filters) -> instance
+        self._tables = {}  # (model, field names) -> {values: [instances]}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        if self.hits or self.misses:
+            log.info(u'lookup cache: %s hits, %s misses' % (
+                self.hits,
+                self.misses,
+            ))
+        self.hits = 0
+        self.misses = 0
+        self._entries.clear()
+        self._tables.clear()
+
+    def preload(self, Model, *names, **filters):
+        """Loads the instances of ``Model`` matching ``filters`` (the whole
+        table by default) with one query, so that lookups by ``names``
+        fields are answered without query. Values are compared after
+        conversion with the ``to_python`` method of the fields"""
+        names = tuple(sorted(names))
+        fields = [Model._meta.get_field(name) for name in names]
+        table = {}
+        for instance in Model._default_manager.filter(**filters):
+            values = tuple(
+                # attname so that foreign keys are not fetched
+                normalize_value(field, getattr(instance, field.attname))
+                for field in fields
+            )
+            table.setdefault(values, []).append(instance)
+        self._tables[(Model, names)] = table
+        return len(table)
+
+    def get(self, Model, **filters):
+        """Same as ``Model.objects.get(**filters)`` but the result is
+        cached, ``filters`` values should be hashable"""
+        names = tuple(sorted(filters))
+        values = self._normalize(Model, names, filters)
+        table = self._tables.get((Model, names))
+        if table is not None:
+            self.hits += 1
+            instances = table.get(values, ())
+            if len(instances) == 1:
+                return instances[0]
+            if not instances:
+                raise Model.DoesNotExist(
+                    '%s matching query does not exist.' % Model._meta.object_name
+                )
+            raise Model.MultipleObjectsReturned(
+                'get() returned more than one %s -- it returned %s! '
+                'Lookup parameters were %s' % (
+                    Model._meta.object_name,
+                    len(instances),
+                    filters,
+                )
+            )
+        key = (Model, tuple(zip(names, values)))
+        instance = self._entries.pop(key, None)
+        if instance is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                instance = Model._default_manager.get(**filters)
+            except Model.DoesNotExist:
+                instance = self._MISSING
+            while len(self._entries) >= self.size > 0:
+                self._entries.popitem(last=False)
+        if self.size > 0:
+            self._entries[key] = instance  # most recently used
+        if instance is self._MISSING:
+            raise Model.DoesNotExist(
+                '%s matching query does not exist.' % Model._meta.object_name
+            )
+        return instance
+
+    def _normalize(self, Model, names, filters):
+        """Returns the values of ``filters`` converted with the
+        ``to_python`` method of their field, so that ``1`` and ``'1'`` are
+        the same lookup. Values of lookups like ``name__iexact`` are kept
+        as is"""
+        values = []
+        for name in names:
+            value = filters[name]
+            try:
+                field = Model._meta.get_field(name)
+            except FieldDoesNotExist:
+                pass
+            else:
+                value = normalize_value(field, value)
+            values.append(value)
+        return tuple(values)
+
+
+def parse_shard(value):
+    """Parses a shard given as ``'index/count'`` like ``'0/4'`` and returns
+    the ``(index, count)`` tuple, see
+    :meth:`swallow.config.BaseConfig.shard_key`"""
+    try:
+        index, count = [int(n) for n in value.split('/')]
+    except ValueError:
+        raise ValueError('shard should be like 0/4, not %r' % value)
+    if not 0 <= index < count:
+        raise ValueError('shard index should be in [0, %s[, not %s' % (count, index))
+    return index, count
 
 
 def get_config(path):
@@ -0,0 +1,313 @@
+"""Process the files of a configuration as soon as they land in its
+input directory, see ``swallow_watch`` command"""
+import os
+import sys
+import errno
+import select
+import logging
+
+from math import ceil
+from time import time
+
+from django.utils.text import force_unicode
+
+from swallow import inotify
+from swallow.util import is_utf8
+
+
+log = logging.getLogger('swallow.watch')
+
+
+WATCH_MASK = (
+    inotify.IN_CLOSE_WRITE
+    | inotify.IN_MOVED_TO
+    | inotify.IN_CREATE
+    | inotify.IN_ONLYDIR
+)
+
+
+class TimerWheel(object):
+    """Hashed timer wheel.
+
+    Items are stored in the slot of the tick of their deadline, modulo
+    the size of the wheel, so that scheduling is O(1) and expiring only
+    looks at the slots of the elapsed ticks."""
+
+    def __init__(self, tick=1.0, size=256, now=None):
+        if now is None:
+            now = time()
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for i in xrange(size)]
+        self.current = int(now / tick)  # first tick not expired yet
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, item):
+        """Schedule ``item`` to be expired at ``deadline``"""
+        t = max(int(ceil(deadline / self.tick)), self.current)
+        self.slots[t % self.size].append((t, item))
+        self._count += 1
+
+    def advance(self, now=None):
+        """Returns the list of items whose deadline is elapsed"""
+        if now is None:
+            now = time()
+        target = int(now / self.tick)
+        expired = []
+        if target < self.current:
+            return expired
+        # every slot is visited at most once, items of further turns
+        # of the wheel are kept in their slot
+        ticks = min(target - self.current + 1, self.size)
+        for i in xrange(ticks):
+            index = (self.current + i) % self.size
+            slot = self.slots[index]
+            if not slot:
+                continue
+            keep = []
+            for t, item in slot:
+                if t <= target:
+                    expired.append(item)
+                else:
+                    keep.append((t, item))
+            self.slots[index] = keep
+        self._count -= len(expired)
+        self.current = target + 1
+        return expired
+
+    def next_tick(self):
+        """Returns the tick of the earliest item, ``None`` if the wheel is
+        empty"""
+        if not self._count:
+            return None
+        earliest = None
+        for i in xrange(self.size):
+            for t, item in self.slots[(self.current + i) % self.size]:
+                if t == self.current + i:
+                    # no item can expire before
+                    return t
+                if earliest is None or t < earliest:
+                    earliest = t
+        # only items of further turns of the wheel
+        return earliest
+
+    def timeout(self, now=None):
+        """Seconds to wait before the earliest item expires, ``None`` if
+        the wheel is empty"""
+        t = self.next_tick()
+        if t is None:
+            return None
+        if now is None:
+            now = time()
+        return max(0, t * self.tick - now)
+
+
+class Watcher(object):
+    """Watch :attribute:`BaseConfig.input_dir` of ``config`` and its
+    subdirectories with inotify.
+
+    Files are queued when they are closed after writing or moved in the
+    input directory, and processed once :attribute:`BaseConfig.QUARANTINE`
+    has elapsed. The whole input directory is processed with
+    :method:`BaseConfig.run` when the watcher starts and when the inotify
+    queue overflows, which is also when secondary files older than
+    :attribute:`BaseConfig.GRACE_PERIOD` are cleaned."""
+
+    RETRY_DELAY = 60  # Min time (in seconds) before a postponed file
+                      # is processed again
+
+    def __init__(self, config, tick=1.0):
+        self.config = config
+        self.inotify = inotify.Inotify()
+        self.wheel = TimerWheel(tick)
+        self.directories = {}  # watch descriptor -> relative path
+        self.due = {}  # relative file path -> deadline
+        self.postponed = set()  # relative paths moved back to input dir
+        self.partition = None  # partition of the last processed files,
+                               # see BaseConfig.PACK
+        self.stopped = False
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def start(self):
+        """Watch input dir and process the files already there"""
+        log.info(u'watch %s in %s' % (
+            type(self.config).__name__,
+            self.config.input_dir(),
+        ))
+        self.watch_tree('')
+        if self.config.CLAIM:
+            # held until the watcher is closed
+            self.config.acquire_lease()
+        self.rescan()
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        self.inotify.close()
+        if self.config._lease is not None:
+            self.config.release_lease()
+
+    def watch_tree(self, path, schedule=False):
+        """Watch directory ``path`` and its subdirectories, the files
+        found in them are scheduled if ``schedule`` is ``True``"""
+        input_dir = self.config.input_dir()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(input_dir, path)):
+            partial_path = os.path.relpath(dirpath, input_dir)
+            if partial_path == '.':
+                partial_path = ''
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_MASK)
+            except OSError:
+                continue  # the directory vanished
+            self.directories[wd] = partial_path
+            if schedule:
+                for f in filenames:
+                    self.schedule(os.path.join(partial_path, f))
+
+    def rescan(self):
+        log.info(u'rescan %s' % self.config.input_dir())
+        self.config.run()
+        self.postponed.update(self.config._postponed)
+
+    def schedule(self, partial_file_path, deadline=None):
+        if deadline is None:
+            delay = self.config.QUARANTINE
+            if partial_file_path in self.postponed:
+                self.postponed.discard(partial_file_path)
+                delay = max(delay, self.RETRY_DELAY)
+            deadline = time() + delay
+        self.due[partial_file_path] = deadline
+        self.wheel.schedule(deadline, (partial_file_path, deadline))
+
+    def handle_events(self):
+        """Read inotify events and schedule the files"""
+        overflow = False
+        for event in self.inotify.read_events():
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if event.mask & inotify.IN_IGNORED:
+                # the directory was removed or moved away
+                self.directories.pop(event.wd, None)
+                continue
+            directory = self.directories.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            partial_path = os.path.join(directory, event.name)
+            if event.mask & inotify.IN_ISDIR:
+                self.watch_tree(partial_path, schedule=True)
+            elif event.mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                self.schedule(partial_path)
+        if overflow:
+            log.warning(u'inotify queue overflow for %s' % self.config.input_dir())
+            self.rescan()
+
+    def handle_timers(self, now=None):
+        """Process the files whose quarantine is elapsed"""
+        processed = False
+        for partial_file_path, deadline in self.wheel.advance(now):
+            if self.stopped:
+                break
+            if self.due.get(partial_file_path) != deadline:
+                continue  # the file was scheduled again since
+            del self.due[partial_file_path]
+            self.process(partial_file_path)
+            processed = True
+        if processed:
+            # processed files were moved out of work dir
+            self.config.transitions.truncate()
+            if self.config.CLAIM:
+                self.config.reclaim()
+            partition = self.config.partition()
+            if self.config.PACK and partition != self.partition:
+                # the previous partition is closed
+                self.config.pack_partitions()
+                self.partition = partition
+
+    def process(self, partial_file_path):
+        """Process one file the same way :method:`BaseConfig.process_recursively`
+        does"""
+        config = self.config
+        input_file_path = os.path.join(config.input_dir(), partial_file_path)
+
+        if not config.in_shard(partial_file_path):
+            return  # processed by the worker of its shard
+
+        # For now, do not process non utf-8 file names  #FIXME
+        if not is_utf8(os.path.basename(partial_file_path)):
+            error_file_path = config.archive_path(
+                config.error_dir(),
+                os.path.basename(partial_file_path)
+            )
+            config.transitions.move(input_file_path, error_file_path)
+            return
+
+        try:
+            st_mtime = os.stat(input_file_path).st_mtime
+        except OSError:
+            # the file might have been already moved
+            # by a nested builder
+            return
+        deadline = st_mtime + config.QUARANTINE
+        if deadline > time():
+            # the file was modified after it was scheduled
+            self.schedule(partial_file_path, deadline)
+            return
+
+        config.prepare_paths(os.path.dirname(partial_file_path))
+        try:
+            to_dir, new_instances, stop = config.process_file(partial_file_path)
+        except Exception, e:
+            msg = u'processing of %s failed' % force_unicode(input_file_path)
+            log.error(msg, exc_info=sys.exc_info())
+            if (partial_file_path not in config._opened
+                and os.path.exists(input_file_path)):
+                # the file was not opened yet, it goes to error dir
+                # through work dir like the others
+                work = os.path.join(config.working_dir(), partial_file_path)
+                config.transitions.move(input_file_path, work)
+                config.files.append(partial_file_path)
+            to_dir, new_instances, stop = config.error_dir(), None, False
+        if to_dir is not None:
+            config.mv_files_from_work_dir(to_dir=to_dir)
+        self.postponed.update(config._postponed)
+        config._opened.clear()
+        config._postponed.clear()
+        config.lookups.clear()
+        if hasattr(config, 'postprocess') and new_instances:
+            config.postprocess([new_instances])
+        if stop:
+            log.warning(u'stop watching %s' % force_unicode(config.input_dir()))
+            self.stop()
+
+
+def watch(watchers):
+    """Run ``watchers`` until they are all stopped"""
+    for watcher in watchers:
+        watcher.start()
+    while watchers:
+        timeouts = [w.wheel.timeout() for w in watchers]
+        timeouts = [t for t in timeouts if t is not None]
+        timeout = min(timeouts) if timeouts else None
+        try:
+            readable, _, _ = select.select(watchers, [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []  # interrupted by a signal
+        for watcher in readable:
+            if not watcher.stopped:
+                watcher.handle_events()
+        for watcher in watchers:
+            if not watcher.stopped:
+                watcher.handle_timers()
+        for watcher in watchers:
+            if watcher.stopped:
+                watcher.close()
+        watchers = [w for w in watchers if not w.stopped]